@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from . import tools
 from . import controllers
 from . import models
 from . import wizard
@@ -22,6 +22,7 @@
         "security/moodle_sync_security.xml",
         "security/ir.model.access.csv",
         "data/moodle_course_data.xml",
+        "data/ir_cron_data.xml",
 
         # 2. Các view & action cơ bản
         "views/moodle_course_views.xml",         # <-- chứa action_moodle_course
@@ -37,6 +38,7 @@
 
         # 4. New views
         "views/moodle_sync_views.xml",
+        "views/moodle_sync_job_views.xml",
     ],
     # Đường dẫn relative, không có dấu "
     "icon": ["static/description/icon.png"],
@@ -7,3 +7,4 @@ from . import progress_sync
 from . import assignments_sync
 from . import debug
 from . import config_debug
+from . import sync_jobs
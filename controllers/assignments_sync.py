@@ -1,15 +1,50 @@
 import requests
-from odoo import http
+from odoo import fields, http
 from odoo.http import request
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from odoo.exceptions import AccessError
 import json
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
+from odoo.addons.digi_moodle_sync.controllers.sync_jobs import run_or_enqueue
+from odoo.addons.digi_moodle_sync.tools.bulk import bulk_upsert
+from odoo.addons.digi_moodle_sync.tools.sync_cursor import SyncCursor
 
 _logger = logging.getLogger(__name__)
 
 MOODLE_SYNC_MANAGER_GROUP = 'digi_moodle_sync.group_manager'
 
+# Số khóa học hỏi chung một lần gọi mod_assign_get_assignments
+DEFAULT_ASSIGNMENT_COURSE_BATCH_SIZE = 50
+
+# Chia assignmentids của mod_assign_get_submissions theo kích thước phản hồi ước tính
+DEFAULT_SUBMISSION_CHUNK_BYTES = 2 * 1024 * 1024
+SUBMISSION_ESTIMATED_BYTES = 400
+SUBMISSION_MIN_ESTIMATE = 30
+SUBMISSION_MAX_IDS_PER_CALL = 200
+# Lùi mốc đồng bộ bài nộp một chút để không lỡ bài nộp sửa sát lúc tải
+SUBMISSION_WATERMARK_OVERLAP_SECONDS = 300
+
+
+def get_assignment_course_batch_size(env):
+    """Read digi_moodle_sync.assignment_course_batch_size, never below 1."""
+    value = env['ir.config_parameter'].sudo().get_param('digi_moodle_sync.assignment_course_batch_size')
+    try:
+        return max(int(value or DEFAULT_ASSIGNMENT_COURSE_BATCH_SIZE), 1)
+    except (TypeError, ValueError):
+        _logger.warning(f"Invalid digi_moodle_sync.assignment_course_batch_size '{value}', using {DEFAULT_ASSIGNMENT_COURSE_BATCH_SIZE}")
+        return DEFAULT_ASSIGNMENT_COURSE_BATCH_SIZE
+
+
+def get_submission_chunk_bytes(env):
+    """Read digi_moodle_sync.submission_chunk_bytes (estimated answer size of one call)."""
+    value = env['ir.config_parameter'].sudo().get_param('digi_moodle_sync.submission_chunk_bytes')
+    try:
+        return max(int(value or DEFAULT_SUBMISSION_CHUNK_BYTES), SUBMISSION_ESTIMATED_BYTES)
+    except (TypeError, ValueError):
+        _logger.warning(f"Invalid digi_moodle_sync.submission_chunk_bytes '{value}', using {DEFAULT_SUBMISSION_CHUNK_BYTES}")
+        return DEFAULT_SUBMISSION_CHUNK_BYTES
+
 class MoodleAssignmentSync(http.Controller):
     
     def _check_access_rights(self):
@@ -19,9 +54,9 @@ class MoodleAssignmentSync(http.Controller):
             )
             raise AccessError("Bạn không có quyền thực hiện hành động này. Vui lòng liên hệ quản trị viên.")
 
-    def _get_moodle_config(self):
+    def _get_moodle_config(self, env):
         """Get Moodle configuration with correct parameter names"""
-        params = request.env['ir.config_parameter'].sudo()
+        params = env['ir.config_parameter'].sudo()
         
         # Get parameters with correct names from your system
         token = params.get_param('digi_moodle_sync.token')
@@ -40,7 +75,8 @@ class MoodleAssignmentSync(http.Controller):
         return {
             'token': token,
             'url': moodle_url,
-            'api_url': api_url
+            'api_url': api_url,
+            'client': MoodleClient.from_env(env),
         }
 
     @http.route('/moodle/sync/assignments', type='http', auth='user', csrf=False, methods=['GET'])
@@ -56,155 +92,212 @@ class MoodleAssignmentSync(http.Controller):
                 status=403, 
                 headers=[('Content-Type', 'application/json')])
 
-        config = self._get_moodle_config()
+        return run_or_enqueue('assignments', lambda env: self._sync_assignments(env, **kwargs), kwargs)
+
+    def _sync_assignments(self, env, progress=None, cursor=None, **kwargs):
+        """Run the sync on ``env``; returns ``(payload, http_status)``.
+
+        ``cursor`` (a SyncCursor) time-boxes the course loop and resumes it.
+        """
+        cursor = cursor or SyncCursor()
+        config = self._get_moodle_config(env)
         if not config['token'] or not config['api_url']:
             _logger.error("Moodle configuration is missing - Token or URL not found")
-            return request.make_response(json.dumps({'error': 'Moodle configuration is missing - check digi_moodle_sync.token and digi_moodle_sync.moodle_url parameters'}), status=503, headers=[('Content-Type', 'application/json')])
+            return {'error': 'Moodle configuration is missing - check digi_moodle_sync.token and digi_moodle_sync.moodle_url parameters'}, 503
 
         _logger.info("Starting assignment synchronization...")
-        courses = request.env['moodle.course'].search([('active','=',True)])
+        courses = env['moodle.course'].search([('active','=',True)])
         if not courses:
             _logger.warning("No active courses found in Odoo to sync assignments for.")
-            return request.make_response(json.dumps({'error': 'No active courses found in Odoo database'}), status=503, headers=[('Content-Type', 'application/json')])
+            return {'error': 'No active courses found in Odoo database'}, 503
         
+        courses = cursor.pending(courses)
         _logger.info(f"Found {len(courses)} active courses to sync assignments for.")
         total_assignments_synced = 0
         total_submissions_synced_overall = 0
-        AssignmentModel = request.env['moodle.assignment'].sudo()
-
-        for course in courses:
-            _logger.info(f"Syncing assignments for course: {course.name} (Moodle Course ID: {course.moodle_id})")
-            params = {
-                'wstoken': config['token'],
-                'wsfunction': 'mod_assign_get_assignments',
-                'courseids[]': course.moodle_id,
-                'moodlewsrestformat': 'json'
-            }
+        AssignmentModel = env['moodle.assignment'].sudo()
+        batch_size = get_assignment_course_batch_size(env)
+        done_courses = 0
+        user_map = self._get_user_moodle_map(env)
+
+        # Một lần gọi mod_assign_get_assignments cho mỗi nhóm batch_size khóa học
+        for course_batch in cursor.chunks(courses, batch_size):
+            if progress:
+                progress(done_courses, len(courses))
+            done_courses += len(course_batch)
+            courses_by_moodle_id = {course.moodle_id: course for course in course_batch if course.moodle_id}
+            _logger.info(f"Syncing assignments for {len(courses_by_moodle_id)} courses (Moodle Course IDs: {list(courses_by_moodle_id)})")
             try:
-                response = requests.get(config['api_url'], params=params, timeout=30)
-                response.raise_for_status()
-                data = response.json()
+                assignments_by_course = self._fetch_assignments_by_course(config['client'], list(courses_by_moodle_id))
 
-                if isinstance(data, dict) and 'exception' in data:
-                    _logger.error(f"Moodle API error for course {course.name}: {data.get('message', 'Unknown error')} - Code: {data.get('errorcode', 'Unknown')}")
-                    continue
+                assignment_rows = []
+                sync_date = datetime.now()
+                for moodle_course_id, assignments_in_course_api in assignments_by_course.items():
+                    course = courses_by_moodle_id.get(moodle_course_id)
+                    if not course:
+                        _logger.warning(f"Moodle returned assignments for unexpected course ID {moodle_course_id}, skipping.")
+                        continue
+                    if not assignments_in_course_api:
+                        _logger.info(f"No assignments returned by API for course {course.name}")
+                        continue
+                    _logger.info(f"API returned {len(assignments_in_course_api)} assignments for course {course.name}.")
 
-                if 'courses' not in data or not isinstance(data['courses'], list):
-                    _logger.warning(f"No assignments found or invalid format for course {course.name}. Response: {data}")
-                    continue
+                    for assign_data_api in assignments_in_course_api:
+                        moodle_assign_id = assign_data_api.get('id')
+                        if not moodle_assign_id:
+                            _logger.warning(f"Assignment data from API for course {course.name} missing 'id'. Data: {assign_data_api}")
+                            continue
 
-                assignments_in_course_api = []
-                for course_data_api in data['courses']:
-                    if 'assignments' in course_data_api and isinstance(course_data_api['assignments'], list):
-                        assignments_in_course_api.extend(course_data_api['assignments'])
-                
-                if not assignments_in_course_api:
-                    _logger.info(f"No assignments returned by API for course {course.name}")
+                        assignment_rows.append({
+                            'moodle_id': moodle_assign_id,
+                            'name': assign_data_api.get('name', 'Unnamed Assignment'),
+                            'duedate': datetime.fromtimestamp(assign_data_api['duedate']) if assign_data_api.get('duedate') else False,
+                            'course_id': course.id,
+                            'last_sync_date': sync_date,
+                        })
+
+                if not assignment_rows:
                     continue
 
-                _logger.info(f"API returned {len(assignments_in_course_api)} assignments for course {course.name}.")
-                
-                existing_assignments_in_course = AssignmentModel.search([('course_id', '=', course.id)])
-                existing_assignments_map = {assign.moodle_id: assign for assign in existing_assignments_in_course}
-                
-                assignments_to_create_vals = []
-                assignments_to_update_map = {}
-                processed_assignment_ids_for_submission_sync = []
-
-                for assign_data_api in assignments_in_course_api:
-                    moodle_assign_id = assign_data_api.get('id')
-                    if not moodle_assign_id:
-                        _logger.warning(f"Assignment data from API for course {course.name} missing 'id'. Data: {assign_data_api}")
-                        continue
+                # Upsert on UNIQUE(moodle_id); unchanged assignments only get last_sync_date
+                upsert_result = bulk_upsert(env, 'moodle.assignment', assignment_rows, ['moodle_id'])
+                processed_assignment_ids_for_submission_sync = list(upsert_result['ids'].values())
+                created_assignments_count = upsert_result['created']
+                updated_assignments_count = upsert_result['updated']
 
-                    vals = {
-                        'moodle_id': moodle_assign_id,
-                        'name': assign_data_api.get('name', 'Unnamed Assignment'),
-                        'duedate': datetime.fromtimestamp(assign_data_api['duedate']) if assign_data_api.get('duedate') else False,
-                        'course_id': course.id,
-                        'last_sync_date': datetime.now(),
-                    }
-                    if moodle_assign_id in existing_assignments_map:
-                        assignments_to_update_map[existing_assignments_map[moodle_assign_id].id] = vals
-                        processed_assignment_ids_for_submission_sync.append(existing_assignments_map[moodle_assign_id].id)
-                    else:
-                        assignments_to_create_vals.append(vals)
-                
-                created_assignments_count = 0
-                if assignments_to_create_vals:
-                    try:
-                        created_records = AssignmentModel.create(assignments_to_create_vals)
-                        created_assignments_count = len(created_records)
-                        _logger.debug(f"Batch created {created_assignments_count} assignments for course {course.name}.")
-                        for rec in created_records: processed_assignment_ids_for_submission_sync.append(rec.id)
-                    except Exception as e_create_batch:
-                        _logger.error(f"Error batch creating assignments for course {course.name}: {e_create_batch}", exc_info=True)
-                        # Fallback to individual create for robustness
-                        for v_c in assignments_to_create_vals:
-                            try: 
-                                new_rec = AssignmentModel.create(v_c)
-                                _logger.debug(f"Individually created assignment {v_c['name']} for course {course.name}.")
-                                created_assignments_count+=1
-                                processed_assignment_ids_for_submission_sync.append(new_rec.id)
-                            except Exception as e_c_single:
-                                _logger.error(f"Error individually creating assignment {v_c.get('name')} for course {course.name}: {e_c_single}")
-                
-                updated_assignments_count = 0
-                for assign_id, update_vals in assignments_to_update_map.items():
-                    try:
-                        AssignmentModel.browse(assign_id).write(update_vals)
-                        _logger.debug(f"Updated assignment ID {assign_id} in course {course.name}.")
-                        updated_assignments_count += 1
-                    except Exception as e_update:
-                        _logger.error(f"Error updating assignment ID {assign_id} for course {course.name}: {e_update}")
-
-                course_assignments_processed_count = created_assignments_count + updated_assignments_count
-                total_assignments_synced += course_assignments_processed_count
-                _logger.info(f"Processed {course_assignments_processed_count} assignments for course {course.name} (Created: {created_assignments_count}, Updated: {updated_assignments_count}).")
-
-                # Sync submissions for all created/updated assignments in this course
+                total_assignments_synced += created_assignments_count + updated_assignments_count
+                _logger.info(f"Processed {len(processed_assignment_ids_for_submission_sync)} assignments for {len(course_batch)} courses (Created: {created_assignments_count}, Updated: {updated_assignments_count}, Unchanged: {upsert_result['unchanged']}).")
+
+                # Sync submissions for all created/updated assignments of these courses
                 if processed_assignment_ids_for_submission_sync:
                     assignments_for_submission_sync = AssignmentModel.browse(processed_assignment_ids_for_submission_sync)
-                    submissions_synced_this_course = self._sync_submissions(config, assignments_for_submission_sync)
-                    total_submissions_synced_overall += submissions_synced_this_course
+                    total_submissions_synced_overall += self._sync_submissions(env, config, assignments_for_submission_sync, full=bool(kwargs.get('full')), user_map=user_map)
 
             except requests.exceptions.RequestException as e_req:
-                _logger.error(f"API request error syncing assignments for course {course.name}: {e_req}")
+                _logger.error(f"API request error syncing assignments for courses {list(courses_by_moodle_id)}: {e_req}")
+            except ValueError as e_api:
+                _logger.error(f"Moodle API error for courses {list(courses_by_moodle_id)}: {e_api}")
             except Exception as e_course:
-                _logger.error(f"Unexpected error syncing assignments for course {course.name}: {e_course}", exc_info=True)
+                _logger.error(f"Unexpected error syncing assignments for courses {list(courses_by_moodle_id)}: {e_course}", exc_info=True)
         
         _logger.info(f"Assignment synchronization completed. Total assignments synced: {total_assignments_synced}, Total submissions synced: {total_submissions_synced_overall}.")
-        return request.make_response(json.dumps({
-            'message': f'Assignment sync completed successfully. Assignments: {total_assignments_synced}, Submissions: {total_submissions_synced_overall}.'
-        }), headers=[('Content-Type', 'application/json')])
+        return {
+            'message': f'Assignment sync completed successfully. Assignments: {total_assignments_synced}, Submissions: {total_submissions_synced_overall}.',
+            **cursor.summary(),
+        }, 200
+
+    def _fetch_assignments_by_course(self, client, moodle_course_ids):
+        """``{moodle course id: [assignment dicts]}`` for many courses in one call.
+
+        mod_assign_get_assignments accepts a list of course ids and answers
+        with one ``courses[]`` entry per course; courses Moodle cannot read
+        are reported in ``warnings`` and simply missing from the result.
+        Raises ``ValueError`` on a Moodle exception or malformed answer.
+        """
+        if not moodle_course_ids:
+            return {}
+        params = {f'courseids[{i}]': moodle_course_id for i, moodle_course_id in enumerate(moodle_course_ids)}
+        response = client.request('mod_assign_get_assignments', params, timeout=60)
+        response.raise_for_status()
+        data = response.json()
+
+        if isinstance(data, dict) and 'exception' in data:
+            raise ValueError(f"{data.get('message', 'Unknown error')} - Code: {data.get('errorcode', 'Unknown')}")
+        if not isinstance(data, dict) or not isinstance(data.get('courses'), list):
+            raise ValueError(f"Invalid mod_assign_get_assignments response: {str(data)[:500]}")
+        for warning in data.get('warnings') or []:
+            _logger.warning(f"mod_assign_get_assignments warning for {warning.get('item')} {warning.get('itemid')}: {warning.get('message')}")
+
+        assignments_by_course = {moodle_course_id: [] for moodle_course_id in moodle_course_ids}
+        for course_data_api in data['courses']:
+            assignments = course_data_api.get('assignments')
+            if course_data_api.get('id') and isinstance(assignments, list):
+                assignments_by_course.setdefault(course_data_api['id'], []).extend(assignments)
+        return assignments_by_course
+
+    def _sync_submissions(self, env, config, assignments_to_sync, full=False, user_map=None):
+        """Sync the submissions of ``assignments_to_sync``; returns the number of rows written.
 
-    def _sync_submissions(self, config, assignments_to_sync):
+        Assignment ids are sent in POST bodies, split into chunks whose
+        estimated answer stays under digi_moodle_sync.submission_chunk_bytes.
+        Unless ``full``, each chunk passes ``since`` = the assignments'
+        submissions_synced_until watermark, so only submissions modified
+        since the last successful run are transferred.
+
+        ``user_map`` is the :meth:`_get_user_moodle_map` of the run; it is
+        built here when the caller does not share one.
+        """
         _logger.info(f"Starting submission sync for {len(assignments_to_sync)} assignments.")
+        assignments_to_sync = assignments_to_sync.filtered('moodle_id')
         if not assignments_to_sync:
+            _logger.warning("No Moodle assignment IDs found for submission sync.")
             return 0
 
-        SubmissionModel = request.env['moodle.assignment.submission'].sudo()
-        ResUsers = request.env['res.users'].sudo()
-        MoodleUser = request.env['moodle.user'].sudo()
+        if user_map is None:
+            user_map = self._get_user_moodle_map(env)
         total_submissions_processed_count = 0
+        for since, chunk in self._plan_submission_chunks(env, assignments_to_sync, full):
+            total_submissions_processed_count += self._sync_submission_chunk(env, config, chunk, since, user_map)
+        return total_submissions_processed_count
 
-        # API mod_assign_get_submissions expects assignmentids[]
-        moodle_assignment_ids = [assign.moodle_id for assign in assignments_to_sync if assign.moodle_id]
-        if not moodle_assignment_ids:
-            _logger.warning("No Moodle assignment IDs found for submission sync.")
-            return 0
+    def _get_user_moodle_map(self, env):
+        """``{moodle user id: res.users id}`` of the active users, read in one query."""
+        users = env['res.users'].sudo().search_read([('moodle_id', '!=', False)], ['moodle_id'])
+        return {user['moodle_id']: user['id'] for user in users}
+
+    def _plan_submission_chunks(self, env, assignments, full=False):
+        """Yield ``(since, assignments)`` chunks for mod_assign_get_submissions.
 
-        params = {
-            'wstoken': config['token'],
-            'wsfunction': 'mod_assign_get_submissions',
-            'moodlewsrestformat': 'json'
+        ``since`` is a single value per call, so assignments are grouped by
+        watermark first. The answer size of an assignment is estimated from
+        the submissions already stored for it (at least
+        SUBMISSION_MIN_ESTIMATE, for new assignments).
+        """
+        budget = get_submission_chunk_bytes(env)
+        counts = {
+            group['assignment_id'][0]: group['assignment_id_count']
+            for group in env['moodle.assignment.submission'].sudo().read_group(
+                [('assignment_id', 'in', assignments.ids)], ['assignment_id'], ['assignment_id'])
         }
-        # Add assignment IDs to params. API might have a limit, but typically handles many.
-        for i, moodle_assign_id in enumerate(moodle_assignment_ids):
-            params[f'assignmentids[{i}]'] = moodle_assign_id
-        
+
+        by_since = {}
+        for assignment in assignments:
+            watermark = None if full else assignment.submissions_synced_until
+            since = int(watermark.replace(tzinfo=timezone.utc).timestamp()) if watermark else 0
+            by_since.setdefault(since, []).append(assignment)
+
+        for since, group in sorted(by_since.items()):
+            chunk, chunk_bytes = [], 0
+            for assignment in group:
+                estimate = max(counts.get(assignment.id, 0), SUBMISSION_MIN_ESTIMATE) * SUBMISSION_ESTIMATED_BYTES
+                if chunk and (chunk_bytes + estimate > budget or len(chunk) >= SUBMISSION_MAX_IDS_PER_CALL):
+                    yield since, assignments.browse([a.id for a in chunk])
+                    chunk, chunk_bytes = [], 0
+                chunk.append(assignment)
+                chunk_bytes += estimate
+            if chunk:
+                yield since, assignments.browse([a.id for a in chunk])
+
+    def _sync_submission_chunk(self, env, config, assignments, since, user_map):
+        """Fetch and upsert the submissions of one chunk; returns the number of rows written.
+
+        The watermark only advances for assignments whose submissions were
+        all stored; one skipped for an unknown user or a failed row keeps the
+        old watermark, so the next run fetches it again.
+
+        Users come from ``user_map`` and existing submissions are matched by
+        the ON CONFLICT of :func:`bulk_upsert`, so a chunk costs the same
+        number of queries whatever its number of submissions.
+        """
+        params = {'since': since}
+        for i, assignment in enumerate(assignments):
+            params[f'assignmentids[{i}]'] = assignment.moodle_id
+        # Mốc mới lấy trước khi gọi để không bỏ sót bài nộp sửa trong lúc đang tải
+        fetch_started_at = fields.Datetime.now()
+
+        total_submissions_processed_count = 0
         try:
-            response = requests.get(config['api_url'], params=params, timeout=60) # Increased timeout
+            response = config['client'].request('mod_assign_get_submissions', params, timeout=60, method='POST')
             response.raise_for_status()
             data = response.json()
 
@@ -213,14 +306,16 @@ class MoodleAssignmentSync(http.Controller):
                 return 0
             
             if 'assignments' not in data or not isinstance(data['assignments'], list):
-                _logger.warning(f"No submissions data or invalid format in API response. Response: {data}")
+                _logger.warning(f"No submissions data or invalid format in API response. Response: {str(data)[:500]}")
                 return 0
 
             # Map Odoo assignment ID to Moodle assignment ID for quick lookup
-            odoo_assignment_map = {assign.moodle_id: assign.id for assign in assignments_to_sync}
+            odoo_assignment_map = {assign.moodle_id: assign.id for assign in assignments}
 
-            submissions_to_create_vals = []
-            submissions_to_update_map = {}
+            submission_rows = []
+            missing_moodle_user_ids = set()
+            # Bài tập có bài nộp chưa lưu được: giữ mốc cũ để lần sau tải lại
+            incomplete_assignment_ids = set()
 
             for assign_data_api in data['assignments']:
                 api_moodle_assignment_id = assign_data_api.get('assignmentid')
@@ -240,10 +335,10 @@ class MoodleAssignmentSync(http.Controller):
                         continue
                     
                     # Find Odoo user (res.users) via moodle_id
-                    odoo_user = ResUsers.search([('moodle_id', '=', moodle_user_id)], limit=1)
-                    if not odoo_user:
-                        # Optional: Attempt to find/create moodle.user and then res.users if needed
-                        _logger.warning(f"Odoo user with Moodle ID {moodle_user_id} not found for submission in Moodle assignment ID {api_moodle_assignment_id}. Consider running user sync first.")
+                    odoo_user_id = user_map.get(moodle_user_id)
+                    if not odoo_user_id:
+                        missing_moodle_user_ids.add(moodle_user_id)
+                        incomplete_assignment_ids.add(odoo_assignment_id)
                         continue
                     
                     submission_status_api = sub_data_api.get('status')
@@ -253,54 +348,34 @@ class MoodleAssignmentSync(http.Controller):
 
                     vals = {
                         'assignment_id': odoo_assignment_id,
-                        'user_id': odoo_user.id,
+                        'user_id': odoo_user_id,
                         'status': submission_status_api,
                         'timemodified': datetime.fromtimestamp(sub_data_api['timemodified']) if sub_data_api.get('timemodified') else False,
                         'grade': sub_data_api.get('grade'), # API might send grade as part of submission status or a separate grade call
                         'last_sync_date': datetime.now(),
                     }
+                    submission_rows.append(vals)
+            
+            if missing_moodle_user_ids:
+                _logger.warning(f"Skipped submissions of {len(missing_moodle_user_ids)} Moodle users without Odoo user (Moodle IDs: {sorted(missing_moodle_user_ids)[:20]}). Consider running user sync first.")
 
-                    existing_submission = SubmissionModel.search([
-                        ('assignment_id', '=', odoo_assignment_id),
-                        ('user_id', '=', odoo_user.id)
-                    ], limit=1)
+            upsert_result = bulk_upsert(env, 'moodle.assignment.submission', submission_rows, ['assignment_id', 'user_id'])
+            # Khóa lỗi là (assignment_id, user_id)
+            incomplete_assignment_ids.update(key[0] for key in upsert_result['failed'])
+            created_submissions_count = upsert_result['created']
+            updated_submissions_count = upsert_result['updated']
 
-                    if existing_submission:
-                        submissions_to_update_map[existing_submission.id] = vals
-                    else:
-                        submissions_to_create_vals.append(vals)
-            
-            created_submissions_count = 0
-            if submissions_to_create_vals:
-                try:
-                    created_subs = SubmissionModel.create(submissions_to_create_vals)
-                    created_submissions_count = len(created_subs)
-                    _logger.debug(f"Batch created {created_submissions_count} submissions.")
-                except Exception as e_create_batch_sub:
-                    _logger.error(f"Error batch creating submissions: {e_create_batch_sub}", exc_info=True)
-                    for v_s_c in submissions_to_create_vals:
-                        try:
-                            SubmissionModel.create(v_s_c)
-                            _logger.debug(f"Individually created submission for assignment {v_s_c['assignment_id']} user {v_s_c['user_id']}.")
-                            created_submissions_count +=1
-                        except Exception as e_s_c_single:
-                            _logger.error(f"Error individually creating submission for assignment {v_s_c.get('assignment_id')} user {v_s_c.get('user_id')}: {e_s_c_single}")
-                            
-            updated_submissions_count = 0
-            for sub_id, update_vals_sub in submissions_to_update_map.items():
-                try:
-                    SubmissionModel.browse(sub_id).write(update_vals_sub)
-                    _logger.debug(f"Updated submission ID {sub_id}.")
-                    updated_submissions_count += 1
-                except Exception as e_update_sub:
-                    _logger.error(f"Error updating submission ID {sub_id}: {e_update_sub}")
-            
             total_submissions_processed_count = created_submissions_count + updated_submissions_count
-            _logger.info(f"Processed {total_submissions_processed_count} submissions (Created: {created_submissions_count}, Updated: {updated_submissions_count}) for the provided assignments.")
+            _logger.info(f"Processed {total_submissions_processed_count} submissions (Created: {created_submissions_count}, Updated: {updated_submissions_count}, Unchanged: {upsert_result['unchanged']}) for {len(assignments)} assignments since {since}.")
+
+            complete_assignments = assignments.filtered(lambda a: a.id not in incomplete_assignment_ids)
+            complete_assignments.write({'submissions_synced_until': fetch_started_at - timedelta(seconds=SUBMISSION_WATERMARK_OVERLAP_SECONDS)})
+            if incomplete_assignment_ids:
+                _logger.info(f"Kept the submission watermark of {len(incomplete_assignment_ids)} assignments with unsaved submissions")
 
         except requests.exceptions.RequestException as e_req_sub:
             _logger.error(f"API request error syncing submissions: {e_req_sub}")
         except Exception as e_sub_main:
             _logger.error(f"Unexpected error syncing submissions: {e_sub_main}", exc_info=True)
             
-        return total_submissions_processed_count
\ No newline at end of file
+        return total_submissions_processed_count
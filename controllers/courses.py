@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 import logging
 import requests
-import json
 
 from odoo import http
 from odoo.http import request
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
+from odoo.addons.digi_moodle_sync.controllers.sync_jobs import json_response
+from odoo.addons.digi_moodle_sync.tools.sync_cursor import SyncCursor
 
 _logger = logging.getLogger(__name__)
 
@@ -12,50 +14,57 @@ class MoodleCourseController(http.Controller):
 
     @http.route('/moodle/get_courses', type='http', auth='public', methods=['GET'], csrf=False)
     def get_moodle_courses(self, **kw):
+        payload, status = self._sync_courses(request.env)
+        return json_response(payload, status)
+
+    def _sync_courses(self, env, progress=None, cursor=None, **kw):
+        """Pull the Moodle course list into moodle.course; returns ``(payload, http_status)``.
+
+        ``cursor`` (a SyncCursor) time-boxes the loop over the list, in
+        Moodle id order, and resumes it after the last completed chunk.
+        """
+        cursor = cursor or SyncCursor()
         # Lấy cấu hình từ Settings
-        config = request.env['ir.config_parameter'].sudo()
-        moodle_url = config.get_param('digi_moodle_sync.moodle_url')
-        token      = config.get_param('digi_moodle_sync.token')
-
-        params = {
-            'wstoken':            token,
-            'wsfunction':         'core_course_get_courses',
-            'moodlewsrestformat': 'json'
-        }
+        client = MoodleClient.from_env(env)
+
         try:
-            response = requests.get(moodle_url, params=params, timeout=15)
+            response = client.request('core_course_get_courses', timeout=15)
             response.raise_for_status()
             courses = response.json()
+            if not isinstance(courses, list):
+                _logger.error('Unexpected core_course_get_courses response: %s', str(courses)[:500])
+                return {'error': f"Moodle API error: {courses.get('message', courses) if isinstance(courses, dict) else courses}"}, 200
+
+            MoodleCourse = env['moodle.course'].sudo()
+            cr = env.cr
+            done_courses = 0
+            for course_chunk in cursor.item_chunks(courses, key=lambda c: c.get('id') or 0):
+                for course in course_chunk:
+                    if progress:
+                        progress(done_courses, len(courses))
+                    done_courses += 1
+                    cid = course.get('id')
+                    vals = {
+                        'name':      course.get('fullname'),
+                        'shortname': course.get('shortname'),
+                    }
+                    try:
+                        # Lỗi một khóa học chỉ huỷ khóa học đó; nhóm được commit ở checkpoint của job
+                        with cr.savepoint():
+                            existing = MoodleCourse.search([('moodle_id','=',cid)], limit=1)
+                            if existing:
+                                existing.write(vals)
+                            else:
+                                MoodleCourse.create({'moodle_id': cid, **vals})
+                    except Exception as e:
+                        _logger.error('Error syncing course %s: %s', cid, e)
 
-            MoodleCourse = request.env['moodle.course'].sudo()
-            cr = request.env.cr
-            for course in courses:
-                cid = course.get('id')
-                vals = {
-                    'name':      course.get('fullname'),
-                    'shortname': course.get('shortname'),
-                }
-                try:
-                    existing = MoodleCourse.search([('moodle_id','=',cid)], limit=1)
-                    if existing:
-                        existing.write(vals)
-                    else:
-                        MoodleCourse.create({'moodle_id': cid, **vals})
-                    cr.commit()
-                except Exception as e:
-                    _logger.error('Error syncing course %s: %s', cid, e)
-                    cr.rollback()
-
-            return request.make_response(
-                json.dumps({'message': 'Courses synchronized successfully'}),
-                headers=[('Content-Type','application/json')])
+            if cursor.interrupted:
+                return {'message': 'Courses partially synchronized, the rest runs in the next tick', **cursor.summary()}, 200
+            return {'message': 'Courses synchronized successfully'}, 200
         except requests.RequestException as e:
             _logger.error('Moodle connection error: %s', e)
-            return request.make_response(
-                json.dumps({'error': f'Không thể kết nối Moodle: {e}'}),
-                headers=[('Content-Type','application/json')])
+            return {'error': f'Không thể kết nối Moodle: {e}'}, 200
         except Exception as e:
             _logger.error('Unexpected error: %s', e)
-            return request.make_response(
-                json.dumps({'error': f'Lỗi không xác định: {e}'}),
-                headers=[('Content-Type','application/json')])
+            return {'error': f'Lỗi không xác định: {e}'}, 200
@@ -2,17 +2,36 @@
 import logging
 import requests
 import json
-from datetime import datetime
+import time
+from datetime import datetime, timedelta, timezone
 
-from odoo import http
+from odoo import http, fields
 from odoo.http import request
 from odoo.tools import float_is_zero # For comparing float grades if needed
 from odoo.exceptions import AccessError # Added AccessError
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
+from odoo.addons.digi_moodle_sync.controllers.sync_jobs import run_or_enqueue
+from odoo.addons.digi_moodle_sync.tools.bulk import bulk_upsert
+from odoo.addons.digi_moodle_sync.tools.fetch_pool import fetch_concurrently, get_fetch_concurrency
+from odoo.addons.digi_moodle_sync.tools.sync_cursor import SyncCursor
 
 _logger = logging.getLogger(__name__)
 
 MOODLE_SYNC_MANAGER_GROUP = 'digi_moodle_sync.group_manager' # Define group name
 
+# Số học viên mỗi lượt khi phải tải điểm từng người của một khóa học quá lớn
+GRADE_USER_CHUNK_SIZE = 200
+
+# Thời gian chờ tối đa báo cáo điểm toàn khóa; quá thời gian thì chuyển ngay sang tải theo nhóm học viên
+COURSE_GRADES_TIMEOUT = 120
+COURSE_GRADES_MIN_TIMEOUT = 10
+
+# Lùi mốc đồng bộ tăng dần một chút để bù chênh lệch đồng hồ giữa Odoo và Moodle
+WATERMARK_OVERLAP_SECONDS = 300
+
+ENROLLMENT_KEY = ['moodle_course_id', 'moodle_user_id']
+GRADE_KEY = ['moodle_user_id', 'moodle_course_id', 'moodle_item_id']
+
 class MoodleCourseGradeSyncController(http.Controller):
 
     def _check_access_rights(self):
@@ -22,11 +41,6 @@ class MoodleCourseGradeSyncController(http.Controller):
             )
             raise AccessError("Bạn không có quyền thực hiện hành động này. Vui lòng liên hệ quản trị viên.")
 
-    def _get_moodle_api_url(self, base_url):
-        if not base_url:
-            return None
-        return base_url.rstrip('/') + '/webservice/rest/server.php'
-
     @http.route('/moodle/sync_all_courses_grades', type='http', auth='user', methods=['GET'], csrf=False)
     def sync_all(self, **kw):
         _logger.info(
@@ -40,41 +54,95 @@ class MoodleCourseGradeSyncController(http.Controller):
                 status=403, 
                 headers=[('Content-Type', 'application/json')])
 
-        config = request.env['ir.config_parameter'].sudo()
-        base_moodle_url = config.get_param('digi_moodle_sync.moodle_url')
-        token = config.get_param('digi_moodle_sync.token')
+        return run_or_enqueue('courses_grades', lambda env: self._sync_all(env, **kw), kw)
 
-        if not base_moodle_url or not token:
-            _logger.error("Moodle URL hoặc Token chưa được cấu hình trong Cài đặt Hệ thống.")
-            return request.make_response(json.dumps({'error': 'Moodle URL/Token chưa cấu hình.'}), headers=[('Content-Type', 'application/json')])
+    def _sync_all(self, env, progress=None, cursor=None, **kw):
+        """Run the grade sync on ``env``; returns ``(payload, http_status)``.
+
+        ``cursor`` (a SyncCursor) time-boxes the run; an interrupted run
+        resumes after the last completed chunk of users or courses.
+        """
+        cursor = cursor or SyncCursor()
+        config = env['ir.config_parameter'].sudo()
+        max_workers = get_fetch_concurrency(env)
+        client = MoodleClient.from_env(env, min_pool_size=max_workers)
 
-        api_url = self._get_moodle_api_url(base_moodle_url)
-        users_to_sync = request.env['res.users'].sudo().search([('moodle_id', '!=', False), ('moodle_id', '!=', 0)])
+        if not client.is_configured:
+            _logger.error("Moodle URL hoặc Token chưa được cấu hình trong Cài đặt Hệ thống.")
+            return {'error': 'Moodle URL/Token chưa cấu hình.'}, 200
+
+        # mode=course: một lần gọi báo cáo điểm cho mỗi khóa học thay vì mỗi cặp (user, khóa học)
+        sync_mode = kw.get('mode') or config.get_param('digi_moodle_sync.grade_sync_mode') or 'user'
+        incremental = not kw.get('full') and bool(config.get_param('digi_moodle_sync.grade_sync_incremental'))
+        # Một lượt chạy tiếp tục giữ thời điểm bắt đầu của lượt đầu cho mốc tăng dần
+        run_started_at = fields.Datetime.to_datetime(
+            cursor.data.setdefault('run_started_at', fields.Datetime.to_string(fields.Datetime.now())))
+        if sync_mode == 'course':
+            return self._sync_all_by_course(env, client, max_workers, incremental, run_started_at, progress, cursor)
+
+        users_to_sync = env['res.users'].sudo().search([('moodle_id', '!=', False), ('moodle_id', '!=', 0)])
         
-        if not users_to_sync:
+        if not users_to_sync and not cursor.resumed:
             _logger.info("Không tìm thấy người dùng Odoo nào có Moodle ID để đồng bộ điểm.")
-            return request.make_response(json.dumps({'message': 'Không có người dùng nào có Moodle ID hợp lệ để đồng bộ.'}), headers=[('Content-Type', 'application/json')])
+            return {'message': 'Không có người dùng nào có Moodle ID hợp lệ để đồng bộ.'}, 200
 
-        _logger.info(f"Bắt đầu đồng bộ khóa học và điểm cho {len(users_to_sync)} người dùng Odoo có Moodle ID.")
+        _logger.info(f"Bắt đầu đồng bộ khóa học và điểm cho {len(users_to_sync)} người dùng Odoo có Moodle ID ({max_workers} luồng tải song song).")
         
         results = {}
         grand_total_courses_processed = 0
         grand_total_grades_created = 0
         grand_total_grades_updated = 0
+        grand_total_grades_unchanged = 0
         grand_total_enrollments_created = 0
         grand_total_enrollments_updated = 0
 
+        users_to_sync = cursor.pending(users_to_sync)
+        users_by_moodle_id = {}
         for odoo_user in users_to_sync:
             if not odoo_user.moodle_id: # Double check
                 _logger.warning(f"Người dùng Odoo {odoo_user.name} (ID: {odoo_user.id}) không có Moodle ID. Bỏ qua.")
                 continue
+            users_by_moodle_id[odoo_user.moodle_id] = odoo_user
+
+        course_id_map = self._get_course_id_map(env)
+        since_by_course = dict.fromkeys(course_id_map)
+        if incremental:
+            courses = env['moodle.course'].sudo().browse(list(course_id_map.values()))
+            since_by_course = self._select_courses_to_refetch(client, self._get_grade_watermarks(courses), max_workers)
+            _logger.info(f"Đồng bộ tăng dần: tải lại điểm của {len(since_by_course)}/{len(course_id_map)} khóa học có thay đổi.")
+
+        # Tải dữ liệu Moodle song song, ghi ORM tuần tự trên cursor của request;
+        # hạn thời gian chỉ được kiểm tra giữa các nhóm người dùng
+        fetch_user = lambda user_moodle_id: self._fetch_user_courses_and_grades(client, user_moodle_id, since_by_course)
+        fetch_stream = (
+            fetched
+            for chunk in cursor.chunks(users_to_sync, GRADE_USER_CHUNK_SIZE)
+            for fetched in fetch_concurrently(
+                fetch_user,
+                [u.moodle_id for u in chunk if users_by_moodle_id.get(u.moodle_id) == u],
+                max_workers=max_workers)
+        )
+
+        for user_index, (user_moodle_id, payload, fetch_error) in enumerate(fetch_stream):
+            if progress:
+                progress(user_index, len(users_by_moodle_id))
+            odoo_user = users_by_moodle_id[user_moodle_id]
             try:
+                if fetch_error:
+                    raise fetch_error
                 _logger.info(f"Đang đồng bộ cho người dùng: {odoo_user.name} (Moodle ID: {odoo_user.moodle_id})")
-                sync_result = self._sync_user_courses_and_grades(odoo_user, api_url, token)
+                sync_result = self._apply_user_courses_and_grades(env, odoo_user, payload, course_id_map)
                 results[odoo_user.id] = sync_result
+                if sync_result.get('error'):
+                    # Không biết người dùng học những khóa nào: giữ mốc của mọi khóa học
+                    cursor.data['had_errors'] = True
+                if sync_result.get('failed_course_ids'):
+                    failed_courses = cursor.data.setdefault('failed_courses', [])
+                    failed_courses.extend(cid for cid in sync_result['failed_course_ids'] if cid not in failed_courses)
                 grand_total_courses_processed += sync_result.get('courses_processed_count', 0)
                 grand_total_grades_created += sync_result.get('grades_created', 0)
                 grand_total_grades_updated += sync_result.get('grades_updated', 0)
+                grand_total_grades_unchanged += sync_result.get('grades_unchanged', 0)
                 grand_total_enrollments_created += sync_result.get('enrollments_created', 0)
                 grand_total_enrollments_updated += sync_result.get('enrollments_updated', 0)
 
@@ -82,19 +150,30 @@ class MoodleCourseGradeSyncController(http.Controller):
                 error_msg = f"Lỗi nghiêm trọng khi đồng bộ cho người dùng {odoo_user.name} (Moodle ID: {odoo_user.moodle_id}): {e}"
                 _logger.error(error_msg, exc_info=True)
                 results[odoo_user.id] = {'error': error_msg}
+                # Lưu vào cursor để lượt chạy tiếp (sau khi dừng hoặc bị kill) vẫn biết đã có lỗi
+                cursor.data['had_errors'] = True
+
+        had_errors = bool(cursor.data.get('had_errors'))
+        if cursor.interrupted:
+            _logger.info(f"Dừng đồng bộ điểm do hết thời gian, sẽ tiếp tục sau người dùng ID {cursor.resume_after}.")
+            return {'message': f"Đã đồng bộ {len(results)} người dùng, phần còn lại chạy ở lượt sau.", 'details_per_user': results, **cursor.summary()}, 200
 
         final_summary_message = (
             f"Hoàn tất đồng bộ cho tất cả người dùng. "
             f"Tổng khóa học đã xử lý: {grand_total_courses_processed}. "
             f"Tổng ghi danh tạo mới: {grand_total_enrollments_created}, cập nhật: {grand_total_enrollments_updated}. "
-            f"Tổng điểm tạo mới: {grand_total_grades_created}, cập nhật: {grand_total_grades_updated}."
+            f"Tổng điểm tạo mới: {grand_total_grades_created}, cập nhật: {grand_total_grades_updated}, không đổi: {grand_total_grades_unchanged}. "
+            f"Khóa học bỏ qua do không thay đổi: {len(course_id_map) - len(since_by_course)}."
         )
         _logger.info(final_summary_message)
         config.set_param('digi_moodle_sync.last_grades_sync_date', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        # Mốc chỉ được đẩy lên khi không người dùng nào lỗi, nếu không lần sau tải lại từ mốc cũ;
+        # khóa học tải hoặc ghi điểm lỗi cũng giữ mốc cũ
+        if not had_errors:
+            failed_courses = set(cursor.data.get('failed_courses') or [])
+            self._advance_grade_watermarks(env, [cid for cid in course_id_map if cid not in failed_courses], run_started_at)
 
-        return request.make_response(
-            json.dumps({'message': final_summary_message, 'details_per_user': results}),
-            headers=[('Content-Type', 'application/json')])
+        return {'message': final_summary_message, 'details_per_user': results}, 200
 
     @http.route('/moodle/sync_courses_grades', type='http', auth='user', methods=['GET'], csrf=False)
     def sync_one(self, **kw):
@@ -122,93 +201,186 @@ class MoodleCourseGradeSyncController(http.Controller):
             _logger.error(f"Tham số 'odoo_userid' không hợp lệ: {odoo_user_id_param}. Lỗi: {ve}")
             return request.make_response(json.dumps({'error': f'Tham số odoo_userid không hợp lệ: {ve}'}), status=400, headers=[('Content-Type', 'application/json')])
 
-        config = request.env['ir.config_parameter'].sudo()
-        base_moodle_url = config.get_param('digi_moodle_sync.moodle_url')
-        token = config.get_param('digi_moodle_sync.token')
+        return run_or_enqueue('user_grades', lambda env: self._sync_one(env, **kw), kw)
+
+    def _sync_one(self, env, progress=None, cursor=None, **kw):
+        """Sync courses and grades of one res.users; returns ``(payload, http_status)``.
+
+        The work for one user is short and is not split; a ``cursor`` whose
+        deadline has already passed only postpones it to the next tick.
+        """
+        if cursor and cursor.expired():
+            cursor.interrupted = True
+            return {'message': 'Chưa chạy: hết thời gian của lượt cron, chạy ở lượt sau.', **cursor.summary()}, 200
+        odoo_user_id_param = kw.get('odoo_userid')
+        odoo_user_id_int = int(odoo_user_id_param)
+        client = MoodleClient.from_env(env)
 
-        if not base_moodle_url or not token:
+        if not client.is_configured:
             _logger.error("Moodle URL hoặc Token chưa được cấu hình.")
-            return request.make_response(json.dumps({'error': 'Moodle URL/Token chưa cấu hình.'}), headers=[('Content-Type', 'application/json')])
-        api_url = self._get_moodle_api_url(base_moodle_url)
+            return {'error': 'Moodle URL/Token chưa cấu hình.'}, 200
 
         try:
-            odoo_user = request.env['res.users'].sudo().browse(odoo_user_id_int)
+            odoo_user = env['res.users'].sudo().browse(odoo_user_id_int)
             if not odoo_user.exists():
-                return request.make_response(json.dumps({'error': f'Người dùng Odoo với ID {odoo_user_id_int} không tồn tại.'}), headers=[('Content-Type', 'application/json')])
+                return {'error': f'Người dùng Odoo với ID {odoo_user_id_int} không tồn tại.'}, 200
             if not odoo_user.moodle_id:
-                return request.make_response(json.dumps({'error': f'Người dùng Odoo {odoo_user.name} (ID: {odoo_user_id_int}) không có Moodle ID.'}), headers=[('Content-Type', 'application/json')])
+                return {'error': f'Người dùng Odoo {odoo_user.name} (ID: {odoo_user_id_int}) không có Moodle ID.'}, 200
 
             _logger.info(f"Bắt đầu đồng bộ khóa học và điểm cho người dùng: {odoo_user.name} (Moodle ID: {odoo_user.moodle_id})")
-            data = self._sync_user_courses_and_grades(odoo_user, api_url, token)
-            return request.make_response(json.dumps({'message': 'Đồng bộ hoàn tất.', 'result': data}), headers=[('Content-Type', 'application/json')])
+            data = self._sync_user_courses_and_grades(env, odoo_user, client)
+            return {'message': 'Đồng bộ hoàn tất.', 'result': data}, 200
         except Exception as e:
             _logger.error(f"Lỗi khi đồng bộ cho người dùng Odoo ID {odoo_user_id_param}: {e}", exc_info=True)
-            return request.make_response(json.dumps({'error': str(e)}), status=500, headers=[('Content-Type', 'application/json')])
+            return {'error': str(e)}, 500
 
-    def _sync_user_courses_and_grades(self, odoo_user_record, api_url, token):
-        user_moodle_id = odoo_user_record.moodle_id
-        odoo_user_id_int = odoo_user_record.id
-        _logger.info(f"Đang xử lý người dùng: {odoo_user_record.name} (Odoo ID: {odoo_user_id_int}, Moodle ID: {user_moodle_id})")
+    def _get_course_id_map(self, env):
+        """Return {Moodle course id: moodle.course id} for every synced course."""
+        courses = env['moodle.course'].sudo().search_read([('moodle_id', '!=', False)], ['moodle_id'])
+        return {c['moodle_id']: c['id'] for c in courses}
 
-        MoodleAppUser = request.env['moodle.user'].sudo()
-        moodle_app_user = MoodleAppUser.search([('moodle_id', '=', user_moodle_id)], limit=1)
-        if not moodle_app_user:
-            moodle_app_user_vals = {
-                'name': odoo_user_record.name,
-                'login': odoo_user_record.login or f'user_{user_moodle_id}@placeholder.com',
-                'email': odoo_user_record.email or f'user_{user_moodle_id}@placeholder.com',
-                'moodle_id': user_moodle_id,
-                'odoo_user_id': odoo_user_id_int,
-                'last_sync_date': datetime.now(),
-            }
-            try:
-                moodle_app_user = MoodleAppUser.create(moodle_app_user_vals)
-                _logger.debug(f"Đã tạo moodle.user (ID: {moodle_app_user.id}) cho Moodle ID {user_moodle_id}.")
-            except Exception as e_create_mu:
-                _logger.error(f"Không thể tạo moodle.user cho {odoo_user_record.name} (Moodle ID {user_moodle_id}). Lỗi: {e_create_mu}")
-                return {'error': f"Không thể tạo moodle.user: {e_create_mu}"}
-        elif not moodle_app_user.odoo_user_id or moodle_app_user.odoo_user_id.id != odoo_user_id_int:
-            try:
-                moodle_app_user.write({'odoo_user_id': odoo_user_id_int, 'last_sync_date': datetime.now()})
-                _logger.debug(f"Cập nhật odoo_user_id trên moodle.user (ID: {moodle_app_user.id}) thành {odoo_user_id_int}.")
-            except Exception as e_write_mu:
-                 _logger.error(f"Không thể cập nhật odoo_user_id trên moodle.user cho {odoo_user_record.name}. Lỗi: {e_write_mu}")
-                 # Continue with existing moodle_app_user if link update fails
+    def _get_grade_watermarks(self, courses):
+        """Return {Moodle course id: unix timestamp of grades_synced_until, or None}."""
+        return {
+            course.moodle_id: int(course.grades_synced_until.replace(tzinfo=timezone.utc).timestamp()) if course.grades_synced_until else None
+            for course in courses
+        }
+
+    def _advance_grade_watermarks(self, env, course_moodle_ids, run_started_at):
+        """Move grades_synced_until of the given courses to the start of the current run."""
+        if not course_moodle_ids:
+            return
+        courses = env['moodle.course'].sudo().search([('moodle_id', 'in', course_moodle_ids)])
+        courses.write({'grades_synced_until': run_started_at - timedelta(seconds=WATERMARK_OVERLAP_SECONDS)})
 
+    def _course_has_grade_updates(self, client, course_moodle_id, since_ts):
+        """Ask Moodle whether anything in the course changed since ``since_ts`` (fetch thread, no ORM).
+
+        Any doubt (no watermark yet, API error) answers True so the course is refetched.
+        """
+        if not since_ts:
+            return True
+        try:
+            data = client.call('core_course_get_updates_since', {'courseid': course_moodle_id, 'since': since_ts}, timeout=30)
+        except (requests.RequestException, ValueError) as e_updates:
+            _logger.warning(f"Lỗi API (core_course_get_updates_since) cho Course {course_moodle_id}: {e_updates}. Sẽ tải lại toàn bộ.")
+            return True
+        if not isinstance(data, dict) or 'exception' in data:
+            return True
+        return bool(data.get('instances'))
+
+    def _select_courses_to_refetch(self, client, since_by_course, max_workers):
+        """Filter ``{Moodle course id: since}`` down to the courses with activity since their watermark."""
+        changed = {}
+        fetch_stream = fetch_concurrently(
+            lambda course_moodle_id: self._course_has_grade_updates(client, course_moodle_id, since_by_course[course_moodle_id]),
+            list(since_by_course),
+            max_workers=max_workers)
+        for course_moodle_id, has_updates, error in fetch_stream:
+            if error or has_updates:
+                changed[course_moodle_id] = since_by_course[course_moodle_id]
+        return changed
+
+    def _filter_grade_items_since(self, usergrades, since_ts):
+        """Keep only grade items graded or submitted at or after ``since_ts``.
+
+        Items without any timestamp (course and category totals) are always
+        kept; the upsert drops them anyway when nothing changed.
+        """
+        if not since_ts:
+            return usergrades
+        for ug_item in usergrades:
+            kept_items = []
+            for grade_item in ug_item.get('gradeitems') or []:
+                touched_at = max(grade_item.get('gradedategraded') or 0, grade_item.get('gradedatesubmitted') or 0)
+                if not touched_at or touched_at >= since_ts:
+                    kept_items.append(grade_item)
+            ug_item['gradeitems'] = kept_items
+        return usergrades
+
+    def _sync_user_courses_and_grades(self, env, odoo_user_record, client):
+        course_id_map = self._get_course_id_map(env)
+        payload = self._fetch_user_courses_and_grades(client, odoo_user_record.moodle_id, dict.fromkeys(course_id_map))
+        return self._apply_user_courses_and_grades(env, odoo_user_record, payload, course_id_map)
+
+    def _fetch_user_courses_and_grades(self, client, user_moodle_id, since_by_course):
+        """Network-only stage of the grade sync.
+
+        Runs in the fetch thread pool: it must not touch ``env``.
+        Grades are only requested for the courses of ``since_by_course``
+        ({Moodle course id: watermark timestamp or None}), and items older
+        than the course watermark are dropped. Courses whose grades could not
+        be fetched are listed in ``failed_courses``.
+        """
         params_courses = {
-            'wstoken': token,
-            'wsfunction': 'core_enrol_get_users_courses',
-            'moodlewsrestformat': 'json',
             'userid': user_moodle_id
         }
         _logger.debug(f"Gọi API Moodle lấy DS khóa học cho User Moodle ID: {user_moodle_id}")
         try:
-            r_courses = requests.get(api_url, params=params_courses, timeout=30)
+            r_courses = client.request('core_enrol_get_users_courses', params_courses, timeout=30)
             r_courses.raise_for_status()
             courses_data_api = r_courses.json() or []
         except requests.RequestException as e_req_course:
             _logger.error(f"Lỗi API (core_enrol_get_users_courses) cho Moodle User ID {user_moodle_id}: {e_req_course}")
-            return {'error': f'Lỗi API lấy khóa học: {e_req_course}', 'courses_processed_count': 0, 'enrollments_created': 0, 'enrollments_updated': 0, 'grades_created': 0, 'grades_updated': 0}
+            return {'error': f'Lỗi API lấy khóa học: {e_req_course}'}
         except json.JSONDecodeError as e_json_course:
             _logger.error(f"Lỗi giải mã JSON (core_enrol_get_users_courses) cho Moodle User ID {user_moodle_id}. Phản hồi: {r_courses.text[:200]}")
-            return {'error': f'Lỗi JSON lấy khóa học: {e_json_course}', 'courses_processed_count': 0, 'enrollments_created': 0, 'enrollments_updated': 0, 'grades_created': 0, 'grades_updated': 0}
+            return {'error': f'Lỗi JSON lấy khóa học: {e_json_course}'}
 
-        _logger.info(f"API trả về {len(courses_data_api)} khóa học cho người dùng {odoo_user_record.name}.")
-        if not courses_data_api:
-            return {'message': 'Người dùng này không tham gia khóa học nào trên Moodle.', 'courses_processed_count': 0, 'enrollments_created': 0, 'enrollments_updated': 0, 'grades_created': 0, 'grades_updated': 0}
+        grades_by_course = {}
+        failed_courses = []
+        for c_moodle_data in courses_data_api:
+            api_course_id_for_grades = c_moodle_data.get('id')
+            if not api_course_id_for_grades or api_course_id_for_grades not in since_by_course:
+                continue
+
+            params_grades = {
+                'userid': user_moodle_id, 
+                'courseid': api_course_id_for_grades
+            }
+            _logger.debug(f"Gọi API Moodle lấy điểm cho User Moodle ID {user_moodle_id}, Course Moodle ID {api_course_id_for_grades}")
+            try:
+                r_grades = client.request('gradereport_user_get_grade_items', params_grades, timeout=30)
+                r_grades.raise_for_status()
+                grades_report_data = r_grades.json() or {}
+                if isinstance(grades_report_data, dict) and isinstance(grades_report_data.get('usergrades'), list):
+                    self._filter_grade_items_since(grades_report_data['usergrades'], since_by_course[api_course_id_for_grades])
+                grades_by_course[api_course_id_for_grades] = grades_report_data
+            except requests.RequestException as e_req_grade:
+                _logger.error(f"Lỗi API (gradereport_user_get_grade_items) cho User {user_moodle_id}, Course {api_course_id_for_grades}: {e_req_grade}")
+                failed_courses.append(api_course_id_for_grades)
+            except json.JSONDecodeError as e_json_grade:
+                _logger.error(f"Lỗi giải mã JSON (gradereport_user_get_grade_items) cho User {user_moodle_id}, Course {api_course_id_for_grades}. Phản hồi: {r_grades.text[:200]}")
+                failed_courses.append(api_course_id_for_grades)
 
-        UserCourseModel = request.env['moodle.user.course'].sudo()
-        GradeModel = request.env['moodle.user.grade'].sudo()
-        OdooCourseModel = request.env['moodle.course'].sudo()
+        return {'courses': courses_data_api, 'grades': grades_by_course, 'failed_courses': failed_courses}
 
-        user_courses_to_create_vals = []
-        user_courses_to_update_map = {}
-        processed_user_course_records_for_grades = [] # List of moodle.user.course records
+    def _apply_user_courses_and_grades(self, env, odoo_user_record, payload, course_id_map):
+        """ORM stage of the grade sync, always run on the request cursor.
 
-        num_enrollments_created = 0
-        num_enrollments_updated = 0
-        num_grades_created = 0
-        num_grades_updated = 0
+        Enrollments and grades are written with one ``bulk_upsert`` each.
+        Moodle ids of the courses that were not fully written are returned
+        in ``failed_course_ids`` so their grade watermark is not advanced.
+        """
+        user_moodle_id = odoo_user_record.moodle_id
+        odoo_user_id_int = odoo_user_record.id
+        _logger.info(f"Đang xử lý người dùng: {odoo_user_record.name} (Odoo ID: {odoo_user_id_int}, Moodle ID: {user_moodle_id})")
+
+        if payload.get('error'):
+            return {'error': payload['error'], 'courses_processed_count': 0, 'enrollments_created': 0, 'enrollments_updated': 0, 'grades_created': 0, 'grades_updated': 0, 'grades_unchanged': 0}
+
+        moodle_app_user, error_mu = self._get_or_create_moodle_app_user(env, odoo_user_record)
+        if error_mu:
+            return {'error': error_mu}
+
+        courses_data_api = payload['courses']
+        grades_by_course = payload['grades']
+        _logger.info(f"API trả về {len(courses_data_api)} khóa học cho người dùng {odoo_user_record.name}.")
+        if not courses_data_api:
+            return {'message': 'Người dùng này không tham gia khóa học nào trên Moodle.', 'courses_processed_count': 0, 'enrollments_created': 0, 'enrollments_updated': 0, 'grades_created': 0, 'grades_updated': 0, 'grades_unchanged': 0}
+
+        enrollment_rows = []
+        course_moodle_id_by_odoo_id = {}
 
         for c_moodle_data in courses_data_api:
             moodle_course_id_api = c_moodle_data.get('id')
@@ -216,141 +388,337 @@ class MoodleCourseGradeSyncController(http.Controller):
                 _logger.warning(f"Dữ liệu khóa học từ Moodle thiếu 'id' cho user {user_moodle_id}. Data: {c_moodle_data}")
                 continue
 
-            odoo_moodle_course = OdooCourseModel.search([('moodle_id', '=', moodle_course_id_api)], limit=1)
-            if not odoo_moodle_course:
+            odoo_course_id = course_id_map.get(moodle_course_id_api)
+            if not odoo_course_id:
                 _logger.warning(f"Không tìm thấy bản ghi moodle.course trong Odoo cho Moodle Course ID: {moodle_course_id_api}. Bỏ qua khóa học này cho người dùng {user_moodle_id}. Đồng bộ khóa học trước.")
                 continue 
+            course_moodle_id_by_odoo_id[odoo_course_id] = moodle_course_id_api
             
-            user_course_vals = {
-                'moodle_course_id': odoo_moodle_course.id, 
+            enrollment_rows.append({
+                'moodle_course_id': odoo_course_id, 
                 'moodle_user_id': moodle_app_user.id,
                 'course_name': c_moodle_data.get('fullname', 'Khóa học không tên từ API'),
                 'course_shortname': c_moodle_data.get('shortname', ''),
                 'enrol_date': datetime.fromtimestamp(c_moodle_data['enrolledcourses'][0]['timecreated']) if c_moodle_data.get('enrolledcourses') and c_moodle_data['enrolledcourses'] and c_moodle_data['enrolledcourses'][0].get('timecreated') else False,
                 'last_sync_date': datetime.now(),
-            }
-            
-            existing_user_course_record = UserCourseModel.search([
-                ('moodle_course_id', '=', odoo_moodle_course.id),
-                ('moodle_user_id', '=', moodle_app_user.id)
-            ], limit=1)
+            })
 
-            if not existing_user_course_record:
-                user_courses_to_create_vals.append(user_course_vals)
-            else:
-                user_courses_to_update_map[existing_user_course_record.id] = user_course_vals
-                processed_user_course_records_for_grades.append(existing_user_course_record)
-
-        if user_courses_to_create_vals:
-            try:
-                created_enrollments = UserCourseModel.create(user_courses_to_create_vals)
-                num_enrollments_created = len(created_enrollments)
-                _logger.debug(f"Batch created {num_enrollments_created} moodle.user.course records for user {odoo_user_record.name}.")
-                processed_user_course_records_for_grades.extend(created_enrollments)
-            except Exception as e_batch_create_uc:
-                _logger.error(f"Lỗi batch create moodle.user.course cho user {odoo_user_record.name}: {e_batch_create_uc}", exc_info=True)
-                # Fallback
-                for val_uc in user_courses_to_create_vals:
-                    try: 
-                        new_uc = UserCourseModel.create(val_uc)
-                        _logger.debug(f"Individually created moodle.user.course for user {odoo_user_record.name}, course {val_uc['course_name']}.")
-                        num_enrollments_created += 1
-                        processed_user_course_records_for_grades.append(new_uc)
-                    except Exception as e_single_uc:
-                         _logger.error(f"Lỗi tạo moodle.user.course cho user {odoo_user_record.name}, course {val_uc.get('course_name')}: {e_single_uc}")
-
-        for rec_id, update_vals in user_courses_to_update_map.items():
-            try:
-                UserCourseModel.browse(rec_id).write(update_vals)
-                num_enrollments_updated += 1
-                _logger.debug(f"Updated moodle.user.course ID {rec_id} for user {odoo_user_record.name}.")
-            except Exception as e_update_uc:
-                _logger.error(f"Lỗi cập nhật moodle.user.course ID {rec_id} cho user {odoo_user_record.name}: {e_update_uc}")
-
-        # Sync grades for processed user_course_records
-        grades_to_create_vals = []
-        grades_to_update_map = {}
-
-        for user_course_record in processed_user_course_records_for_grades:
-            # Ensure moodle_course_id on user_course_record.moodle_course_id is the odoo moodle.course record.
-            # And we need moodle_id from that odoo_moodle_course for the API call.
-            odoo_course_for_grade = user_course_record.moodle_course_id 
-            if not odoo_course_for_grade or not odoo_course_for_grade.moodle_id:
-                _logger.warning(f"Skipping grade sync for user_course {user_course_record.id} as linked odoo_moodle_course or its moodle_id is missing.")
-                continue
-            
-            api_course_id_for_grades = odoo_course_for_grade.moodle_id
-
-            params_grades = {
-                'wstoken': token,
-                'wsfunction': 'gradereport_user_get_grade_items',
-                'moodlewsrestformat': 'json',
-                'userid': user_moodle_id, 
-                'courseid': api_course_id_for_grades
-            }
-            _logger.debug(f"Gọi API Moodle lấy điểm cho User Moodle ID {user_moodle_id}, Course Moodle ID {api_course_id_for_grades}")
-            try:
-                r_grades = requests.get(api_url, params=params_grades, timeout=30)
-                r_grades.raise_for_status()
-                grades_report_data = r_grades.json() or {}
-            except requests.RequestException as e_req_grade:
-                _logger.error(f"Lỗi API (gradereport_user_get_grade_items) cho User {user_moodle_id}, Course {api_course_id_for_grades}: {e_req_grade}")
-                continue 
-            except json.JSONDecodeError as e_json_grade:
-                _logger.error(f"Lỗi giải mã JSON (gradereport_user_get_grade_items) cho User {user_moodle_id}, Course {api_course_id_for_grades}. Phản hồi: {r_grades.text[:200]}")
+        try:
+            enrollment_result = bulk_upsert(env, 'moodle.user.course', enrollment_rows, ENROLLMENT_KEY)
+        except Exception as e_upsert_uc:
+            _logger.error(f"Lỗi ghi moodle.user.course cho user {odoo_user_record.name}: {e_upsert_uc}", exc_info=True)
+            return {'error': f"Lỗi ghi moodle.user.course: {e_upsert_uc}"}
+        num_enrollments_created = enrollment_result['created']
+        num_enrollments_updated = enrollment_result['updated']
+        failed_course_ids = set(payload.get('failed_courses') or [])
+        failed_course_ids.update(course_moodle_id_by_odoo_id[odoo_course_id] for odoo_course_id, _mu in enrollment_result['failed'])
+        odoo_course_id_by_user_course = {user_course_id: odoo_course_id for (odoo_course_id, _mu), user_course_id in enrollment_result['ids'].items()}
+
+        # Sync grades for the upserted enrollments
+        grade_rows = []
+        for (odoo_course_id, _moodle_app_user_id), user_course_id in enrollment_result['ids'].items():
+            # moodle_course_id trên moodle.user.course lưu ID moodle.course của Odoo
+            api_course_id_for_grades = course_moodle_id_by_odoo_id.get(odoo_course_id)
+            if api_course_id_for_grades not in grades_by_course:
+                # Lỗi API đã được ghi log ở bước tải dữ liệu
                 continue
+            grades_report_data = grades_by_course[api_course_id_for_grades]
 
             if 'usergrades' in grades_report_data and isinstance(grades_report_data['usergrades'], list):
                 for ug_item in grades_report_data['usergrades']:
                     if 'gradeitems' in ug_item and isinstance(ug_item['gradeitems'], list):
                         for grade_item_api_data in ug_item['gradeitems']:
-                            processed_grade_info = self._prepare_grade_vals(grade_item_api_data, moodle_app_user.id, user_course_record.id)
+                            processed_grade_info = self._prepare_grade_vals(grade_item_api_data, moodle_app_user.id, user_course_id)
                             if processed_grade_info:
-                                grade_vals_for_db = processed_grade_info['data']
-                                existing_grade_rec = GradeModel.search([
-                                    ('moodle_user_id', '=', moodle_app_user.id),
-                                    ('moodle_course_id', '=', user_course_record.id),
-                                    ('moodle_item_id', '=', grade_vals_for_db['moodle_item_id'])
-                                ], limit=1)
-                                if existing_grade_rec:
-                                    grades_to_update_map[existing_grade_rec.id] = grade_vals_for_db
-                                else:
-                                    grades_to_create_vals.append(grade_vals_for_db)
+                                grade_rows.append(processed_grade_info['data'])
             else:
                 _logger.info(f"Không có 'usergrades' trong phản hồi điểm cho user {user_moodle_id}, course {api_course_id_for_grades}. Phản hồi: {grades_report_data}")
 
-        if grades_to_create_vals:
-            try:
-                created_grades = GradeModel.create(grades_to_create_vals)
-                num_grades_created = len(created_grades)
-                _logger.debug(f"Batch created {num_grades_created} moodle.user.grade records for user {odoo_user_record.name}.")
-            except Exception as e_batch_create_g:
-                _logger.error(f"Lỗi batch create moodle.user.grade cho user {odoo_user_record.name}: {e_batch_create_g}", exc_info=True)
-                for val_g in grades_to_create_vals:
-                    try: 
-                        GradeModel.create(val_g)
-                        _logger.debug(f"Individually created grade for item {val_g['item_name']} user {odoo_user_record.name}.")
-                        num_grades_created+=1
-                    except Exception as e_single_g:
-                         _logger.error(f"Lỗi tạo grade cho item {val_g.get('item_name')} user {odoo_user_record.name}: {e_single_g}")
-
-        for rec_id, update_vals in grades_to_update_map.items():
-            try:
-                GradeModel.browse(rec_id).write(update_vals)
-                num_grades_updated += 1
-                _logger.debug(f"Updated moodle.user.grade ID {rec_id} for user {odoo_user_record.name}.")
-            except Exception as e_update_g:
-                _logger.error(f"Lỗi cập nhật moodle.user.grade ID {rec_id} cho user {odoo_user_record.name}: {e_update_g}")
+        num_grades_created = 0
+        num_grades_updated = 0
+        num_grades_unchanged = 0
+        try:
+            grade_result = bulk_upsert(env, 'moodle.user.grade', grade_rows, GRADE_KEY)
+            num_grades_created = grade_result['created']
+            num_grades_updated = grade_result['updated']
+            num_grades_unchanged = grade_result['unchanged']
+            failed_course_ids.update(
+                course_moodle_id_by_odoo_id[odoo_course_id_by_user_course[user_course_id]]
+                for _mu, user_course_id, _item in grade_result['failed'])
+        except Exception as e_upsert_g:
+            _logger.error(f"Lỗi ghi moodle.user.grade cho user {odoo_user_record.name}: {e_upsert_g}", exc_info=True)
+            failed_course_ids.update(course_moodle_id_by_odoo_id[odoo_course_id_by_user_course[row['moodle_course_id']]] for row in grade_rows)
         
-        _logger.info(f"Hoàn tất xử lý khóa học và điểm cho User {odoo_user_record.name}. Ghi danh mới: {num_enrollments_created}, cập nhật: {num_enrollments_updated}. Điểm mới: {num_grades_created}, cập nhật: {num_grades_updated}.")
+        _logger.info(f"Hoàn tất xử lý khóa học và điểm cho User {odoo_user_record.name}. Ghi danh mới: {num_enrollments_created}, cập nhật: {num_enrollments_updated}. Điểm mới: {num_grades_created}, cập nhật: {num_grades_updated}, không đổi: {num_grades_unchanged}.")
         return {
             'courses_processed_count': len(courses_data_api),
             'enrollments_created': num_enrollments_created,
             'enrollments_updated': num_enrollments_updated,
             'grades_created': num_grades_created,
-            'grades_updated': num_grades_updated
+            'grades_updated': num_grades_updated,
+            'grades_unchanged': num_grades_unchanged,
+            'failed_course_ids': sorted(failed_course_ids),
         }
 
+    def _sync_all_by_course(self, env, client, max_workers, incremental=False, run_started_at=None, progress=None, cursor=None):
+        """Course-centric variant of sync_all: O(courses) grade report calls.
+
+        In incremental mode only courses with activity since their
+        grades_synced_until watermark are downloaded.
+        """
+        config = env['ir.config_parameter'].sudo()
+        cursor = cursor or SyncCursor()
+        courses = env['moodle.course'].sudo().search([('moodle_id', '!=', False), ('active', '=', True)])
+        courses = cursor.pending(courses)
+        if not courses:
+            _logger.info("Không có khóa học nào có Moodle ID để đồng bộ điểm.")
+            return {'message': 'Không có khóa học nào có Moodle ID hợp lệ để đồng bộ.'}, 200
+
+        _logger.info(f"Bắt đầu đồng bộ điểm theo khóa học cho {len(courses)} khóa học ({max_workers} luồng tải song song).")
+        run_started_at = run_started_at or fields.Datetime.now()
+        courses_by_moodle_id = {c.moodle_id: c for c in courses}
+        results = {}
+        totals = {'courses_processed_count': 0, 'enrollments_created': 0, 'enrollments_updated': 0, 'grades_created': 0, 'grades_updated': 0, 'grades_unchanged': 0}
+
+        since_by_course = dict.fromkeys(courses_by_moodle_id)
+        if incremental:
+            since_by_course = self._select_courses_to_refetch(client, self._get_grade_watermarks(courses), max_workers)
+            _logger.info(f"Đồng bộ tăng dần: tải lại điểm của {len(since_by_course)}/{len(courses)} khóa học có thay đổi.")
+        # Khóa học không có thay đổi cũng được đẩy mốc lên
+        synced_course_moodle_ids = [cid for cid in courses_by_moodle_id if cid not in since_by_course]
+
+        fetch_course = lambda course_moodle_id: self._fetch_course_grades(client, course_moodle_id, deadline=cursor.deadline)
+        fetch_stream = (
+            fetched
+            for chunk in cursor.chunks(courses.filtered(lambda c: c.moodle_id in since_by_course))
+            for fetched in fetch_concurrently(fetch_course, chunk.mapped('moodle_id'), max_workers=max_workers)
+        )
+
+        for course_index, (course_moodle_id, payload, fetch_error) in enumerate(fetch_stream):
+            if progress:
+                progress(course_index, len(since_by_course))
+            odoo_course = courses_by_moodle_id[course_moodle_id]
+            try:
+                if fetch_error:
+                    raise fetch_error
+                if payload.get('error'):
+                    results[odoo_course.id] = {'error': payload['error']}
+                    continue
+                course_errors = []
+                if payload.get('fallback'):
+                    _logger.warning(f"Không tải được báo cáo điểm toàn khóa {odoo_course.name} (Moodle ID: {course_moodle_id}), chuyển sang tải theo từng nhóm {GRADE_USER_CHUNK_SIZE} học viên.")
+                    usergrades_chunks = self._iter_course_grades_by_user(client, course_moodle_id, max_workers, course_errors)
+                else:
+                    usergrades_chunks = [payload['usergrades']]
+
+                course_result = dict.fromkeys(totals, 0)
+                for usergrades in usergrades_chunks:
+                    usergrades = self._filter_grade_items_since(usergrades, since_by_course[course_moodle_id])
+                    chunk_result = self._apply_course_grades(env, odoo_course, usergrades)
+                    for key in course_result:
+                        course_result[key] += chunk_result.get(key, 0)
+                    if chunk_result.get('error'):
+                        course_errors.append(chunk_result['error'])
+                course_result['courses_processed_count'] = 1
+                for key in totals:
+                    totals[key] += course_result[key]
+                if course_errors:
+                    # Phần đã ghi được giữ lại, nhưng mốc của khóa học không được đẩy lên
+                    course_result['error'] = '; '.join(course_errors[:5]) + (f" (+{len(course_errors) - 5} lỗi khác)" if len(course_errors) > 5 else '')
+                else:
+                    synced_course_moodle_ids.append(course_moodle_id)
+                results[odoo_course.id] = course_result
+            except Exception as e:
+                error_msg = f"Lỗi nghiêm trọng khi đồng bộ điểm cho khóa học {odoo_course.name} (Moodle ID: {course_moodle_id}): {e}"
+                _logger.error(error_msg, exc_info=True)
+                results[odoo_course.id] = {'error': error_msg}
+
+        if cursor.interrupted:
+            # Khóa học đã xong vẫn được đẩy mốc, phần còn lại chạy ở lượt sau
+            self._advance_grade_watermarks(env, synced_course_moodle_ids, run_started_at)
+            _logger.info(f"Dừng đồng bộ điểm theo khóa học do hết thời gian, sẽ tiếp tục sau khóa học ID {cursor.resume_after}.")
+            return {'message': f"Đã đồng bộ {totals['courses_processed_count']} khóa học, phần còn lại chạy ở lượt sau.", 'details_per_course': results, **cursor.summary()}, 200
+
+        final_summary_message = (
+            f"Hoàn tất đồng bộ điểm theo khóa học. "
+            f"Tổng khóa học đã xử lý: {totals['courses_processed_count']}. "
+            f"Tổng ghi danh tạo mới: {totals['enrollments_created']}, cập nhật: {totals['enrollments_updated']}. "
+            f"Tổng điểm tạo mới: {totals['grades_created']}, cập nhật: {totals['grades_updated']}, không đổi: {totals['grades_unchanged']}. "
+            f"Khóa học bỏ qua do không thay đổi: {len(courses) - len(since_by_course)}."
+        )
+        _logger.info(final_summary_message)
+        config.set_param('digi_moodle_sync.last_grades_sync_date', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+        self._advance_grade_watermarks(env, synced_course_moodle_ids, run_started_at)
+
+        return {'message': final_summary_message, 'details_per_course': results}, 200
+
+    def _fetch_course_grades(self, client, course_moodle_id, deadline=None):
+        """Fetch every user's grade items of a course in one call (fetch thread, no ORM).
+
+        Transport failures (timeouts, HTTP 5xx) usually mean the course is too
+        big for one report, so the caller falls back to per-user chunks. The
+        call is therefore not retried, and its timeout never exceeds what is
+        left of the run's ``deadline`` (a ``time.monotonic()`` value).
+        """
+        timeout = COURSE_GRADES_TIMEOUT
+        if deadline is not None:
+            timeout = max(min(timeout, deadline - time.monotonic()), COURSE_GRADES_MIN_TIMEOUT)
+        try:
+            r_grades = client.request('gradereport_user_get_grade_items', {'courseid': course_moodle_id},
+                                      timeout=timeout, max_retries=0)
+            r_grades.raise_for_status()
+            grades_report_data = r_grades.json() or {}
+        except (requests.RequestException, json.JSONDecodeError) as e_grade:
+            _logger.warning(f"Lỗi API (gradereport_user_get_grade_items) cho Course {course_moodle_id}: {e_grade}")
+            return {'fallback': True}
+
+        if isinstance(grades_report_data, dict) and 'exception' in grades_report_data:
+            error_msg = f"Moodle API error: {grades_report_data.get('message', 'Unknown error')} - Code: {grades_report_data.get('errorcode', 'Unknown')}"
+            _logger.error(f"{error_msg} (gradereport_user_get_grade_items, Course {course_moodle_id})")
+            return {'error': error_msg}
+        return {'usergrades': grades_report_data.get('usergrades') or []}
+
+    def _iter_course_grades_by_user(self, client, course_moodle_id, max_workers, errors):
+        """Yield ``usergrades`` lists of a large course, GRADE_USER_CHUNK_SIZE users at a time.
+
+        gradereport_user_get_grade_items only filters on a single userid, so
+        each chunk is a batch of per-user calls run through the fetch pool.
+        Failed calls are appended to ``errors`` instead of stopping the course.
+        """
+        params_enrolled = {
+            'courseid': course_moodle_id,
+            'options[0][name]': 'userfields',
+            'options[0][value]': 'id',
+        }
+        try:
+            enrolled_users_data = client.call('core_enrol_get_enrolled_users', params_enrolled, timeout=60)
+        except (requests.RequestException, ValueError) as e_users:
+            _logger.error(f"Lỗi API (core_enrol_get_enrolled_users) cho Course {course_moodle_id}: {e_users}")
+            errors.append(f"Lỗi API lấy danh sách học viên: {e_users}")
+            return
+        if not isinstance(enrolled_users_data, list):
+            _logger.error(f"Phản hồi không hợp lệ (core_enrol_get_enrolled_users) cho Course {course_moodle_id}: {enrolled_users_data}")
+            errors.append(f"Phản hồi không hợp lệ khi lấy danh sách học viên: {enrolled_users_data}")
+            return
+
+        user_moodle_ids = [u['id'] for u in enrolled_users_data if u.get('id')]
+        fetch_one = lambda user_moodle_id: client.call(
+            'gradereport_user_get_grade_items', {'courseid': course_moodle_id, 'userid': user_moodle_id}, timeout=30)
+        for start in range(0, len(user_moodle_ids), GRADE_USER_CHUNK_SIZE):
+            usergrades = []
+            chunk = user_moodle_ids[start:start + GRADE_USER_CHUNK_SIZE]
+            for user_moodle_id, data, error in fetch_concurrently(fetch_one, chunk, max_workers=max_workers):
+                if error or not isinstance(data, dict) or 'exception' in data:
+                    _logger.error(f"Lỗi API (gradereport_user_get_grade_items) cho User {user_moodle_id}, Course {course_moodle_id}: {error or data}")
+                    errors.append(f"Lỗi API lấy điểm của học viên {user_moodle_id}: {error or data}")
+                    continue
+                usergrades.extend(data.get('usergrades') or [])
+            yield usergrades
+
+    def _apply_course_grades(self, env, odoo_course, usergrades):
+        """Fan a course grade report out to moodle.user.course / moodle.user.grade.
+
+        Users of the chunk are prefetched in two queries; enrollments and
+        grades are then written with one ``bulk_upsert`` each. Rows that
+        could not be written are reported in ``error``.
+        """
+        ResUsers = env['res.users'].sudo()
+        MoodleAppUser = env['moodle.user'].sudo()
+
+        user_moodle_ids = [ug.get('userid') for ug in usergrades if ug.get('userid')]
+        odoo_users_by_moodle_id = {u.moodle_id: u for u in ResUsers.search([('moodle_id', 'in', user_moodle_ids)])}
+        moodle_app_users_by_moodle_id = {mu.moodle_id: mu for mu in MoodleAppUser.search([('moodle_id', 'in', user_moodle_ids)])}
+
+        enrollment_rows = []
+        gradeitems_by_moodle_app_user = {}
+        sync_date = datetime.now()
+
+        for ug_item in usergrades:
+            user_moodle_id = ug_item.get('userid')
+            odoo_user = odoo_users_by_moodle_id.get(user_moodle_id)
+            if not odoo_user:
+                _logger.debug(f"Không có res.users với Moodle ID {user_moodle_id} cho khóa học {odoo_course.name}. Bỏ qua.")
+                continue
+            moodle_app_user = moodle_app_users_by_moodle_id.get(user_moodle_id)
+            if not moodle_app_user or moodle_app_user.odoo_user_id.id != odoo_user.id:
+                moodle_app_user, error_mu = self._get_or_create_moodle_app_user(env, odoo_user)
+                if error_mu:
+                    continue
+
+            enrollment_rows.append({
+                'moodle_course_id': odoo_course.id,
+                'moodle_user_id': moodle_app_user.id,
+                'course_name': odoo_course.name,
+                'course_shortname': odoo_course.shortname,
+                'last_sync_date': sync_date,
+            })
+            gradeitems_by_moodle_app_user[moodle_app_user.id] = ug_item.get('gradeitems') or []
+
+        try:
+            enrollment_result = bulk_upsert(env, 'moodle.user.course', enrollment_rows, ENROLLMENT_KEY)
+        except Exception as e_upsert_uc:
+            _logger.error(f"Lỗi ghi moodle.user.course cho khóa học {odoo_course.name}: {e_upsert_uc}", exc_info=True)
+            return {'error': f"Lỗi ghi moodle.user.course: {e_upsert_uc}", 'enrollments_created': 0, 'enrollments_updated': 0, 'grades_created': 0, 'grades_updated': 0, 'grades_unchanged': 0}
+
+        grade_rows = []
+        for (_odoo_course_id, moodle_app_user_id), user_course_id in enrollment_result['ids'].items():
+            for grade_item_api_data in gradeitems_by_moodle_app_user.get(moodle_app_user_id, []):
+                processed_grade_info = self._prepare_grade_vals(grade_item_api_data, moodle_app_user_id, user_course_id)
+                if processed_grade_info:
+                    grade_rows.append(processed_grade_info['data'])
+
+        grade_result = {'created': 0, 'updated': 0, 'unchanged': 0, 'failed': {}}
+        error = None
+        try:
+            grade_result = bulk_upsert(env, 'moodle.user.grade', grade_rows, GRADE_KEY)
+        except Exception as e_upsert_g:
+            _logger.error(f"Lỗi ghi moodle.user.grade cho khóa học {odoo_course.name}: {e_upsert_g}", exc_info=True)
+            error = f"Lỗi ghi moodle.user.grade: {e_upsert_g}"
+        failed_rows = len(enrollment_result['failed']) + len(grade_result['failed'])
+        if failed_rows and not error:
+            error = f"{failed_rows} dòng ghi danh/điểm không ghi được"
+
+        result = {
+            'enrollments_created': enrollment_result['created'],
+            'enrollments_updated': enrollment_result['updated'],
+            'grades_created': grade_result['created'],
+            'grades_updated': grade_result['updated'],
+            'grades_unchanged': grade_result['unchanged']
+        }
+        if error:
+            result['error'] = error
+        return result
+
+    def _get_or_create_moodle_app_user(self, env, odoo_user_record):
+        """Return ``(moodle.user, error)`` linked to the given res.users."""
+        user_moodle_id = odoo_user_record.moodle_id
+        odoo_user_id_int = odoo_user_record.id
+        MoodleAppUser = env['moodle.user'].sudo()
+        moodle_app_user = MoodleAppUser.search([('moodle_id', '=', user_moodle_id)], limit=1)
+        if not moodle_app_user:
+            moodle_app_user_vals = {
+                'name': odoo_user_record.name,
+                'login': odoo_user_record.login or f'user_{user_moodle_id}@placeholder.com',
+                'email': odoo_user_record.email or f'user_{user_moodle_id}@placeholder.com',
+                'moodle_id': user_moodle_id,
+                'odoo_user_id': odoo_user_id_int,
+                'last_sync_date': datetime.now(),
+            }
+            try:
+                moodle_app_user = MoodleAppUser.create(moodle_app_user_vals)
+                _logger.debug(f"Đã tạo moodle.user (ID: {moodle_app_user.id}) cho Moodle ID {user_moodle_id}.")
+            except Exception as e_create_mu:
+                _logger.error(f"Không thể tạo moodle.user cho {odoo_user_record.name} (Moodle ID {user_moodle_id}). Lỗi: {e_create_mu}")
+                return MoodleAppUser, f"Không thể tạo moodle.user: {e_create_mu}"
+        elif not moodle_app_user.odoo_user_id or moodle_app_user.odoo_user_id.id != odoo_user_id_int:
+            try:
+                moodle_app_user.write({'odoo_user_id': odoo_user_id_int, 'last_sync_date': datetime.now()})
+                _logger.debug(f"Cập nhật odoo_user_id trên moodle.user (ID: {moodle_app_user.id}) thành {odoo_user_id_int}.")
+            except Exception as e_write_mu:
+                 _logger.error(f"Không thể cập nhật odoo_user_id trên moodle.user cho {odoo_user_record.name}. Lỗi: {e_write_mu}")
+                 # Continue with existing moodle_app_user if link update fails
+        return moodle_app_user, None
+
     def _prepare_grade_vals(self, grade_item_api_data, moodle_app_user_pk, user_course_pk):
         moodle_grade_item_id = grade_item_api_data.get('id')
         if not moodle_grade_item_id:
@@ -4,6 +4,7 @@ from odoo import http
 from odoo.http import request
 import logging
 import json
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
 
 _logger = logging.getLogger(__name__)
 
@@ -13,7 +14,8 @@ class MoodleDebugController(http.Controller):
         params = request.env['ir.config_parameter'].sudo()
         return {
             'token': params.get_param('digi_moodle_sync.token'),
-            'url': params.get_param('digi_moodle_sync.moodle_url')
+            'url': params.get_param('digi_moodle_sync.moodle_url'),
+            'client': MoodleClient.from_env(request.env),
         }
 
     @http.route('/moodle/debug/test-connection', type='http', auth='user')
@@ -24,14 +26,8 @@ class MoodleDebugController(http.Controller):
             return 'Moodle configuration is missing'
 
         # Test basic connection
-        params = {
-            'wstoken': config['token'],
-            'wsfunction': 'core_webservice_get_site_info',
-            'moodlewsrestformat': 'json'
-        }
-
         try:
-            response = requests.get(config['url'] + '/webservice/rest/server.php', params=params)
+            response = config['client'].request('core_webservice_get_site_info')
             response.raise_for_status()
             data = response.json()
             
@@ -51,14 +47,8 @@ class MoodleDebugController(http.Controller):
             return 'Moodle configuration is missing'
 
         # Get available functions
-        params = {
-            'wstoken': config['token'],
-            'wsfunction': 'core_webservice_get_site_info',
-            'moodlewsrestformat': 'json'
-        }
-
         try:
-            response = requests.get(config['url'] + '/webservice/rest/server.php', params=params)
+            response = config['client'].request('core_webservice_get_site_info')
             response.raise_for_status()
             data = response.json()
             
@@ -100,14 +90,11 @@ class MoodleDebugController(http.Controller):
         _logger.info(f"Testing assignments for course: {course.name} (ID: {course.moodle_id})")
         
         params = {
-            'wstoken': config['token'],
-            'wsfunction': 'mod_assign_get_assignments',
             'courseids[]': course.moodle_id,
-            'moodlewsrestformat': 'json'
         }
 
         try:
-            response = requests.get(config['url'] + '/webservice/rest/server.php', params=params)
+            response = config['client'].request('mod_assign_get_assignments', params)
             _logger.info(f"Response status: {response.status_code}")
             _logger.info(f"Response headers: {dict(response.headers)}")
             
@@ -153,15 +140,12 @@ class MoodleDebugController(http.Controller):
             return 'No courses or users found for testing'
 
         params = {
-            'wstoken': config['token'],
-            'wsfunction': 'core_completion_get_activities_completion_status',
             'courseid': course.moodle_id,
             'userid': user.moodle_id,
-            'moodlewsrestformat': 'json'
         }
 
         try:
-            response = requests.get(config['url'] + '/webservice/rest/server.php', params=params)
+            response = config['client'].request('core_completion_get_activities_completion_status', params)
             response.raise_for_status()
             data = response.json()
             
@@ -192,15 +176,12 @@ class MoodleDebugController(http.Controller):
             return 'No courses found'
 
         params = {
-            'wstoken': config['token'],
-            'wsfunction': 'core_course_get_courses_by_field',
             'field': 'id',
             'value': course.moodle_id,
-            'moodlewsrestformat': 'json'
         }
 
         try:
-            response = requests.get(config['url'] + '/webservice/rest/server.php', params=params)
+            response = config['client'].request('core_course_get_courses_by_field', params)
             response.raise_for_status()
             data = response.json()
             
@@ -5,6 +5,12 @@ import logging
 from datetime import datetime
 from odoo.exceptions import AccessError
 import json
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
+from odoo.addons.digi_moodle_sync.controllers.sync_jobs import run_or_enqueue
+from odoo.addons.digi_moodle_sync.tools.bulk import bulk_upsert
+from odoo.addons.digi_moodle_sync.tools.sync_cursor import SyncCursor
+from odoo.addons.digi_moodle_sync.tools.fetch_pool import fetch_concurrently, get_fetch_concurrency
+from odoo.addons.digi_moodle_sync.tools.roster_cache import get_course_roster
 
 _logger = logging.getLogger(__name__)
 
@@ -19,9 +25,9 @@ class MoodleProgressSync(http.Controller):
             )
             raise AccessError("Bạn không có quyền thực hiện hành động này. Vui lòng liên hệ quản trị viên.")
 
-    def _get_moodle_config(self):
+    def _get_moodle_config(self, env):
         """Get Moodle configuration with correct parameter names"""
-        params = request.env['ir.config_parameter'].sudo()
+        params = env['ir.config_parameter'].sudo()
         
         # Get parameters with correct names from your system
         token = params.get_param('digi_moodle_sync.token')
@@ -38,7 +44,7 @@ class MoodleProgressSync(http.Controller):
         return {
             'token': token,
             'url': url, # Base URL
-            'api_url': api_url # Full API URL
+            'api_url': api_url, # Full API URL
         }
 
     @http.route('/moodle/sync/progress', type='http', auth='user', csrf=False, methods=['GET'])
@@ -54,170 +60,132 @@ class MoodleProgressSync(http.Controller):
                 status=403, 
                 headers=[('Content-Type', 'application/json')])
 
-        config = self._get_moodle_config()
+        return run_or_enqueue('progress', lambda env: self._sync_progress(env, **kwargs), kwargs)
+
+    def _sync_progress(self, env, progress=None, cursor=None, **kwargs):
+        """Run the sync on ``env``; returns ``(payload, http_status)``.
+
+        ``cursor`` (a SyncCursor) time-boxes the course loop and resumes it.
+        """
+        cursor = cursor or SyncCursor()
+        config = self._get_moodle_config(env)
         if not config['token'] or not config['api_url']: # Check api_url
             _logger.error("Moodle configuration is missing - Token or URL not found")
-            return request.make_response(json.dumps({'error': 'Moodle configuration is missing - check digi_moodle_sync.token and digi_moodle_sync.moodle_url parameters'}), status=503, headers=[('Content-Type', 'application/json')])
+            return {'error': 'Moodle configuration is missing - check digi_moodle_sync.token and digi_moodle_sync.moodle_url parameters'}, 503
 
         _logger.info("Starting progress synchronization...")
 
-        courses = request.env['moodle.course'].search([('active', '=', True)])
+        courses = env['moodle.course'].search([('active', '=', True)])
         if not courses:
             _logger.warning("No active courses found in Odoo to sync progress for.")
-            return request.make_response(json.dumps({'error': 'No active courses found in Odoo database'}), status=503, headers=[('Content-Type', 'application/json')])
+            return {'error': 'No active courses found in Odoo database'}, 503
 
+        courses = cursor.pending(courses)
         _logger.info(f"Found {len(courses)} active courses to sync progress for.")
         total_progress_records_synced = 0
+        total_progress_records_unchanged = 0
         
-        ResUsers = request.env['res.users'].sudo()
-        ActivityProgress = request.env['moodle.activity.progress'].sudo()
+        ResUsers = env['res.users'].sudo()
+        max_workers = get_fetch_concurrency(env)
+        client = MoodleClient.from_env(env, min_pool_size=max_workers)
 
-        for course in courses:
+        for course_index, course in enumerate(cursor.iterate(courses)):
+            if progress:
+                progress(course_index, len(courses))
             _logger.info(f"Syncing progress for course: {course.name} (Moodle ID: {course.moodle_id})")
             
-            # 1. Get enrolled users for this course
-            params_enrolled_users = {
-                'wstoken': config['token'],
-                'wsfunction': 'core_enrol_get_enrolled_users',
-                'courseid': course.moodle_id,
-                'moodlewsrestformat': 'json'
-            }
-            enrolled_moodle_user_ids = []
-            try:
-                resp_users = requests.get(config['api_url'], params=params_enrolled_users, timeout=30)
-                resp_users.raise_for_status()
-                enrolled_users_data = resp_users.json()
-                if isinstance(enrolled_users_data, list):
-                    enrolled_moodle_user_ids = [u['id'] for u in enrolled_users_data if 'id' in u]
-                elif isinstance(enrolled_users_data, dict) and 'exception' in enrolled_users_data:
-                     _logger.error(f"Moodle API error when fetching enrolled users for course {course.name} (ID: {course.moodle_id}): {enrolled_users_data.get('message', 'Unknown error')} - Code: {enrolled_users_data.get('errorcode', 'Unknown')}")
-                     continue # Skip to next course
-                else:
-                    _logger.warning(f"Unexpected data format for enrolled users of course {course.name}: {enrolled_users_data}")
-                    continue
-
-
-            except requests.exceptions.RequestException as e_users:
-                _logger.error(f"API error fetching enrolled users for course {course.name} (ID: {course.moodle_id}): {e_users}")
-                continue # Skip to next course
-            
+            # 1. Get enrolled users for this course (roster shared with the wizard)
+            enrolled_moodle_user_ids = self._fetch_enrolled_user_ids(env, client, course)
             if not enrolled_moodle_user_ids:
-                _logger.info(f"No enrolled users found in Moodle for course: {course.name}")
                 continue
 
             # Find corresponding Odoo users
-            odoo_users_for_course = ResUsers.search([('moodle_id', 'in', enrolled_moodle_user_ids)])
-            if not odoo_users_for_course:
+            odoo_users_by_moodle_id = {u.moodle_id: u for u in ResUsers.search([('moodle_id', 'in', enrolled_moodle_user_ids)])}
+            if not odoo_users_by_moodle_id:
                 _logger.info(f"No Odoo users with Moodle IDs {enrolled_moodle_user_ids} found for course: {course.name}")
                 continue
             
-            _logger.info(f"Found {len(odoo_users_for_course)} Odoo users enrolled in course {course.name} to sync progress for.")
+            _logger.info(f"Found {len(odoo_users_by_moodle_id)} Odoo users enrolled in course {course.name} to sync progress for.")
 
             course_progress_synced_count = 0
-            activities_to_create_vals = []
-            activities_to_update = {} # {progress_id: vals}
+            progress_rows = []
+
+            # 2. Moodle has no course-wide completion report in the webservice API,
+            # so the per-user calls run in parallel; ORM work stays on this thread
+            course_moodle_id = course.moodle_id
+            fetch_stream = fetch_concurrently(
+                lambda user_moodle_id: self._fetch_completion_statuses(client, course_moodle_id, user_moodle_id),
+                list(odoo_users_by_moodle_id),
+                max_workers=max_workers)
+
+            for user_moodle_id, data, fetch_error in fetch_stream:
+                odoo_user = odoo_users_by_moodle_id[user_moodle_id]
+                if fetch_error:
+                    _logger.error(f"API error syncing progress for user {odoo_user.name} in course {course.name}: {fetch_error}")
+                    continue # Skip to next user in this course
 
-            for odoo_user in odoo_users_for_course:
-                if not odoo_user.moodle_id: # Should not happen due to search domain
+                if isinstance(data, dict) and 'exception' in data:
+                    error_code = data.get('errorcode', 'Unknown')
+                    error_message = data.get('message', 'Unknown error')
+                    if error_code in ['completionnotenabled', 'nocompletionenabled']:
+                        _logger.warning(f"Completion not enabled for course {course.name}. Skipping progress sync for this course.")
+                        break # Break from user loop, go to next course
+                    _logger.error(f"Moodle API error for user {odoo_user.name} in course {course.name}: {error_message} - Code: {error_code}")
+                    continue # Skip to next user
+
+                if not isinstance(data, dict) or not isinstance(data.get('statuses'), list):
+                    _logger.warning(f"No completion statuses or invalid format for user {odoo_user.name} in course {course.name}. Response: {data}")
                     continue
 
-                params_activity_status = {
-                    'wstoken': config['token'],
-                    'wsfunction': 'core_completion_get_activities_completion_status',
-                    'courseid': course.moodle_id,
-                    'userid': odoo_user.moodle_id,
-                    'moodlewsrestformat': 'json'
-                }
-
-                try:
-                    response = requests.get(config['api_url'], params=params_activity_status, timeout=30)
-                    response.raise_for_status()
-                    data = response.json()
-
-                    if isinstance(data, dict) and 'exception' in data:
-                        error_code = data.get('errorcode', 'Unknown')
-                        error_message = data.get('message', 'Unknown error')
-                        if error_code in ['completionnotenabled', 'nocompletionenabled']:
-                            _logger.warning(f"Completion not enabled for course {course.name}. Skipping progress sync for this course.")
-                            break # Break from user loop, go to next course
-                        else:
-                            _logger.error(f"Moodle API error for user {odoo_user.name} in course {course.name}: {error_message} - Code: {error_code}")
-                            continue # Skip to next user
-
-                    if 'statuses' not in data or not isinstance(data['statuses'], list):
-                        _logger.warning(f"No completion statuses or invalid format for user {odoo_user.name} in course {course.name}. Response: {data}")
+                for activity in data['statuses']:
+                    cmid = activity.get('cmid')
+                    if not cmid:
+                        _logger.warning(f"Activity for user {odoo_user.name}, course {course.name} missing cmid. Data: {activity}")
                         continue
 
-                    for activity in data['statuses']:
-                        cmid = activity.get('cmid')
-                        if not cmid:
-                            _logger.warning(f"Activity for user {odoo_user.name}, course {course.name} missing cmid. Data: {activity}")
-                            continue
-                        
-                        vals = {
-                            'userid': odoo_user.id,
-                            'courseid': course.id,
-                            'cmid': cmid,
-                            'activity_name': activity.get('activityname', ''), # Moodle might not always send this
-                            'completionstate': str(activity['state']), # API doc says 'state' not 'completionstate'
-                            'timemodified': datetime.fromtimestamp(activity['timemodified']) if activity.get('timemodified') else False,
-                            'last_sync_date': datetime.now(),
-                        }
-                        
-                        existing_progress = ActivityProgress.search([
-                            ('userid', '=', odoo_user.id),
-                            ('courseid', '=', course.id),
-                            ('cmid', '=', cmid)
-                        ], limit=1)
-
-                        if existing_progress:
-                            activities_to_update[existing_progress.id] = vals
-                        else:
-                            activities_to_create_vals.append(vals)
-                        
-                except requests.exceptions.RequestException as e:
-                    _logger.error(f"API error syncing progress for user {odoo_user.name} in course {course.name}: {e}")
-                    continue # Skip to next user in this course
-                except Exception as e_inner:
-                    _logger.error(f"Unexpected error processing progress for user {odoo_user.name} in course {course.name}: {e_inner}", exc_info=True)
-                    continue
+                    progress_rows.append({
+                        'userid': odoo_user.id,
+                        'courseid': course.id,
+                        'cmid': cmid,
+                        'activity_name': activity.get('activityname', ''), # Moodle might not always send this
+                        'completionstate': str(activity['state']), # API doc says 'state' not 'completionstate'
+                        'timemodified': datetime.fromtimestamp(activity['timemodified']) if activity.get('timemodified') else False,
+                        'last_sync_date': datetime.now(),
+                    })
             
-            # Batch create
-            if activities_to_create_vals:
-                try:
-                    created_progress = ActivityProgress.create(activities_to_create_vals)
-                    _logger.debug(f"Batch created {len(created_progress)} activity progress records for course {course.name}.")
-                    course_progress_synced_count += len(created_progress)
-                except Exception as e_create_batch:
-                    _logger.error(f"Error batch creating activity progress for course {course.name}: {e_create_batch}", exc_info=True)
-                    # Fallback to individual create with logging if batch fails
-                    for v_create in activities_to_create_vals:
-                        try:
-                            ActivityProgress.create(v_create)
-                            _logger.debug(f"Individually created activity progress for cmid {v_create['cmid']} user {v_create['userid']} course {v_create['courseid']}.")
-                            course_progress_synced_count +=1
-                        except Exception as e_create_single:
-                             _logger.error(f"Error individually creating activity progress for cmid {v_create['cmid']} user {v_create['userid']} course {v_create['courseid']}: {e_create_single}", exc_info=True)
-
-
-            # Batch update (individual writes for now, batching updates is more complex)
-            updated_count_for_course = 0
-            for progress_id, update_vals in activities_to_update.items():
-                try:
-                    record_to_update = ActivityProgress.browse(progress_id)
-                    record_to_update.write(update_vals)
-                    _logger.debug(f"Updated activity progress for cmid {update_vals['cmid']} user {update_vals['userid']} course {update_vals['courseid']}.")
-                    updated_count_for_course +=1
-                except Exception as e_update:
-                    _logger.error(f"Error updating activity progress ID {progress_id} with vals {update_vals}: {e_update}", exc_info=True)
-            
-            course_progress_synced_count += updated_count_for_course
+            # Upsert on UNIQUE(userid, courseid, cmid)
+            try:
+                upsert_result = bulk_upsert(env, 'moodle.activity.progress', progress_rows, ['userid', 'courseid', 'cmid'])
+                course_progress_synced_count = upsert_result['created'] + upsert_result['updated']
+                total_progress_records_unchanged += upsert_result['unchanged']
+            except Exception as e_upsert:
+                _logger.error(f"Error upserting activity progress for course {course.name}: {e_upsert}", exc_info=True)
 
             if course_progress_synced_count > 0:
                 _logger.info(f"Synced {course_progress_synced_count} activity progress records for course {course.name} (Moodle ID: {course.moodle_id}).")
             total_progress_records_synced += course_progress_synced_count
 
-        _logger.info(f"Progress synchronization completed. Total activity progress records synced: {total_progress_records_synced}.")
-        return request.make_response(json.dumps({
-            'message': f'Progress sync completed successfully - {total_progress_records_synced} records synced'
-        }), headers=[('Content-Type', 'application/json')])
\ No newline at end of file
+        _logger.info(f"Progress synchronization completed. Total activity progress records synced: {total_progress_records_synced}, unchanged: {total_progress_records_unchanged}.")
+        return {
+            'message': f'Progress sync completed successfully - {total_progress_records_synced} records synced, {total_progress_records_unchanged} unchanged',
+            **cursor.summary(),
+        }, 200
+
+    def _fetch_enrolled_user_ids(self, env, client, course):
+        """Moodle ids of the users enrolled in ``course``, or an empty list on error."""
+        try:
+            roster = get_course_roster(env, client, course)
+        except (requests.exceptions.RequestException, ValueError) as e_users:
+            _logger.error(f"API error fetching enrolled users for course {course.name} (ID: {course.moodle_id}): {e_users}")
+            return []
+        enrolled_moodle_user_ids = [u['id'] for u in roster.users if 'id' in u]
+        if not enrolled_moodle_user_ids:
+            _logger.info(f"No enrolled users found in Moodle for course: {course.name}")
+        return enrolled_moodle_user_ids
+
+    def _fetch_completion_statuses(self, client, course_moodle_id, user_moodle_id):
+        """Activity completion of one user in one course (fetch thread, no ORM)."""
+        return client.call('core_completion_get_activities_completion_status', {
+            'courseid': course_moodle_id,
+            'userid': user_moodle_id,
+        }, timeout=30)
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import hmac
+import logging
+import json
+
+from odoo import http, SUPERUSER_ID
+from odoo.http import request
+from odoo.addons.digi_moodle_sync.tools.metrics import CallStats, prometheus_text
+
+_logger = logging.getLogger(__name__)
+
+MOODLE_SYNC_MANAGER_GROUP = 'digi_moodle_sync.group_manager'
+
+
+def json_response(payload, status=200):
+    return request.make_response(json.dumps(payload), status=status, headers=[('Content-Type', 'application/json')])
+
+
+def run_or_enqueue(job_type, run_inline, kw):
+    """Queue a moodle.sync.job and answer 202 with its id right away.
+
+    ``wait=1`` keeps the old behaviour and runs ``run_inline(request.env)``
+    inside the HTTP request, which is handy for scripts and tests.
+    """
+    if kw.get('wait'):
+        payload, status = run_inline(request.env)
+        return json_response(payload, status)
+    params = {k: v for k, v in kw.items() if k != 'wait'}
+    job = request.env['moodle.sync.job'].sudo().enqueue(job_type, params)
+    return json_response({
+        'job_id': job.id,
+        'state': job.state,
+        'status_url': f'/moodle/sync/jobs/{job.id}',
+    }, status=202)
+
+
+class MoodleSyncJobController(http.Controller):
+
+    @http.route('/moodle/sync/jobs/<int:job_id>', type='http', auth='user', methods=['GET'], csrf=False)
+    def job_status(self, job_id, **kw):
+        job = request.env['moodle.sync.job'].sudo().browse(job_id).exists()
+        if not job:
+            return json_response({'error': f'Không tìm thấy job {job_id}.'}, status=404)
+        if job.user_id != request.env.user and not request.env.user.has_group(MOODLE_SYNC_MANAGER_GROUP):
+            _logger.warning(f"User {request.env.user.login} (ID: {request.env.user.id}) attempt to read Moodle sync job {job_id} without proper rights.")
+            return json_response({'error': 'Bạn không có quyền xem job này.'}, status=403)
+        return json_response(job.get_status())
+
+    @http.route('/moodle/metrics', type='http', auth='none', methods=['GET'], csrf=False)
+    def metrics(self, token=None, **kw):
+        """Moodle call statistics of all sync jobs in the Prometheus text format.
+
+        Needs digi_moodle_sync.metrics_token, sent as ``Authorization:
+        Bearer <token>`` or ``?token=``; the endpoint is closed when unset.
+        """
+        if not request.db:
+            return request.make_response('database not selected\n', status=404)
+        env = request.env(user=SUPERUSER_ID)
+        expected = env['ir.config_parameter'].get_param('digi_moodle_sync.metrics_token')
+        header = request.httprequest.headers.get('Authorization', '')
+        given = header[7:] if header.startswith('Bearer ') else (token or '')
+        if not expected or not hmac.compare_digest(given.encode(), expected.encode()):
+            return request.make_response('forbidden\n', status=403)
+
+        stats_by_job_type = {}
+        run_seconds_by_job_type = {}
+        jobs = env['moodle.sync.job'].search_read([('api_stats', '!=', False)], ['job_type', 'api_stats', 'run_seconds'])
+        for job in jobs:
+            stats_by_job_type.setdefault(job['job_type'], CallStats()).merge(CallStats.from_json(job['api_stats']))
+            run_seconds_by_job_type[job['job_type']] = run_seconds_by_job_type.get(job['job_type'], 0.0) + job['run_seconds']
+        return request.make_response(prometheus_text(stats_by_job_type, run_seconds_by_job_type),
+                                     headers=[('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')])
@@ -5,11 +5,25 @@ import logging
 from datetime import datetime
 from odoo.exceptions import AccessError
 import json
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
+from odoo.addons.digi_moodle_sync.controllers.sync_jobs import run_or_enqueue
+from odoo.addons.digi_moodle_sync.tools.sync_cursor import SyncCursor
+from odoo.addons.digi_moodle_sync.tools.bulk import bulk_upsert, bulk_write
 
 _logger = logging.getLogger(__name__)
 
 MOODLE_SYNC_MANAGER_GROUP = 'digi_moodle_sync.group_manager'
 
+# Số khóa học xử lý giảng viên chung một lượt (một lần tra cứu người dùng, một checkpoint)
+TEACHER_COURSE_CHUNK_SIZE = 50
+
+# Vai trò giảng viên mặc định của Moodle (shortname); thêm vai trò riêng trong cài đặt
+DEFAULT_TEACHER_ROLES = 'editingteacher,teacher'
+# Chỉ lấy người dùng có quyền này khi tải danh sách giảng viên (cả giảng viên không sửa nội dung đều có).
+# Quyền này chỉ thu hẹp danh sách: quản lý được ghi danh cũng có, và bị loại bởi bộ lọc vai trò giảng viên
+DEFAULT_TEACHER_CAPABILITY = 'moodle/grade:viewall'
+TEACHER_USER_FIELDS = 'id,username,fullname,email,roles'
+
 class MoodleTeacherSync(http.Controller):
     
     def _check_access_rights(self):
@@ -19,9 +33,9 @@ class MoodleTeacherSync(http.Controller):
             )
             raise AccessError("Bạn không có quyền thực hiện hành động này. Vui lòng liên hệ quản trị viên.")
 
-    def _get_moodle_config(self):
+    def _get_moodle_config(self, env):
         """Get Moodle configuration with correct parameter names"""
-        params = request.env['ir.config_parameter'].sudo()
+        params = env['ir.config_parameter'].sudo()
         
         # Get parameters with correct names from your system
         token = params.get_param('digi_moodle_sync.token')
@@ -40,7 +54,8 @@ class MoodleTeacherSync(http.Controller):
         return {
             'token': token,
             'url': moodle_url,
-            'api_url': api_url
+            'api_url': api_url,
+            'client': MoodleClient.from_env(env),
         }
 
     @http.route('/moodle/sync/teachers', type='http', auth='user', csrf=False, methods=['GET'])
@@ -56,137 +71,142 @@ class MoodleTeacherSync(http.Controller):
                 status=403, 
                 headers=[('Content-Type', 'application/json')])
 
-        config = self._get_moodle_config()
+        return run_or_enqueue('teachers', lambda env: self._sync_teachers(env, **kwargs), kwargs)
+
+    def _sync_teachers(self, env, progress=None, cursor=None, **kwargs):
+        """Run the sync on ``env``; returns ``(payload, http_status)``.
+
+        ``cursor`` (a SyncCursor) time-boxes the course loop and resumes it.
+        """
+        cursor = cursor or SyncCursor()
+        config = self._get_moodle_config(env)
         if not config['token'] or not config['url']:
             _logger.error("Moodle configuration is missing - Token or URL not found")
-            return request.make_response(json.dumps({'error': 'Moodle configuration is missing - check digi_moodle_sync.token and digi_moodle_sync.moodle_url parameters'}), status=503, headers=[('Content-Type', 'application/json')])
+            return {'error': 'Moodle configuration is missing - check digi_moodle_sync.token and digi_moodle_sync.moodle_url parameters'}, 503
 
         _logger.info("Starting teacher synchronization...")
 
         # Get all courses
-        courses = request.env['moodle.course'].search([])
+        courses = env['moodle.course'].search([])
         
         if not courses:
             _logger.warning("No courses found in Odoo")
-            return request.make_response(json.dumps({'error': 'No courses found in Odoo database'}), status=200, headers=[('Content-Type', 'application/json')])
+            return {'error': 'No courses found in Odoo database'}, 200
         
-        # Define teacher role IDs (can be configured in Moodle settings)
-        teacher_role_ids = [3, 4]  # 3: Teacher, 4: Non-editing teacher
+        teacher_roles = self._get_teacher_roles(env)
+        _logger.info(f"Teacher roles: {sorted(teacher_roles['shortnames'])}, known role ids: {teacher_roles['ids']}")
         
+        courses = cursor.pending(courses)
         _logger.info(f"Found {len(courses)} courses to sync teachers for")
         total_teachers_synced = 0
-        
-        for course in courses:
-            _logger.info(f"Syncing teachers for course: {course.name} (ID: {course.moodle_id})")
-            params = {
-                'wstoken': config['token'],
-                'wsfunction': 'core_enrol_get_enrolled_users',
-                'courseid': course.moodle_id,
-                'moodlewsrestformat': 'json'
-            }
+        done_courses = 0
 
+        # Mỗi nhóm khóa học: tải danh sách ghi danh, rồi xử lý giảng viên của cả nhóm bằng vài truy vấn theo tập hợp
+        for course_chunk in cursor.chunks(courses, TEACHER_COURSE_CHUNK_SIZE):
+            teachers_by_course = self._collect_course_teachers(env, config['client'], course_chunk, teacher_roles)
             try:
-                response = requests.get(config['api_url'], params=params, timeout=30)
-                response.raise_for_status()
-                data = response.json()
-
-                # Check for Moodle API errors
-                if isinstance(data, dict) and 'exception' in data:
-                    error_code = data.get('errorcode', 'Unknown')
-                    error_message = data.get('message', 'Unknown error')
-                    _logger.error(f"Moodle API error for course {course.name}: {error_message} - Code: {error_code}")
-                    continue
+                total_teachers_synced += self._apply_course_teachers(env, teachers_by_course)
+            except Exception as e:
+                _logger.error(f"Unexpected error syncing teachers for courses {course_chunk.ids}: {str(e)}", exc_info=True)
+            done_courses += len(course_chunk)
+            if progress:
+                progress(done_courses, len(courses))
 
-                if not isinstance(data, list):
-                    _logger.warning(f"Unexpected response format for course {course.name} - expected list, got {type(data)}")
-                    continue
+        self._store_teacher_role_ids(env, teacher_roles)
+        _logger.info(f"Teacher synchronization completed - Total: {total_teachers_synced} teachers synced")
+        return {
+            'message': f'Teacher sync completed successfully - {total_teachers_synced} teachers synced',
+            **cursor.summary(),
+        }, 200
 
-                # Filter teachers from enrolled users
-                teachers = []
-                for user in data:
-                    user_roles = user.get('roles', [])
-                    if any(role['roleid'] in teacher_role_ids for role in user_roles):
-                        teachers.append(user)
-                
-                if not teachers:
-                    _logger.warning(f"No teachers found for course {course.name}")
-                    continue
+    def _get_teacher_roles(self, env):
+        """Teacher roles of this run: configured shortnames, capability filter and known role ids.
+
+        Role ids differ between Moodle sites and the webservice API has no
+        function listing roles, so the ids cannot be resolved up front: they
+        are learned from the ``roles`` entries of the fetched users (see
+        _learn_teacher_role_ids) and kept in digi_moodle_sync.teacher_role_ids
+        for entries without a shortname.
+        """
+        params = env['ir.config_parameter'].sudo()
+        shortnames = params.get_param('digi_moodle_sync.teacher_role_shortnames') or DEFAULT_TEACHER_ROLES
+        capability = params.get_param('digi_moodle_sync.teacher_capability') or DEFAULT_TEACHER_CAPABILITY
+        try:
+            known_ids = json.loads(params.get_param('digi_moodle_sync.teacher_role_ids') or '{}')
+        except ValueError:
+            known_ids = {}
+        shortnames = {name.strip() for name in shortnames.split(',') if name.strip()}
+        return {
+            'shortnames': shortnames,
+            'capability': capability.strip(),
+            'ids': {name: role_id for name, role_id in known_ids.items() if name in shortnames},
+            'learned': False,
+        }
+
+    def _store_teacher_role_ids(self, env, teacher_roles):
+        if teacher_roles['learned']:
+            env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.teacher_role_ids', json.dumps(teacher_roles['ids'], sort_keys=True))
+
+    def _learn_teacher_role_ids(self, teacher_roles, users):
+        """Record the role ids of the teacher shortnames found in ``users``' roles."""
+        for user in users:
+            for role in user.get('roles') or []:
+                shortname = role.get('shortname')
+                if shortname in teacher_roles['shortnames'] and role.get('roleid') \
+                        and teacher_roles['ids'].get(shortname) != role['roleid']:
+                    teacher_roles['ids'][shortname] = role['roleid']
+                    teacher_roles['learned'] = True
+
+    def _is_teacher(self, user, teacher_roles):
+        """Whether ``user`` holds a teacher role in the course, by shortname or known role id.
+
+        Managers and other roles that only share the capability filter are
+        not teachers.
+        """
+        role_ids = set(teacher_roles['ids'].values())
+        for role in user.get('roles') or []:
+            shortname = role.get('shortname')
+            if shortname in teacher_roles['shortnames']:
+                return True
+            if not shortname and role.get('roleid') in role_ids:
+                return True
+        return False
+
+    def _fetch_course_teachers(self, env, client, course, teacher_roles):
+        """Enrolled users of ``course`` that may hold a teacher role.
 
-                _logger.info(f"Found {len(teachers)} teachers for course {course.name}")
-
-                course_teachers_synced = 0
-                MoodleUser = request.env['moodle.user'].sudo()
-                
-                for teacher in teachers:
-                    moodle_id = teacher.get('id')
-                    if not moodle_id:
-                        _logger.warning("Teacher without Moodle ID, skipping")
-                        continue
-                
-                    # Tìm hoặc tạo moodle.user
-                    moodle_user = MoodleUser.search([('moodle_id', '=', moodle_id)], limit=1)
-                    if not moodle_user:
-                        # Tạo moodle.user
-                        moodle_user = MoodleUser.create({
-                            'name': teacher.get('fullname'),
-                            'login': teacher.get('username', ''),
-                            'email': teacher.get('email', ''),
-                            'moodle_id': moodle_id,
-                            'last_sync_date': datetime.now(),
-                        })
-                        
-                    # Tìm hoặc liên kết với res.users
-                    user = request.env['res.users'].sudo().search([
-                        ('moodle_id', '=', moodle_id)
-                    ], limit=1)
-                    
-                    if not user:
-                        # Tìm theo email
-                        email = teacher.get('email')
-                        if email:
-                            user = request.env['res.users'].sudo().search([
-                                ('email', '=', email)
-                            ], limit=1)
-                            
-                            if user:
-                                # Cập nhật moodle_id
-                                user.write({'moodle_id': moodle_id})
-                                moodle_user.write({'odoo_user_id': user.id})
-                                
-                    if not user and moodle_user:
-                        # Tạo Odoo user từ moodle user
-                        user = moodle_user.find_or_create_odoo_user()
-
-                    if not user:
-                        _logger.warning(f"Couldn't find or create user for teacher {teacher.get('fullname', 'Unknown')}")
-                        continue
-
-                    vals = {
-                        'user_id': user.id,
-                        'course_id': course.id,
-                        'fullname': teacher.get('fullname', ''),
-                        'email': teacher.get('email', ''),
-                        'last_sync_date': datetime.now(),
-                    }
-
-                    # Create or update teacher record
-                    teacher_record = request.env['moodle.course.teacher'].sudo().search([
-                        ('user_id', '=', user.id),
-                        ('course_id', '=', course.id)
-                    ], limit=1)
-
-                    if teacher_record:
-                        teacher_record.write(vals)
-                        _logger.debug(f"Updated teacher record for {teacher.get('fullname', '')} in course {course.name}")
-                    else:
-                        request.env['moodle.course.teacher'].sudo().create(vals)
-                        _logger.debug(f"Created teacher record for {teacher.get('fullname', '')} in course {course.name}")
-
-                    course_teachers_synced += 1
-
-                _logger.info(f"Synced {course_teachers_synced} teachers for course {course.name}")
-                total_teachers_synced += course_teachers_synced
+        Moodle is asked only for active users having the teacher capability,
+        with a minimal field list, instead of the whole class. The cached
+        full roster of the progress sync is deliberately not used: it also
+        holds suspended enrolments, so the teachers found would depend on
+        the cache state.
+        """
+        params = {
+            'courseid': course.moodle_id,
+            'options[0][name]': 'userfields',
+            'options[0][value]': TEACHER_USER_FIELDS,
+            'options[1][name]': 'onlyactive',
+            'options[1][value]': 1,
+            'options[2][name]': 'withcapability',
+            'options[2][value]': teacher_roles['capability'],
+        }
+        users = client.call('core_enrol_get_enrolled_users', params, timeout=60)
+        if isinstance(users, dict) and 'exception' in users:
+            raise ValueError(f"{users.get('message', 'Unknown error')} - Code: {users.get('errorcode', 'Unknown')}")
+        if not isinstance(users, list):
+            raise ValueError(f"Unexpected core_enrol_get_enrolled_users response: {users}")
+        return users
+
+    def _collect_course_teachers(self, env, client, courses, teacher_roles):
+        """``{course: [teacher dicts]}`` for the courses whose teachers could be fetched.
 
+        Courses with an API error are left out, so their existing teacher
+        links are kept untouched.
+        """
+        teachers_by_course = {}
+        for course in courses:
+            try:
+                data = self._fetch_course_teachers(env, client, course, teacher_roles)
             except requests.exceptions.Timeout:
                 _logger.error(f"Timeout error syncing teachers for course {course.name}")
                 continue
@@ -196,11 +216,126 @@ class MoodleTeacherSync(http.Controller):
             except requests.exceptions.RequestException as e:
                 _logger.error(f"HTTP Error syncing teachers for course {course.name}: {str(e)}")
                 continue
-            except Exception as e:
-                _logger.error(f"Unexpected error syncing teachers for course {course.name}: {str(e)}")
+            except ValueError as e_roster:
+                _logger.error(f"Moodle API error for course {course.name}: {e_roster}")
                 continue
 
-        _logger.info(f"Teacher synchronization completed - Total: {total_teachers_synced} teachers synced")
-        return request.make_response(json.dumps({
-            'message': f'Teacher sync completed successfully - {total_teachers_synced} teachers synced'
-        }), headers=[('Content-Type', 'application/json')])
\ No newline at end of file
+            # Filter teachers from enrolled users
+            self._learn_teacher_role_ids(teacher_roles, data)
+            teachers = [user for user in data if user.get('id') and self._is_teacher(user, teacher_roles)]
+            if not teachers:
+                _logger.warning(f"No teachers found for course {course.name}")
+            teachers_by_course[course] = teachers
+        return teachers_by_course
+
+    def _apply_course_teachers(self, env, teachers_by_course):
+        """Write the teacher links of ``teachers_by_course``; returns the number of links synced.
+
+        Teachers of all the courses are resolved together: one query per
+        model for moodle.user and res.users, missing moodle.user rows and
+        the links are written with bulk_upsert, and links of teachers no
+        longer in a course are deleted at once. A link is only deleted when
+        its user's Moodle id is missing from a non-empty teacher list, so a
+        teacher that could not be resolved or written keeps its link.
+        """
+        teachers_by_moodle_id = {}
+        for teachers in teachers_by_course.values():
+            for teacher in teachers:
+                teachers_by_moodle_id[teacher['id']] = teacher
+        user_ids_by_moodle_id = self._resolve_teacher_users(env, teachers_by_moodle_id)
+
+        sync_date = datetime.now()
+        link_rows = []
+        for course, teachers in teachers_by_course.items():
+            for teacher in teachers:
+                user_id = user_ids_by_moodle_id.get(teacher['id'])
+                if not user_id:
+                    _logger.warning(f"Couldn't find or create user for teacher {teacher.get('fullname', 'Unknown')}")
+                    continue
+                link_rows.append({
+                    'user_id': user_id,
+                    'course_id': course.id,
+                    'fullname': teacher.get('fullname', ''),
+                    'email': teacher.get('email', ''),
+                    'last_sync_date': sync_date,
+                })
+
+        link_result = bulk_upsert(env, 'moodle.course.teacher', link_rows, ['user_id', 'course_id'])
+        for key, error in link_result['failed'].items():
+            _logger.error(f"Error writing teacher link (user, course) {key}: {error}")
+
+        # Chỉ xoá liên kết của giảng viên không còn trong danh sách Moodle trả về. Khóa học
+        # có danh sách rỗng, giảng viên chưa tìm được người dùng hoặc ghi lỗi giữ nguyên liên kết.
+        roster_moodle_ids = {course.id: {teacher['id'] for teacher in teachers}
+                             for course, teachers in teachers_by_course.items() if teachers}
+        stale_links = env['moodle.course.teacher'].sudo().search([
+            ('course_id', 'in', list(roster_moodle_ids)),
+        ]).filtered(lambda link: link.user_id.moodle_id
+                    and link.user_id.moodle_id not in roster_moodle_ids[link.course_id.id])
+        if stale_links:
+            _logger.info(f"Removing {len(stale_links)} teacher links no longer in Moodle")
+            stale_links.unlink()
+
+        synced = link_result['created'] + link_result['updated'] + link_result['unchanged']
+        _logger.info(f"Synced {synced} teacher links for {len(teachers_by_course)} courses")
+        return synced
+
+    def _resolve_teacher_users(self, env, teachers_by_moodle_id):
+        """``{moodle id: res.users id}`` for the given Moodle teachers.
+
+        Missing moodle.user rows are created in bulk; Odoo users are matched
+        by moodle_id, then by email (and linked), and only teachers matching
+        neither fall back to moodle.user.find_or_create_odoo_user().
+        """
+        if not teachers_by_moodle_id:
+            return {}
+        MoodleUser = env['moodle.user'].sudo()
+        ResUsers = env['res.users'].sudo()
+        moodle_ids = list(teachers_by_moodle_id)
+
+        moodle_users = {mu.moodle_id: mu for mu in MoodleUser.search([('moodle_id', 'in', moodle_ids)])}
+        sync_date = datetime.now()
+        new_rows = [{
+            'name': teacher.get('fullname'),
+            'login': teacher.get('username', ''),
+            'email': teacher.get('email', ''),
+            'moodle_id': moodle_id,
+            'last_sync_date': sync_date,
+        } for moodle_id, teacher in teachers_by_moodle_id.items() if moodle_id not in moodle_users]
+        if new_rows:
+            created = bulk_upsert(env, 'moodle.user', new_rows, ['moodle_id'])
+            for key, error in created['failed'].items():
+                _logger.error(f"Error creating moodle.user for teacher {key[0]}: {error}")
+            for mu in MoodleUser.browse(list(created['ids'].values())):
+                moodle_users[mu.moodle_id] = mu
+
+        user_ids = {u.moodle_id: u.id for u in ResUsers.with_context(active_test=False).search([('moodle_id', 'in', moodle_ids)])}
+
+        # Chưa liên kết theo moodle_id: tìm theo email trong một truy vấn, rồi gắn moodle_id
+        unlinked = {moodle_id: teacher for moodle_id, teacher in teachers_by_moodle_id.items() if moodle_id not in user_ids}
+        users_by_email = ResUsers._get_users_by_email([t.get('email') for t in unlinked.values()])
+        user_updates = {}
+        moodle_user_updates = {}
+        for moodle_id, teacher in unlinked.items():
+            user = users_by_email.get((teacher.get('email') or '').strip().lower())
+            if not user or user.id in user_updates:
+                continue
+            user_ids[moodle_id] = user.id
+            if not user.moodle_id:
+                user_updates[user.id] = {'moodle_id': moodle_id}
+            if moodle_id in moodle_users:
+                moodle_user_updates[moodle_users[moodle_id].id] = {'odoo_user_id': user.id}
+        for model_name, updates in (('res.users', user_updates), ('moodle.user', moodle_user_updates)):
+            for rec_id, error in bulk_write(env, model_name, updates)['failed'].items():
+                _logger.error(f"Error linking teacher {model_name} ID {rec_id}: {error}")
+
+        for moodle_id in teachers_by_moodle_id:
+            if moodle_id not in user_ids and moodle_id in moodle_users:
+                # Tạo Odoo user từ moodle user
+                try:
+                    user = moodle_users[moodle_id].find_or_create_odoo_user()
+                except Exception as e_user:
+                    _logger.error(f"Error creating Odoo user for teacher {moodle_id}: {e_user}")
+                    continue
+                user_ids[moodle_id] = user.id
+        return user_ids
@@ -2,16 +2,41 @@
 import logging
 import requests
 import json
+import time
 from datetime import datetime
 
 from odoo import http
 from odoo.http import request
 from odoo.exceptions import UserError, AccessError
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
+from odoo.addons.digi_moodle_sync.controllers.sync_jobs import run_or_enqueue
+from odoo.addons.digi_moodle_sync.tools.json_stream import JsonArrayStream
+from odoo.addons.digi_moodle_sync.tools.sync_cursor import SyncCursor
+from odoo.addons.digi_moodle_sync.tools.bulk import _apply_isolated, bulk_write
 
 _logger = logging.getLogger(__name__)
 
 MOODLE_SYNC_MANAGER_GROUP = 'digi_moodle_sync.group_manager'
 
+# Số người dùng Moodle được ghi vào Odoo mỗi lô khi đọc phản hồi dạng stream
+USER_BATCH_SIZE = 500
+
+# Context khi tạo hàng loạt partner/res.users: không gửi email đặt mật khẩu,
+# không thêm follower, không ghi log chatter và tracking
+USER_PROVISIONING_CONTEXT = {
+    'no_reset_password': True,
+    'mail_create_nosubscribe': True,
+    'mail_create_nolog': True,
+    'tracking_disable': True,
+}
+
+# Đồng bộ theo trang: số ID mỗi lần gọi core_user_get_users_by_field (giữ URL GET đủ ngắn),
+# số trang rỗng liên tiếp thì coi là hết danh bạ (chỉ sau Moodle ID lớn nhất đã biết trong Odoo),
+# số lần thử lại một trang lỗi
+USER_PAGE_SIZE = 200
+USER_MAX_EMPTY_PAGES = 25
+USER_PAGE_RETRIES = 2
+
 class MoodleUserSyncController(http.Controller):
 
     def _check_access_rights(self):
@@ -35,230 +60,357 @@ class MoodleUserSyncController(http.Controller):
                 status=403, 
                 headers=[('Content-Type', 'application/json')])
 
-        config = request.env['ir.config_parameter'].sudo()
-        base_moodle_url = config.get_param('digi_moodle_sync.moodle_url')
-        token = config.get_param('digi_moodle_sync.token')
+        return run_or_enqueue('users', lambda env: self._sync_users(env, **kw), kw)
+
+    def _sync_users(self, env, progress=None, cursor=None, **kw):
+        """Run the user sync on ``env``; returns ``(payload, http_status)``.
 
-        if not base_moodle_url or not token:
+        By default the Moodle directory is paged by user id ranges with
+        core_user_get_users_by_field, one batch per page; ``cursor`` (a
+        SyncCursor) checkpoints after each page so a failed or time-boxed
+        run resumes at the page it stopped on. ``page_size=0`` (URL or
+        digi_moodle_sync.user_sync_page_size) falls back to streaming the
+        single core_user_get_users response.
+        """
+        config = env['ir.config_parameter'].sudo()
+        client = MoodleClient.from_env(env)
+        cursor = cursor or SyncCursor()
+
+        if not client.is_configured:
             _logger.error("Moodle URL hoặc Token chưa được cấu hình.")
-            return request.make_response(
-                json.dumps({'error': 'Moodle URL/Token chưa cấu hình.'}), 
-                headers=[('Content-Type', 'application/json')])
+            return {'error': 'Moodle URL/Token chưa cấu hình.'}, 200
 
-        api_url = base_moodle_url.rstrip('/') + '/webservice/rest/server.php'
-        params = {
-            'wstoken': token,
-            'wsfunction': 'core_user_get_users',
-            'criteria[0][key]': 'email',
-            'criteria[0][value]': '%',
-            'moodlewsrestformat': 'json'
-        }
+        page_size = self._get_int_setting(env, kw, 'page_size', 'digi_moodle_sync.user_sync_page_size', USER_PAGE_SIZE)
+        max_empty_pages = self._get_int_setting(env, kw, 'max_empty_pages', 'digi_moodle_sync.user_sync_max_empty_pages', USER_MAX_EMPTY_PAGES)
 
+        resp = None
+        users_stream = None
+        page_walk = {}
         try:
-            _logger.info("Bắt đầu đồng bộ người dùng từ Moodle API: %s", api_url)
-            resp = requests.get(api_url, params=params, timeout=60) 
-
-            if resp.status_code != 200:
-                _logger.error(
-                    "Lỗi API Moodle (core_user_get_users): Status %s, Phản hồi: %s",
-                    resp.status_code, resp.text[:500])
-                return request.make_response(
-                    json.dumps({'error': f'Moodle API trả về status {resp.status_code}'}),
-                    headers=[('Content-Type', 'application/json')])
-            
-            data = resp.json()
-            if 'users' not in data or not isinstance(data['users'], list):
-                _logger.error("Phản hồi không hợp lệ: thiếu 'users' hoặc sai định dạng. Phản hồi: %s", data)
-                return request.make_response(
-                    json.dumps({'error': "Không có trường 'users' hợp lệ trong phản hồi từ Moodle."}),
-                    headers=[('Content-Type', 'application/json')])
-
-            moodle_users_api_data = data['users']
-            _logger.info(f"API Moodle trả về {len(moodle_users_api_data)} người dùng.")
-            if not moodle_users_api_data:
-                 return request.make_response(json.dumps({'message': 'Không có người dùng nào từ Moodle để đồng bộ.', 'created_odoo_users': 0, 'updated_odoo_users': 0, 'created_moodle_users': 0, 'updated_moodle_users': 0}), headers=[('Content-Type', 'application/json')])
-
-            ResUsers = request.env['res.users'].sudo()
-            MoodleAppUser = request.env['moodle.user'].sudo()
-            ResPartner = request.env['res.partner'].sudo()
-
-            # Prepare maps for existing records
-            all_moodle_ids_from_api = [u['id'] for u in moodle_users_api_data if u.get('id')]
-            all_emails_from_api = [u['email'].lower() for u in moodle_users_api_data if u.get('email')]
-
-            existing_odoo_users_by_moodle_id = {u.moodle_id: u for u in ResUsers.search([('moodle_id', 'in', all_moodle_ids_from_api)])}
-            existing_odoo_users_by_email = {u.email.lower(): u for u in ResUsers.search([('email', 'ilike', '%')]) if u.email} # Fetch all for broader email check
-            
-            existing_moodle_app_users_by_moodle_id = {mu.moodle_id: mu for mu in MoodleAppUser.search([('moodle_id', 'in', all_moodle_ids_from_api)])}
-            
-            odoo_users_to_create_vals = []
-            odoo_users_to_update_map = {} # {odoo_user_id: vals}
-            moodle_app_users_to_create_vals = []
-            moodle_app_users_to_update_map = {} # {moodle_app_user_id: vals}
+            _logger.info("Bắt đầu đồng bộ người dùng từ Moodle API: %s", client.api_url)
+            if page_size > 0:
+                _logger.info(f"Đồng bộ người dùng theo trang {page_size} ID, tiếp tục sau ID {cursor.resume_after or 0}.")
+                users_batches = self._iter_user_pages(client, cursor, page_size, max(max_empty_pages, 1),
+                                                      self._get_known_max_moodle_id(env), page_walk)
+            else:
+                params = {
+                    'criteria[0][key]': 'email',
+                    'criteria[0][value]': '%',
+                }
+                # Đọc phản hồi dạng stream: danh bạ người dùng có thể lên tới hàng trăm MB
+                resp = client.request('core_user_get_users', params, timeout=60, stream=True)
+
+                if resp.status_code != 200:
+                    _logger.error(
+                        "Lỗi API Moodle (core_user_get_users): Status %s, Phản hồi: %s",
+                        resp.status_code, resp.text[:500])
+                    return {'error': f'Moodle API trả về status {resp.status_code}'}, 200
+
+                # Mỗi lô USER_BATCH_SIZE người dùng được ghi ngay khi tải xong, bộ nhớ không tăng theo số người dùng
+                users_stream = JsonArrayStream(resp, 'users')
+                users_batches = users_stream.batches(USER_BATCH_SIZE)
 
             processed_moodle_ids = set()
+            totals = dict.fromkeys(['created_odoo_users', 'updated_odoo_users', 'created_moodle_users', 'updated_moodle_users'], 0)
 
-            for u_api in moodle_users_api_data:
-                moodle_id = u_api.get('id')
-                email = u_api.get('email', '').lower().strip()
-                username = u_api.get('username', '')
-                fullname = u_api.get('fullname', username or email or f"Moodle User {moodle_id}")
+            try:
+                for users_batch in users_batches:
+                    batch_counts = self._apply_users_batch(env, users_batch, processed_moodle_ids)
+                    for key in totals:
+                        totals[key] += batch_counts[key]
+                    if progress:
+                        progress(len(processed_moodle_ids))
+            finally:
+                if resp is not None:
+                    resp.close()
 
-                if not moodle_id or not email:
-                    _logger.warning(f"Bỏ qua user từ Moodle do thiếu Moodle ID ({moodle_id}) hoặc Email ({email}). Data: {u_api}")
-                    continue
-                
-                if moodle_id in processed_moodle_ids:
-                    _logger.debug(f"Moodle ID {moodle_id} đã được xử lý, bỏ qua trùng lặp từ API.")
-                    continue
-                processed_moodle_ids.add(moodle_id)
-
-                odoo_user = None
-                # 1. Find Odoo User by Moodle ID first
-                if moodle_id in existing_odoo_users_by_moodle_id:
-                    odoo_user = existing_odoo_users_by_moodle_id[moodle_id]
-                # 2. If not found, find by email
-                elif email in existing_odoo_users_by_email:
-                    odoo_user = existing_odoo_users_by_email[email]
-                    # Link Moodle ID if found by email and not yet linked
-                    if odoo_user and not odoo_user.moodle_id:
-                        odoo_users_to_update_map.setdefault(odoo_user.id, {}).update({'moodle_id': moodle_id})
-                
-                # Prepare Odoo User vals
-                odoo_user_update_vals = {
-                    'name': fullname,
-                    'login': odoo_user.login if odoo_user and odoo_user.login else email, # Keep existing login if user exists
-                    'email': email,
-                    'moodle_id': moodle_id # Ensure Moodle ID is set/updated
-                }
+            if users_stream is not None and not users_stream.found:
+                _logger.error("Phản hồi không hợp lệ: thiếu 'users' hoặc sai định dạng. Phản hồi: %s", users_stream.other)
+                return {'error': "Không có trường 'users' hợp lệ trong phản hồi từ Moodle."}, 200
+            if cursor.interrupted:
+                _logger.info(f"Dừng đồng bộ người dùng do hết thời gian, sẽ tiếp tục sau Moodle ID {cursor.resume_after}.")
+                return {'message': f"Đã đồng bộ {len(processed_moodle_ids)} người dùng, phần còn lại chạy ở lượt sau.", **totals, **cursor.summary()}, 200
 
-                if odoo_user:
-                    # Check for changes before adding to update map
-                    current_vals = {k: odoo_user[k] for k in odoo_user_update_vals.keys() if k in odoo_user}
-                    if any(odoo_user_update_vals[k] != current_vals.get(k) for k in odoo_user_update_vals):
-                        odoo_users_to_update_map.setdefault(odoo_user.id, {}).update(odoo_user_update_vals)
-                else:
-                    # Create new Partner first for the new Odoo User
-                    partner_vals = {
-                        'name': fullname,
-                        'email': email,
-                        'company_id': request.env.company.id, # Ensure company context
-                    }
-                    # We will create partner along with user to ensure atomicity if possible or handle failure
-                    odoo_user_create_val = dict(odoo_user_update_vals)
-                    odoo_user_create_val['partner_vals_for_creation'] = partner_vals # Temp store for batch creation
-                    odoo_users_to_create_vals.append(odoo_user_create_val)
-
-                # Prepare Moodle App User (moodle.user) vals
-                moodle_app_user_vals = {
-                    'name': fullname,
-                    'login': username or email, # Moodle username might be different from email
-                    'email': email,
-                    'moodle_id': moodle_id,
-                    'odoo_user_id': odoo_user.id if odoo_user else None, # Link later if Odoo user is created
-                    'last_sync_date': datetime.now(),
-                }
-                if moodle_id in existing_moodle_app_users_by_moodle_id:
-                    mu_record = existing_moodle_app_users_by_moodle_id[moodle_id]
-                    current_mu_vals = {k: mu_record[k] for k in moodle_app_user_vals.keys() if k in mu_record}
-                    if any(moodle_app_user_vals[k] != current_mu_vals.get(k) for k in moodle_app_user_vals):
-                        moodle_app_users_to_update_map.setdefault(mu_record.id, {}).update(moodle_app_user_vals)
-                else:
-                    moodle_app_users_to_create_vals.append(moodle_app_user_vals)
-
-            # Batch Create Odoo Users (res.users)
-            created_odoo_users_count = 0
-            newly_created_odoo_users_map_by_moodle_id = {}
-            if odoo_users_to_create_vals:
-                final_odoo_user_create_list = []
-                for user_val_with_partner in odoo_users_to_create_vals:
-                    partner_vals = user_val_with_partner.pop('partner_vals_for_creation')
-                    try:
-                        partner = ResPartner.create(partner_vals)
-                        user_val_with_partner['partner_id'] = partner.id
-                        user_val_with_partner['company_id'] = partner.company_id.id or request.env.company.id
-                        user_val_with_partner['company_ids'] = [(6, 0, [partner.company_id.id or request.env.company.id])]
-                        final_odoo_user_create_list.append(user_val_with_partner)
-                    except Exception as e_partner:
-                        _logger.error(f"Không thể tạo Partner cho Odoo User (email: {user_val_with_partner.get('email')}). Lỗi: {e_partner}")
-                
-                if final_odoo_user_create_list:
-                    try:
-                        created_odoo_users = ResUsers.with_context(no_reset_password=True).create(final_odoo_user_create_list)
-                        created_odoo_users_count = len(created_odoo_users)
-                        for nou in created_odoo_users: newly_created_odoo_users_map_by_moodle_id[nou.moodle_id] = nou
-                        _logger.debug(f"Batch created {created_odoo_users_count} res.users.")
-                    except Exception as e_create_batch_ou:
-                        _logger.error(f"Lỗi batch create res.users: {e_create_batch_ou}", exc_info=True)
-                        # Fallback could be implemented here if critical
-            
-            # Update Odoo User references in Moodle App User creation list
-            for mu_create_val in moodle_app_users_to_create_vals:
-                if not mu_create_val.get('odoo_user_id') and mu_create_val.get('moodle_id') in newly_created_odoo_users_map_by_moodle_id:
-                    mu_create_val['odoo_user_id'] = newly_created_odoo_users_map_by_moodle_id[mu_create_val['moodle_id']].id
-            
-            # Batch Create Moodle App Users (moodle.user)
-            created_moodle_users_count = 0
-            if moodle_app_users_to_create_vals:
-                try:
-                    MoodleAppUser.create(moodle_app_users_to_create_vals)
-                    created_moodle_users_count = len(moodle_app_users_to_create_vals)
-                    _logger.debug(f"Batch created {created_moodle_users_count} moodle.user records.")
-                except Exception as e_create_batch_mu:
-                    _logger.error(f"Lỗi batch create moodle.user: {e_create_batch_mu}", exc_info=True)
-
-            # Batch Update Odoo Users
-            updated_odoo_users_count = 0
-            for user_id, vals_u_update in odoo_users_to_update_map.items():
-                try:
-                    ResUsers.browse(user_id).write(vals_u_update)
-                    updated_odoo_users_count += 1
-                    _logger.debug(f"Updated res.users ID {user_id}.")
-                except Exception as e_update_ou:
-                    _logger.error(f"Lỗi cập nhật res.users ID {user_id}: {e_update_ou}")
-            
-            # Update Odoo User references in Moodle App User update list
-            for mu_update_vals in moodle_app_users_to_update_map.values():
-                 if not mu_update_vals.get('odoo_user_id') and mu_update_vals.get('moodle_id') in newly_created_odoo_users_map_by_moodle_id:
-                    mu_update_vals['odoo_user_id'] = newly_created_odoo_users_map_by_moodle_id[mu_update_vals['moodle_id']].id
-                 elif not mu_update_vals.get('odoo_user_id') and mu_update_vals.get('moodle_id') in existing_odoo_users_by_moodle_id:
-                     mu_update_vals['odoo_user_id'] = existing_odoo_users_by_moodle_id[mu_update_vals['moodle_id']].id
-
-            # Batch Update Moodle App Users
-            updated_moodle_users_count = 0
-            for mu_id, vals_mu_update in moodle_app_users_to_update_map.items():
-                try:
-                    MoodleAppUser.browse(mu_id).write(vals_mu_update)
-                    updated_moodle_users_count += 1
-                    _logger.debug(f"Updated moodle.user ID {mu_id}.")
-                except Exception as e_update_mu:
-                     _logger.error(f"Lỗi cập nhật moodle.user ID {mu_id}: {e_update_mu}")
+            _logger.info(f"API Moodle trả về {len(processed_moodle_ids)} người dùng hợp lệ.")
+            walk_note = ''
+            if page_walk.get('stopped_on_empty_pages'):
+                walk_note = (f" Kết thúc sau {max(max_empty_pages, 1)} trang rỗng liên tiếp tại Moodle ID {page_walk['stopped_on_empty_pages']}; "
+                             f"nếu Moodle có người dùng sau một khoảng trống lớn hơn, tăng max_empty_pages.")
+            if not processed_moodle_ids:
+                 return {'message': 'Không có người dùng nào từ Moodle để đồng bộ.' + walk_note, 'created_odoo_users': 0, 'updated_odoo_users': 0, 'created_moodle_users': 0, 'updated_moodle_users': 0, **page_walk}, 200
+            created_odoo_users_count = totals['created_odoo_users']
+            updated_odoo_users_count = totals['updated_odoo_users']
+            created_moodle_users_count = totals['created_moodle_users']
+            updated_moodle_users_count = totals['updated_moodle_users']
 
             summary_msg = (
                 f"Đồng bộ người dùng hoàn tất. "
                 f"Odoo Users: {created_odoo_users_count} tạo mới, {updated_odoo_users_count} cập nhật. "
                 f"Moodle App Users: {created_moodle_users_count} tạo mới, {updated_moodle_users_count} cập nhật."
+                f"{walk_note}"
             )
             _logger.info(summary_msg)
             config.set_param('digi_moodle_sync.last_users_sync_date', datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
             
-            return request.make_response(
-                json.dumps({
-                    'message': summary_msg, 
-                    'created_odoo_users': created_odoo_users_count, 'updated_odoo_users': updated_odoo_users_count,
-                    'created_moodle_users': created_moodle_users_count, 'updated_moodle_users': updated_moodle_users_count
-                }),
-                headers=[('Content-Type', 'application/json')])
+            return {
+                'message': summary_msg, 
+                'created_odoo_users': created_odoo_users_count, 'updated_odoo_users': updated_odoo_users_count,
+                'created_moodle_users': created_moodle_users_count, 'updated_moodle_users': updated_moodle_users_count,
+                **page_walk,
+            }, 200
 
         except requests.exceptions.Timeout as e_timeout:
             _logger.error("Timeout khi gọi Moodle API (core_user_get_users): %s", e_timeout)
-            return request.make_response(json.dumps({'error': 'Timeout khi kết nối Moodle API.'}), status=504, headers=[('Content-Type', 'application/json')])
+            return {'error': 'Timeout khi kết nối Moodle API.'}, 504
         except requests.exceptions.RequestException as e_req:
             _logger.error("Lỗi RequestException khi gọi Moodle API (core_user_get_users): %s", e_req)
-            return request.make_response(json.dumps({'error': f'Lỗi kết nối Moodle API: {e_req}'}), status=502, headers=[('Content-Type', 'application/json')])
+            return {'error': f'Lỗi kết nối Moodle API: {e_req}'}, 502
         except Exception as e_main:
             _logger.error("Lỗi không xác định trong quá trình đồng bộ người dùng: %s", e_main, exc_info=True)
-            return request.make_response(json.dumps({'error': f'Lỗi không xác định: {e_main}'}), status=500, headers=[('Content-Type', 'application/json')])
+            return {'error': f'Lỗi không xác định: {e_main}'}, 500
+
+    def _get_int_setting(self, env, kw, name, param_key, default):
+        value = kw.get(name)
+        if value in (None, ''):
+            value = env['ir.config_parameter'].sudo().get_param(param_key)
+        try:
+            return int(value) if value not in (None, False, '') else default
+        except (TypeError, ValueError):
+            _logger.warning(f"Giá trị {name} không hợp lệ: {value}, dùng {default}")
+            return default
+
+    def _get_known_max_moodle_id(self, env):
+        """Highest Moodle user id already stored in Odoo (0 when none)."""
+        known_ids = [0]
+        for model_name in ('res.users', 'moodle.user'):
+            record = env[model_name].sudo().with_context(active_test=False).search(
+                [('moodle_id', '!=', False)], order='moodle_id desc', limit=1)
+            known_ids.append(record.moodle_id or 0)
+        return max(known_ids)
+
+    def _iter_user_pages(self, client, cursor, page_size, max_empty_pages, known_max_id=0, page_walk=None):
+        """Yield the Moodle users of consecutive id ranges, one list per page.
+
+        Moodle has no paginated user listing nor a way to ask for its highest
+        user id, so pages are id ranges asked through
+        core_user_get_users_by_field. Deleted accounts leave gaps: up to
+        ``known_max_id`` (the highest id already synced) empty pages never
+        end the walk, past it the walk ends after ``max_empty_pages`` empty
+        ranges in a row. That stop is recorded in ``page_walk`` so a gap
+        wider than the limit does not truncate the directory silently.
+        """
+        empty_pages = 0
+        for first_id, last_id in cursor.id_ranges(page_size):
+            users = [
+                u for u in self._fetch_user_page(client, first_id, last_id)
+                if isinstance(u, dict) and first_id <= (u.get('id') or 0) <= last_id
+            ]
+            if not users:
+                if last_id < known_max_id:
+                    continue
+                empty_pages += 1
+                if empty_pages >= max_empty_pages:
+                    # Moodle không cho biết ID lớn nhất: đây là cách duy nhất để kết thúc, luôn ghi lại điểm dừng
+                    _logger.info(f"Kết thúc đồng bộ người dùng sau {empty_pages} trang rỗng liên tiếp tại Moodle ID {last_id} "
+                                 f"(ID lớn nhất đã biết: {known_max_id}); người dùng sau một khoảng trống lớn hơn sẽ không được đồng bộ.")
+                    if page_walk is not None:
+                        page_walk['stopped_on_empty_pages'] = last_id
+                    return
+                continue
+            empty_pages = 0
+            yield users
+
+    def _fetch_user_page(self, client, first_id, last_id):
+        """Users with ids in ``[first_id, last_id]``; a failing page is retried on its own."""
+        params = {'field': 'id'}
+        for index, moodle_id in enumerate(range(first_id, last_id + 1)):
+            params[f'values[{index}]'] = moodle_id
+        for attempt in range(USER_PAGE_RETRIES + 1):
+            try:
+                data = client.call('core_user_get_users_by_field', params, timeout=60)
+                if isinstance(data, dict) and 'exception' in data:
+                    raise ValueError(f"{data.get('message', 'Unknown error')} - Code: {data.get('errorcode', 'Unknown')}")
+                if not isinstance(data, list):
+                    raise ValueError(f"Phản hồi core_user_get_users_by_field không hợp lệ: {str(data)[:200]}")
+                return data
+            except (requests.exceptions.RequestException, ValueError) as e_page:
+                if attempt >= USER_PAGE_RETRIES:
+                    raise
+                _logger.warning(f"Lỗi tải trang người dùng ID {first_id}-{last_id} ({e_page}), thử lại {attempt + 1}/{USER_PAGE_RETRIES}")
+                time.sleep(2 ** attempt)
+
+    def _apply_users_batch(self, env, moodle_users_batch, processed_moodle_ids):
+        """Create/update res.users and moodle.user for one batch of API users.
+
+        ``processed_moodle_ids`` is shared by all batches of a run and
+        updated in place. Returns the created/updated counters of the batch.
+        """
+        ResUsers = env['res.users'].sudo()
+        MoodleAppUser = env['moodle.user'].sudo()
+        ResPartner = env['res.partner'].sudo()
+
+        # Prepare maps for existing records
+        all_moodle_ids_from_api = [u['id'] for u in moodle_users_batch if u.get('id')]
+
+        existing_odoo_users_by_moodle_id = {u.moodle_id: u for u in ResUsers.with_context(active_test=False).search([('moodle_id', 'in', all_moodle_ids_from_api)])}
+        
+        # Chỉ tra các email có trong lô (index lower(email)), không nạp toàn bộ res.users
+        existing_odoo_users_by_email = ResUsers._get_users_by_email([u.get('email') for u in moodle_users_batch])
+
+        existing_moodle_app_users_by_moodle_id = {mu.moodle_id: mu for mu in MoodleAppUser.search([('moodle_id', 'in', all_moodle_ids_from_api)])}
+        
+        odoo_users_to_create_vals = []
+        odoo_users_to_update_map = {} # {odoo_user_id: vals}
+        moodle_app_users_to_create_vals = []
+        moodle_app_users_to_update_map = {} # {moodle_app_user_id: vals}
+
+        for u_api in moodle_users_batch:
+            moodle_id = u_api.get('id')
+            email = u_api.get('email', '').lower().strip()
+            username = u_api.get('username', '')
+            fullname = u_api.get('fullname', username or email or f"Moodle User {moodle_id}")
+
+            if not moodle_id or not email:
+                _logger.warning(f"Bỏ qua user từ Moodle do thiếu Moodle ID ({moodle_id}) hoặc Email ({email}). Data: {u_api}")
+                continue
+            
+            if moodle_id in processed_moodle_ids:
+                _logger.debug(f"Moodle ID {moodle_id} đã được xử lý, bỏ qua trùng lặp từ API.")
+                continue
+            processed_moodle_ids.add(moodle_id)
+
+            odoo_user = None
+            # 1. Find Odoo User by Moodle ID first
+            if moodle_id in existing_odoo_users_by_moodle_id:
+                odoo_user = existing_odoo_users_by_moodle_id[moodle_id]
+            # 2. If not found, find by email
+            elif email in existing_odoo_users_by_email:
+                odoo_user = existing_odoo_users_by_email[email]
+                if not odoo_user.active:
+                    # Tài khoản đã lưu trữ: dùng lại (không kích hoạt lại) thay vì tạo login trùng
+                    _logger.info(f"Moodle ID {moodle_id} khớp người dùng đã lưu trữ {odoo_user.login} (ID {odoo_user.id}), cập nhật nhưng không kích hoạt lại.")
+                # Link Moodle ID if found by email and not yet linked
+                if odoo_user and not odoo_user.moodle_id:
+                    odoo_users_to_update_map.setdefault(odoo_user.id, {}).update({'moodle_id': moodle_id})
+            
+            # Prepare Odoo User vals
+            odoo_user_update_vals = {
+                'name': fullname,
+                'login': odoo_user.login if odoo_user and odoo_user.login else email, # Keep existing login if user exists
+                'email': email,
+                'moodle_id': moodle_id # Ensure Moodle ID is set/updated
+            }
+
+            if odoo_user:
+                # Check for changes before adding to update map
+                current_vals = {k: odoo_user[k] for k in odoo_user_update_vals.keys() if k in odoo_user}
+                if any(odoo_user_update_vals[k] != current_vals.get(k) for k in odoo_user_update_vals):
+                    odoo_users_to_update_map.setdefault(odoo_user.id, {}).update(odoo_user_update_vals)
+            else:
+                # Create new Partner first for the new Odoo User
+                partner_vals = {
+                    'name': fullname,
+                    'email': email,
+                    'company_id': env.company.id, # Ensure company context
+                }
+                # We will create partner along with user to ensure atomicity if possible or handle failure
+                odoo_user_create_val = dict(odoo_user_update_vals)
+                odoo_user_create_val['partner_vals_for_creation'] = partner_vals # Temp store for batch creation
+                odoo_users_to_create_vals.append(odoo_user_create_val)
+
+            # Prepare Moodle App User (moodle.user) vals
+            moodle_app_user_vals = {
+                'name': fullname,
+                'login': username or email, # Moodle username might be different from email
+                'email': email,
+                'moodle_id': moodle_id,
+                'odoo_user_id': odoo_user.id if odoo_user else None, # Link later if Odoo user is created
+                'last_sync_date': datetime.now(),
+            }
+            if moodle_id in existing_moodle_app_users_by_moodle_id:
+                mu_record = existing_moodle_app_users_by_moodle_id[moodle_id]
+                current_mu_vals = {k: mu_record[k] for k in moodle_app_user_vals.keys() if k in mu_record}
+                if any(moodle_app_user_vals[k] != current_mu_vals.get(k) for k in moodle_app_user_vals):
+                    moodle_app_users_to_update_map.setdefault(mu_record.id, {}).update(moodle_app_user_vals)
+            else:
+                moodle_app_users_to_create_vals.append(moodle_app_user_vals)
+
+        # Batch Create Odoo Users (res.users)
+        created_odoo_users_count = 0
+        newly_created_odoo_users_map_by_moodle_id = {}
+        if odoo_users_to_create_vals:
+            # Tạo partner và user theo lô, tắt các tác vụ phụ (email mời đặt mật khẩu, follower, tracking).
+            # Mỗi lô chạy trong savepoint; lô lỗi được chia đôi để chỉ bỏ đúng user lỗi (vd. login trùng).
+            user_create_vals_by_moodle_id = {vals['moodle_id']: vals for vals in odoo_users_to_create_vals}
+
+            def create_users(moodle_ids):
+                partner_vals_list = [user_create_vals_by_moodle_id[mid]['partner_vals_for_creation'] for mid in moodle_ids]
+                partners = ResPartner.with_context(**USER_PROVISIONING_CONTEXT).create(partner_vals_list)
+                user_vals_list = []
+                for moodle_id, partner in zip(moodle_ids, partners):
+                    company_id = partner.company_id.id or env.company.id
+                    user_vals = {k: v for k, v in user_create_vals_by_moodle_id[moodle_id].items() if k != 'partner_vals_for_creation'}
+                    user_vals.update({
+                        'partner_id': partner.id,
+                        'company_id': company_id,
+                        'company_ids': [(6, 0, [company_id])],
+                    })
+                    user_vals_list.append(user_vals)
+                return ResUsers.with_context(**USER_PROVISIONING_CONTEXT).create(user_vals_list)
+
+            def remember_users(created_odoo_users):
+                for nou in created_odoo_users:
+                    newly_created_odoo_users_map_by_moodle_id[nou.moodle_id] = nou
+
+            failed_users = {}
+            created_odoo_users_count = _apply_isolated(env, list(user_create_vals_by_moodle_id), create_users, failed_users, remember_users)
+            for moodle_id, error in failed_users.items():
+                _logger.error(f"Không thể tạo Odoo User cho Moodle ID {moodle_id}. Lỗi: {error}")
+            _logger.debug(f"Batch created {created_odoo_users_count} res.users.")
+
+        # Update Odoo User references in Moodle App User creation list (chỉ user đã tạo được)
+        for mu_create_val in moodle_app_users_to_create_vals:
+            if not mu_create_val.get('odoo_user_id') and mu_create_val.get('moodle_id') in newly_created_odoo_users_map_by_moodle_id:
+                mu_create_val['odoo_user_id'] = newly_created_odoo_users_map_by_moodle_id[mu_create_val['moodle_id']].id
+        
+        # Batch Create Moodle App Users (moodle.user)
+        created_moodle_users_count = 0
+        if moodle_app_users_to_create_vals:
+            moodle_user_create_vals_by_moodle_id = {vals['moodle_id']: vals for vals in moodle_app_users_to_create_vals}
+            failed_moodle_users = {}
+            created_moodle_users_count = _apply_isolated(
+                env, list(moodle_user_create_vals_by_moodle_id),
+                lambda moodle_ids: MoodleAppUser.create([moodle_user_create_vals_by_moodle_id[mid] for mid in moodle_ids]),
+                failed_moodle_users)
+            for moodle_id, error in failed_moodle_users.items():
+                _logger.error(f"Lỗi tạo moodle.user cho Moodle ID {moodle_id}: {error}")
+            _logger.debug(f"Batch created {created_moodle_users_count} moodle.user records.")
+
+        # Batch Update Odoo Users: gom các bản ghi cùng giá trị, lỗi chỉ bỏ qua đúng bản ghi lỗi
+        user_write_result = bulk_write(env, 'res.users', odoo_users_to_update_map)
+        updated_odoo_users_count = user_write_result['updated']
+        for user_id, error in user_write_result['failed'].items():
+            _logger.error(f"Lỗi cập nhật res.users ID {user_id}: {error}")
+
+        # Update Odoo User references in Moodle App User update list
+        for mu_update_vals in moodle_app_users_to_update_map.values():
+             if not mu_update_vals.get('odoo_user_id') and mu_update_vals.get('moodle_id') in newly_created_odoo_users_map_by_moodle_id:
+                mu_update_vals['odoo_user_id'] = newly_created_odoo_users_map_by_moodle_id[mu_update_vals['moodle_id']].id
+             elif not mu_update_vals.get('odoo_user_id') and mu_update_vals.get('moodle_id') in existing_odoo_users_by_moodle_id:
+                 mu_update_vals['odoo_user_id'] = existing_odoo_users_by_moodle_id[mu_update_vals['moodle_id']].id
+
+        # Batch Update Moodle App Users
+        moodle_user_write_result = bulk_write(env, 'moodle.user', moodle_app_users_to_update_map)
+        updated_moodle_users_count = moodle_user_write_result['updated']
+        for mu_id, error in moodle_user_write_result['failed'].items():
+            _logger.error(f"Lỗi cập nhật moodle.user ID {mu_id}: {error}")
+
+        return {
+            'created_odoo_users': created_odoo_users_count,
+            'updated_odoo_users': updated_odoo_users_count,
+            'created_moodle_users': created_moodle_users_count,
+            'updated_moodle_users': updated_moodle_users_count,
+        }
 
 # Make sure __init__.py imports this controller
 # from . import users_sync
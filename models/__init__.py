@@ -9,4 +9,5 @@ from . import moodle_assignment
 from . import moodle_assignment_submission
 from . import moodle_course_teacher
 from . import moodle_activity_progress
-from . import res_users
\ No newline at end of file
+from . import res_users
+from . import moodle_sync_job
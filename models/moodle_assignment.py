@@ -11,6 +11,8 @@ class MoodleAssignment(models.Model):
     course_id = fields.Many2one('moodle.course', string='Course', required=True, index=True)
     submission_ids = fields.One2many('moodle.assignment.submission', 'assignment_id', string='Submissions')
     last_sync_date = fields.Datetime("Last Synced")
+    submissions_synced_until = fields.Datetime('Submissions Synced Until', readonly=True,
+                                               help="Bài nộp sửa sau mốc này được tải ở lần đồng bộ sau (tham số since của mod_assign_get_submissions)")
 
     _sql_constraints = [
         ('unique_moodle_assignment', 
@@ -1,7 +1,7 @@
 # -*- coding: utf-8 -*-
 import logging
-import requests
 from odoo import models, fields, api, _
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
 
 _logger = logging.getLogger(__name__)
 
@@ -14,6 +14,12 @@ class MoodleCourse(models.Model):
     moodle_id = fields.Integer('ID Moodle', index=True)
     active = fields.Boolean('Kích hoạt', default=True)
     last_sync_date = fields.Datetime('Lần đồng bộ cuối', readonly=True)
+    grades_synced_until = fields.Datetime('Điểm đã đồng bộ đến', readonly=True,
+                                          help="Mốc thời gian của lần đồng bộ điểm thành công gần nhất, dùng cho chế độ đồng bộ tăng dần")
+    roster_data = fields.Text('Danh sách ghi danh', readonly=True, prefetch=False,
+                              help="Bản lưu danh sách ghi danh Moodle (JSON) khi bật lưu cache danh sách ghi danh")
+    roster_hash = fields.Char('Mã băm danh sách ghi danh', readonly=True)
+    roster_fetched_at = fields.Datetime('Tải danh sách ghi danh lúc', readonly=True)
 
     _sql_constraints = [
         ('unique_moodle_id',
@@ -42,17 +48,11 @@ class MoodleCourse(models.Model):
     @api.model
     def test_moodle_connection(self):
         """Kiểm tra kết nối tới Moodle"""
-        config = self.env['ir.config_parameter'].sudo()
-        url   = config.get_param('digi_moodle_sync.moodle_url')
-        token = config.get_param('digi_moodle_sync.token')
-        if not url or not token:
+        client = MoodleClient.from_env(self.env)
+        if not client.is_configured:
             return {'status':'error','message':_('Thiếu URL hoặc Token')}
         try:
-            res = requests.get(url, params={
-                'wstoken':token,
-                'wsfunction':'core_webservice_get_site_info',
-                'moodlewsrestformat':'json'
-            }, timeout=10)
+            res = client.request('core_webservice_get_site_info', timeout=10)
             res.raise_for_status()
             info = res.json()
             return {'status':'success',
@@ -2,6 +2,7 @@
 import json
 from odoo import models, fields, api, _
 from datetime import datetime
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
 
 class MoodleDashboard(models.TransientModel):
     _name = 'moodle.dashboard'
@@ -75,8 +76,6 @@ class MoodleDashboard(models.TransientModel):
         return self.env["ir.actions.actions"]._for_xml_id("digi_moodle_sync.action_moodle_user_grade")
     
     def action_test_connection(self):
-        import requests
-        
         config = self.env['ir.config_parameter'].sudo()
         moodle_url = config.get_param('digi_moodle_sync.moodle_url')
         token = config.get_param('digi_moodle_sync.token')
@@ -93,20 +92,11 @@ class MoodleDashboard(models.TransientModel):
                 }
             }
         
-        # Thêm /webservice/rest/server.php vào URL
-        api_url = moodle_url
-        if not api_url.endswith('/'):
-            api_url += '/'
-        api_url += 'webservice/rest/server.php'
-        
-        params = {
-            'wstoken': token,
-            'wsfunction': 'core_webservice_get_site_info',
-            'moodlewsrestformat': 'json'
-        }
+        # MoodleClient tự thêm /webservice/rest/server.php vào URL
+        client = MoodleClient.from_env(self.env)
         
         try:
-            resp = requests.get(api_url, params=params, timeout=10)
+            resp = client.request('core_webservice_get_site_info', timeout=10)
             resp.raise_for_status()
             data = resp.json()
             
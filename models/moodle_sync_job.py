@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import time
+from datetime import timedelta
+
+from odoo import api, fields, models, _
+from odoo.tools import config as odoo_config
+from odoo.addons.digi_moodle_sync.tools.sync_cursor import SyncCursor
+from odoo.addons.digi_moodle_sync.tools.metrics import CallStats, collect
+
+_logger = logging.getLogger(__name__)
+
+RUNNER_CRON_XMLID = 'digi_moodle_sync.ir_cron_moodle_sync_job_runner'
+
+# Thứ tự phụ thuộc của pipeline định kỳ: khóa học, người dùng, ghi danh/điểm,
+# bài tập/bài nộp, rồi tiến độ và giảng viên
+PIPELINE_STAGES = ['courses', 'users', 'courses_grades', 'assignments', 'progress', 'teachers']
+
+# Phần thời gian giới hạn của worker cron được dùng cho một lượt chạy
+CRON_TIME_BUDGET_RATIO = 0.75
+DEFAULT_CRON_TIME_BUDGET = 90
+# Job dừng giữa chừng được chạy tiếp sau khoảng nghỉ này
+RESUME_DELAY_SECONDS = 60
+# Gọi lại cùng một đồng bộ trong khoảng này sẽ chạy tiếp job lỗi từ điểm đã lưu
+RESUMABLE_HOURS = 24
+# Job bị ngắt (worker bị kill) quá số lần này thì chuyển sang lỗi thay vì chạy lại mãi
+MAX_INTERRUPTED_ATTEMPTS = 3
+
+
+class MoodleSyncJob(models.Model):
+    """A sync run queued by an endpoint or the wizard and executed by cron.
+
+    The HTTP request only creates the job and triggers the runner cron, so
+    long syncs are no longer bound by browser, proxy or worker time limits.
+    """
+    _name = 'moodle.sync.job'
+    _description = 'Moodle Sync Job'
+    _order = 'id desc'
+
+    name = fields.Char('Tên', required=True)
+    job_type = fields.Selection([
+        ('pipeline', 'Pipeline định kỳ'),
+        ('courses', 'Khóa học'),
+        ('users', 'Người dùng'),
+        ('courses_grades', 'Khóa học & điểm'),
+        ('user_grades', 'Khóa học & điểm của một người dùng'),
+        ('progress', 'Tiến độ hoạt động'),
+        ('assignments', 'Bài tập & bài nộp'),
+        ('teachers', 'Giảng viên'),
+        ('wizard', 'Wizard đồng bộ'),
+    ], string='Loại', required=True)
+    params = fields.Text('Tham số', default='{}', help="Tham số JSON truyền cho hàm đồng bộ")
+    state = fields.Selection([
+        ('queued', 'Chờ chạy'),
+        ('running', 'Đang chạy'),
+        ('done', 'Hoàn tất'),
+        ('failed', 'Lỗi'),
+    ], string='Trạng thái', default='queued', required=True, index=True)
+    user_id = fields.Many2one('res.users', 'Người tạo', default=lambda self: self.env.user, readonly=True)
+    progress_done = fields.Integer('Đã xử lý', readonly=True)
+    progress_total = fields.Integer('Tổng số', readonly=True)
+    result = fields.Text('Kết quả', readonly=True)
+    error = fields.Text('Lỗi', readonly=True)
+    date_started = fields.Datetime('Bắt đầu', readonly=True)
+    date_finished = fields.Datetime('Kết thúc', readonly=True)
+    stage = fields.Char('Bước hiện tại', readonly=True, help="Bước pipeline đang chạy hoặc sẽ chạy tiếp")
+    cursor_state = fields.Text('Điểm tiếp tục', readonly=True, help="Vị trí dừng (JSON) khi job hết thời gian của lượt cron")
+    interrupted_count = fields.Integer('Số lần bị ngắt', readonly=True,
+                                       help="Số lượt chạy liên tiếp bị ngắt giữa chừng (worker bị kill)")
+    run_seconds = fields.Float('Thời gian chạy (giây)', readonly=True, help="Tổng thời gian chạy qua mọi lượt cron")
+    api_call_count = fields.Integer('Số lần gọi Moodle', readonly=True)
+    api_call_seconds = fields.Float('Thời gian gọi Moodle (giây)', readonly=True,
+                                    help="Tổng thời gian các lần gọi Moodle, kể cả thử lại; các lần gọi song song được cộng dồn")
+    api_stats = fields.Text('Thống kê gọi Moodle', readonly=True, help="Histogram thời gian gọi theo wsfunction (JSON)")
+    api_stats_display = fields.Text('Theo wsfunction', compute='_compute_api_stats_display')
+
+    @api.model
+    def enqueue(self, job_type, params=None, name=None):
+        """Create a queued job and wake the runner cron up.
+
+        A recent failed job of the same type and params that left a
+        checkpoint is queued again instead, so it continues where it died.
+        """
+        params = json.dumps(params or {}, sort_keys=True)
+        job = self.search([
+            ('job_type', '=', job_type),
+            ('params', '=', params),
+            ('state', '=', 'failed'),
+            '|', ('cursor_state', '!=', False), ('stage', '!=', False),
+            ('create_date', '>=', fields.Datetime.now() - timedelta(hours=RESUMABLE_HOURS)),
+        ], limit=1)
+        if job:
+            job.write({'state': 'queued', 'error': False, 'date_finished': False, 'interrupted_count': 0})
+            _logger.info(f"Moodle sync job {job.id} ({job_type}) resumed from its checkpoint by {self.env.user.login}")
+        else:
+            job = self.create({
+                'name': name or dict(self._fields['job_type'].selection).get(job_type, job_type),
+                'job_type': job_type,
+                'params': params,
+            })
+            _logger.info(f"Moodle sync job {job.id} ({job_type}) queued by {self.env.user.login}")
+        self.env.ref(RUNNER_CRON_XMLID)._trigger()
+        return job
+
+    @api.depends('api_stats')
+    def _compute_api_stats_display(self):
+        for job in self:
+            lines = []
+            for wsfunction, stats in CallStats.from_json(job.api_stats).summary().items():
+                lines.append(
+                    f"{wsfunction}: {stats['calls']} lần, {stats['seconds']:.1f}s, "
+                    f"p50 {stats['p50']:.2f}s / p95 {stats['p95']:.2f}s / p99 {stats['p99']:.2f}s, "
+                    f"lỗi {stats['errors']}, thử lại {stats['retries']}, {stats['bytes'] / 1024:.0f} KB"
+                )
+            job.api_stats_display = '\n'.join(lines) or False
+
+    def action_retry(self):
+        """Queue failed jobs again; they continue from their last checkpoint."""
+        self.filtered(lambda job: job.state == 'failed').write({
+            'state': 'queued', 'error': False, 'date_finished': False, 'interrupted_count': 0,
+        })
+        self.env.ref(RUNNER_CRON_XMLID)._trigger()
+
+    def get_status(self):
+        self.ensure_one()
+        return {
+            'job_id': self.id,
+            'job_type': self.job_type,
+            'state': self.state,
+            'stage': self.stage or None,
+            'progress_done': self.progress_done,
+            'progress_total': self.progress_total,
+            'date_started': fields.Datetime.to_string(self.date_started) if self.date_started else None,
+            'date_finished': fields.Datetime.to_string(self.date_finished) if self.date_finished else None,
+            'result': json.loads(self.result) if self.result else None,
+            'error': self.error or None,
+            'run_seconds': round(self.run_seconds, 3),
+            'api_calls': CallStats.from_json(self.api_stats).summary(),
+        }
+
+    @api.model
+    def _get_time_budget(self):
+        """Seconds one cron tick may spend on jobs.
+
+        ``digi_moodle_sync.cron_time_budget`` wins; otherwise a share of the
+        server's cron (or HTTP worker) real time limit.
+        """
+        value = self.env['ir.config_parameter'].sudo().get_param('digi_moodle_sync.cron_time_budget')
+        try:
+            if value and int(value) > 0:
+                return int(value)
+        except (TypeError, ValueError):
+            _logger.warning(f"Invalid digi_moodle_sync.cron_time_budget '{value}', using the worker limit")
+        limit = odoo_config.get('limit_time_real_cron') or 0
+        if limit <= 0:
+            limit = odoo_config.get('limit_time_real') or 0
+        return int(limit * CRON_TIME_BUDGET_RATIO) if limit > 0 else DEFAULT_CRON_TIME_BUDGET
+
+    @api.model
+    def _cron_enqueue_pipeline(self):
+        """Scheduled entry point: queue a pipeline run unless one is pending."""
+        if self.search_count([('job_type', '=', 'pipeline'), ('state', 'in', ('queued', 'running'))]):
+            _logger.info("Moodle sync pipeline already queued or running, skipping this schedule")
+            return
+        self.enqueue('pipeline', name=_("Pipeline đồng bộ định kỳ"))
+
+    @api.model
+    def _cron_run_queued_jobs(self, limit=10):
+        """Run queued jobs one after the other, each in its own transaction.
+
+        The tick stops taking new jobs once its time budget is spent, and the
+        same budget is handed to each job so long syncs stop between chunks
+        and are resumed by a later tick instead of hitting the worker limit.
+        """
+        deadline = time.monotonic() + self._get_time_budget()
+        self._requeue_interrupted_jobs()
+        ran_ids = []
+        for _i in range(limit):
+            if time.monotonic() >= deadline:
+                return
+            self.env.cr.execute("""
+                SELECT id FROM moodle_sync_job
+                 WHERE state = 'queued' AND NOT (id = ANY(%s))
+                 ORDER BY id
+                 LIMIT 1
+                 FOR UPDATE SKIP LOCKED
+            """, [ran_ids])
+            row = self.env.cr.fetchone()
+            if not row:
+                return
+            job = self.browse(row[0])
+            ran_ids.append(job.id)
+            job.write({
+                'state': 'running',
+                'date_started': job.date_started or fields.Datetime.now(),
+                'progress_done': 0,
+                'progress_total': 0,
+            })
+            self.env.cr.commit()
+            job._run(deadline=deadline, checkpoint=True)
+            self.env.cr.commit()
+
+    @api.model
+    def _requeue_interrupted_jobs(self):
+        """Queue again jobs left 'running' by a worker that was killed.
+
+        Runner ticks never overlap (the cron row stays locked while a tick
+        runs), so a job still marked running when a tick starts is dead.
+        It resumes from its last committed checkpoint, unless it was already
+        killed MAX_INTERRUPTED_ATTEMPTS times in a row: a job that keeps
+        crashing the worker (memory, hard time limit) is marked failed and
+        keeps its checkpoint for a manual retry.
+        """
+        jobs = self.search([('state', '=', 'running')])
+        if not jobs:
+            return
+        for job in jobs:
+            attempts = job.interrupted_count + 1
+            if attempts >= MAX_INTERRUPTED_ATTEMPTS:
+                _logger.error(f"Moodle sync job {job.id} was interrupted {attempts} times in a row, giving up")
+                job.write({
+                    'state': 'failed',
+                    'interrupted_count': attempts,
+                    'error': _("Job bị ngắt giữa chừng %s lần liên tiếp") % attempts,
+                    'date_finished': fields.Datetime.now(),
+                })
+            else:
+                _logger.warning(f"Moodle sync job {job.id} was interrupted ({attempts}/{MAX_INTERRUPTED_ATTEMPTS}), "
+                                f"resuming it from its checkpoint")
+                job.write({'state': 'queued', 'interrupted_count': attempts})
+        self.env.cr.commit()
+
+    def _run(self, deadline=None, checkpoint=False):
+        """Run the job handler.
+
+        With ``checkpoint`` the cursor is stored and the transaction committed
+        after every completed chunk, so a crash only loses the current chunk.
+        """
+        self.ensure_one()
+        cursor = SyncCursor.from_state(self.cursor_state, deadline=deadline,
+                                       on_checkpoint=self._checkpoint if checkpoint else None)
+        handler = self._get_job_handlers().get(self.job_type)
+        call_stats = CallStats()
+        started_at = time.monotonic()
+        try:
+            with collect(call_stats):
+                if self.job_type == 'pipeline':
+                    payload, status = self._run_pipeline(cursor)
+                elif not handler:
+                    raise ValueError(_("Không có hàm xử lý cho loại job %s") % self.job_type)
+                else:
+                    params = json.loads(self.params or '{}')
+                    payload, status = handler(self.env, params, self._report_progress, cursor)
+        except Exception as e:
+            _logger.error(f"Moodle sync job {self.id} ({self.job_type}) failed: {e}", exc_info=True)
+            self.env.cr.rollback()
+            self.write({
+                'state': 'failed',
+                'error': str(e),
+                'date_finished': fields.Datetime.now(),
+                'interrupted_count': 0,
+                **self._run_stats_vals(call_stats, started_at),
+            })
+            return
+        if cursor.interrupted:
+            self.write({
+                'state': 'queued',
+                'cursor_state': cursor.to_state(),
+                'result': json.dumps(payload, ensure_ascii=False),
+                'interrupted_count': 0,
+                **self._run_stats_vals(call_stats, started_at),
+            })
+            self.env.ref(RUNNER_CRON_XMLID)._trigger(at=fields.Datetime.now() + timedelta(seconds=RESUME_DELAY_SECONDS))
+            _logger.info(f"Moodle sync job {self.id} ({self.job_type}) paused at {self.stage or self.job_type}, resuming in a later tick")
+            return
+        # Một số hàm đồng bộ báo lỗi cấu hình bằng {'error': ...} kèm status 200
+        error = payload.get('error') if isinstance(payload, dict) else None
+        failed = status >= 400 or bool(error)
+        vals = {
+            'state': 'failed' if failed else 'done',
+            'result': json.dumps(payload, ensure_ascii=False),
+            'error': error,
+            'date_finished': fields.Datetime.now(),
+            'interrupted_count': 0,
+            **self._run_stats_vals(call_stats, started_at),
+        }
+        if not failed:
+            vals.update(stage=False, cursor_state=False)
+        elif self.job_type == 'pipeline':
+            # Chạy lại pipeline lỗi bắt đầu từ bước lỗi đầu tiên, không phải bước cuối
+            failed_stages = [stage for stage, stage_payload in payload.get('stages', {}).items()
+                             if isinstance(stage_payload, dict) and stage_payload.get('error')]
+            if failed_stages:
+                vals['stage'] = min(failed_stages, key=PIPELINE_STAGES.index)
+        self.write(vals)
+
+    def _run_stats_vals(self, call_stats, started_at):
+        """Add the Moodle calls and wall time of this run to the job's totals."""
+        total = CallStats.from_json(self.api_stats).merge(call_stats)
+        elapsed = time.monotonic() - started_at
+        _logger.info(
+            f"Moodle sync job {self.id}: {elapsed:.1f}s, {call_stats.total_calls} Moodle calls "
+            f"({call_stats.total_seconds:.1f}s); slowest: {next(iter(call_stats.summary().items()), None)}")
+        return {
+            'run_seconds': self.run_seconds + elapsed,
+            'api_call_count': total.total_calls,
+            'api_call_seconds': total.total_seconds,
+            'api_stats': total.to_json(),
+        }
+
+    def _checkpoint(self, cursor):
+        self.write({'cursor_state': cursor.to_state()})
+        self.env.cr.commit()
+
+    def _run_pipeline(self, cursor):
+        """Run PIPELINE_STAGES in order from ``stage``; returns ``(payload, http_status)``.
+
+        Each stage shares the tick deadline through ``cursor``. A stage that
+        runs out of time leaves ``stage`` and the cursor on the job so the
+        next tick picks up exactly there. A failed stage does not stop the
+        later ones, which still work on the data already in Odoo.
+        """
+        handlers = self._get_job_handlers()
+        previous = json.loads(self.result or '{}') if self.stage else {}
+        stage_results = previous.get('stages', {})
+        start = PIPELINE_STAGES.index(self.stage) if self.stage in PIPELINE_STAGES else 0
+        for stage in PIPELINE_STAGES[start:]:
+            self.write({'stage': stage})
+            if cursor.on_checkpoint:
+                # Commit ngay: nếu để treo, savepoint đầu tiên của bước sẽ flush lệnh ghi này
+                # và giữ khoá dòng job trong khi _report_progress cập nhật dòng đó từ cursor khác
+                self.env.cr.commit()
+            if cursor.expired():
+                cursor.interrupted = True
+                break
+            payload, status = handlers[stage](self.env, {}, self._report_progress, cursor)
+            if status >= 400 and not (isinstance(payload, dict) and payload.get('error')):
+                payload = dict(payload, error=f'HTTP {status}')
+            stage_results[stage] = payload
+            if cursor.interrupted:
+                break
+            cursor.restart()
+            # Giữ kết quả của bước đã xong dù bước sau có lỗi hoặc worker bị kill
+            next_index = PIPELINE_STAGES.index(stage) + 1
+            self.write({
+                'stage': PIPELINE_STAGES[next_index] if next_index < len(PIPELINE_STAGES) else stage,
+                'result': json.dumps({'stages': stage_results}, ensure_ascii=False),
+                'cursor_state': False,
+            })
+            if cursor.on_checkpoint:
+                self.env.cr.commit()
+
+        result = {'stages': stage_results}
+        failed = [stage for stage, payload in stage_results.items() if isinstance(payload, dict) and payload.get('error')]
+        if failed and not cursor.interrupted:
+            result['error'] = _("Các bước lỗi: %s") % ', '.join(failed)
+        return result, 200
+
+    def _report_progress(self, done, total=None):
+        """Publish progress counters right away through a separate cursor.
+
+        The sync itself stays in the job transaction; only the counters are
+        committed so the status endpoint can show them while the job runs.
+        When the job transaction itself holds the row lock (an uncommitted
+        write to the job, e.g. an inline run without checkpoints), waiting
+        for it would deadlock: the counters are then written in the job
+        transaction instead.
+        """
+        vals = {'progress_done': done}
+        if total is not None:
+            vals['progress_total'] = total
+        with self.pool.cursor() as cr:
+            cr.execute("SELECT id FROM moodle_sync_job WHERE id = %s FOR UPDATE SKIP LOCKED", [self.id])
+            if cr.fetchone():
+                cr.execute(
+                    "UPDATE moodle_sync_job SET " + ", ".join(f"{fname} = %s" for fname in vals) + " WHERE id = %s",
+                    list(vals.values()) + [self.id])
+                return
+        self.write(vals)
+
+    @api.model
+    def _get_job_handlers(self):
+        """Map job_type to ``handler(env, params, progress, cursor) -> (payload, http_status)``."""
+        from odoo.addons.digi_moodle_sync.controllers.courses import MoodleCourseController
+        from odoo.addons.digi_moodle_sync.controllers.users_sync import MoodleUserSyncController
+        from odoo.addons.digi_moodle_sync.controllers.courses_grades_sync import MoodleCourseGradeSyncController
+        from odoo.addons.digi_moodle_sync.controllers.progress_sync import MoodleProgressSync
+        from odoo.addons.digi_moodle_sync.controllers.assignments_sync import MoodleAssignmentSync
+        from odoo.addons.digi_moodle_sync.controllers.teacher_sync import MoodleTeacherSync
+        return {
+            'courses': lambda env, params, progress, cursor: MoodleCourseController()._sync_courses(env, progress=progress, cursor=cursor, **params),
+            'users': lambda env, params, progress, cursor: MoodleUserSyncController()._sync_users(env, progress=progress, cursor=cursor, **params),
+            'courses_grades': lambda env, params, progress, cursor: MoodleCourseGradeSyncController()._sync_all(env, progress=progress, cursor=cursor, **params),
+            'user_grades': lambda env, params, progress, cursor: MoodleCourseGradeSyncController()._sync_one(env, cursor=cursor, **params),
+            'progress': lambda env, params, progress, cursor: MoodleProgressSync()._sync_progress(env, progress=progress, cursor=cursor, **params),
+            'assignments': lambda env, params, progress, cursor: MoodleAssignmentSync()._sync_assignments(env, progress=progress, cursor=cursor, **params),
+            'teachers': lambda env, params, progress, cursor: MoodleTeacherSync()._sync_teachers(env, progress=progress, cursor=cursor, **params),
+            'wizard': lambda env, params, progress, cursor: env['moodle.sync.wizard'].create(params)._run_sync(progress=progress, cursor=cursor),
+        }
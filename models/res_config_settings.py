@@ -13,3 +13,114 @@ class ResConfigSettings(models.TransientModel):
         string='Token Moodle',
         config_parameter='digi_moodle_sync.token'
     )
+    moodle_http_timeout = fields.Integer(
+        string='Timeout mỗi lần gọi (giây)',
+        config_parameter='digi_moodle_sync.http_timeout',
+        default=30
+    )
+    moodle_http_pool_size = fields.Integer(
+        string='Số kết nối giữ sẵn',
+        config_parameter='digi_moodle_sync.http_pool_size',
+        default=10,
+        help="Số kết nối keep-alive tối đa tới Moodle trên mỗi worker"
+    )
+    moodle_http_max_retries = fields.Integer(
+        string='Số lần thử lại',
+        config_parameter='digi_moodle_sync.http_max_retries',
+        default=3,
+        help="Số lần gửi lại khi lỗi kết nối, timeout hoặc HTTP 429/5xx"
+    )
+    moodle_http_backoff_factor = fields.Float(
+        string='Hệ số chờ giữa các lần thử (giây)',
+        config_parameter='digi_moodle_sync.http_backoff_factor',
+        default=0.5,
+        help="Thời gian chờ lần thứ n = hệ số x 2^n"
+    )
+    moodle_fetch_concurrency = fields.Integer(
+        string='Số luồng tải song song',
+        config_parameter='digi_moodle_sync.fetch_concurrency',
+        default=4,
+        help="Số request Moodle chạy đồng thời khi đồng bộ hàng loạt. Ghi dữ liệu vào Odoo vẫn tuần tự."
+    )
+    moodle_rate_limit = fields.Float(
+        string='Số request tối đa mỗi giây',
+        config_parameter='digi_moodle_sync.rate_limit',
+        default=20,
+        help="Giới hạn số lần gọi Moodle mỗi giây trên mỗi worker. 0 để không giới hạn."
+    )
+    moodle_max_concurrency = fields.Integer(
+        string='Số request đồng thời tối đa',
+        config_parameter='digi_moodle_sync.max_concurrency',
+        default=8,
+        help="Số request Moodle chạy cùng lúc được tự giảm một nửa khi Moodle trả về 429/503, lỗi hoặc trả lời chậm, rồi tăng dần lại tới giới hạn này khi Moodle trả lời nhanh."
+    )
+    moodle_target_latency = fields.Float(
+        string='Thời gian phản hồi mục tiêu (giây)',
+        config_parameter='digi_moodle_sync.target_latency',
+        default=5,
+        help="Request chậm hơn mức này được coi là Moodle đang quá tải. 0 để bỏ qua thời gian phản hồi."
+    )
+    moodle_grade_sync_mode = fields.Selection([
+        ('user', 'Theo người dùng'),
+        ('course', 'Theo khóa học'),
+    ], string='Chế độ đồng bộ điểm',
+        config_parameter='digi_moodle_sync.grade_sync_mode',
+        default='user',
+        help="Theo khóa học: một lần gọi báo cáo điểm cho mỗi khóa học thay vì mỗi cặp người dùng x khóa học"
+    )
+    moodle_grade_sync_incremental = fields.Boolean(
+        string='Đồng bộ điểm tăng dần',
+        config_parameter='digi_moodle_sync.grade_sync_incremental',
+        help="Chỉ tải lại các khóa học có thay đổi kể từ lần đồng bộ điểm thành công gần nhất. Thêm full=1 vào URL để đồng bộ toàn bộ."
+    )
+    moodle_cron_time_budget = fields.Integer(
+        string='Thời gian tối đa mỗi lượt cron (giây)',
+        config_parameter='digi_moodle_sync.cron_time_budget',
+        help="Job đồng bộ dừng giữa các nhóm bản ghi khi hết thời gian và chạy tiếp ở lượt sau. Để 0 để dùng 75% giới hạn thời gian của worker."
+    )
+    moodle_roster_cache_ttl = fields.Integer(
+        string='Thời gian cache danh sách ghi danh (giây)',
+        config_parameter='digi_moodle_sync.roster_cache_ttl',
+        default=600,
+        help="Đồng bộ tiến độ và wizard dùng chung danh sách ghi danh của mỗi khóa học trong khoảng này. 0 để tắt. Đồng bộ giảng viên không dùng cache này."
+    )
+    moodle_roster_cache_persist = fields.Boolean(
+        string='Lưu cache danh sách ghi danh',
+        config_parameter='digi_moodle_sync.roster_cache_persist',
+        help="Lưu danh sách ghi danh và mã băm vào khóa học để worker khác và lần chạy sau dùng lại; chỉ ghi lại khi mã băm thay đổi."
+    )
+    moodle_user_sync_page_size = fields.Integer(
+        string='Số ID mỗi trang người dùng',
+        config_parameter='digi_moodle_sync.user_sync_page_size',
+        default=200,
+        help="Đồng bộ người dùng theo từng khoảng ID, mỗi trang được ghi và commit riêng. 0 để tải cả danh bạ trong một lần gọi (đọc dạng stream)."
+    )
+    moodle_metrics_token = fields.Char(
+        string='Token trang metrics',
+        config_parameter='digi_moodle_sync.metrics_token',
+        help="Bật /moodle/metrics (định dạng Prometheus) cho ai gửi token này (Authorization: Bearer hoặc ?token=). Để trống để tắt."
+    )
+    moodle_teacher_role_shortnames = fields.Char(
+        string='Vai trò giảng viên',
+        config_parameter='digi_moodle_sync.teacher_role_shortnames',
+        default='editingteacher,teacher',
+        help="Shortname các vai trò Moodle được đồng bộ là giảng viên, cách nhau bởi dấu phẩy (thêm vai trò riêng nếu có)."
+    )
+    moodle_teacher_capability = fields.Char(
+        string='Quyền lọc giảng viên',
+        config_parameter='digi_moodle_sync.teacher_capability',
+        default='moodle/grade:viewall',
+        help="Khi tải danh sách giảng viên, Moodle chỉ trả về người dùng có quyền này thay vì cả lớp. Mọi vai trò giảng viên ở trên phải có quyền này."
+    )
+    moodle_assignment_course_batch_size = fields.Integer(
+        string='Số khóa học mỗi lần tải bài tập',
+        config_parameter='digi_moodle_sync.assignment_course_batch_size',
+        default=50,
+        help="Số khóa học hỏi chung trong một lần gọi mod_assign_get_assignments."
+    )
+    moodle_submission_chunk_bytes = fields.Integer(
+        string='Kích thước mỗi lần tải bài nộp (byte)',
+        config_parameter='digi_moodle_sync.submission_chunk_bytes',
+        default=2 * 1024 * 1024,
+        help="Kích thước phản hồi ước tính tối đa của một lần gọi mod_assign_get_submissions; các bài tập được chia nhóm theo số bài nộp đã lưu."
+    )
@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 from odoo import models, fields
+from odoo.tools import create_index, index_exists
+
+# Index biểu thức trên email đã chuẩn hoá để đồng bộ người dùng tra theo email không phải quét cả bảng
+PARTNER_EMAIL_INDEX = 'res_partner_lower_email_index'
 
 class ResUsers(models.Model):
     _inherit = 'res.users'
@@ -8,4 +12,48 @@ class ResUsers(models.Model):
 
     _sql_constraints = [
         ('unique_moodle_id_res_users', 'UNIQUE(moodle_id)', 'Moodle ID đã tồn tại trên một Odoo User khác!')
-    ] 
\ No newline at end of file
+    ]
+
+    def init(self):
+        super().init()
+        # Email của res.users nằm trên res.partner
+        if not index_exists(self.env.cr, PARTNER_EMAIL_INDEX):
+            create_index(self.env.cr, PARTNER_EMAIL_INDEX, 'res_partner', ['lower(email)'])
+
+    def _get_users_by_email(self, emails):
+        """Users whose email or login is in ``emails``, as ``{lower(email): user}``.
+
+        Archived users are included (an active user wins over an archived
+        one, then the oldest): a new user with the same login would hit the
+        unique constraint, so the caller decides whether to reuse, reactivate
+        or skip them. One indexed query for the given emails only, so the
+        cost follows the size of a sync batch instead of the number of
+        users in the database.
+        """
+        emails = list({e.strip().lower() for e in emails if e and e.strip()})
+        if not emails:
+            return {}
+        self.env['res.users'].flush(['active', 'partner_id', 'login'])
+        self.env['res.partner'].flush(['email'])
+        # Hai nhánh để mỗi nhánh dùng được index riêng (lower(email) trên partner, login trên user)
+        self.env.cr.execute("""
+            SELECT u.id, u.active, lower(p.email), lower(u.login)
+              FROM res_users u
+              JOIN res_partner p ON p.id = u.partner_id
+             WHERE lower(p.email) IN %s
+             UNION
+            SELECT u.id, u.active, lower(p.email), lower(u.login)
+              FROM res_users u
+              JOIN res_partner p ON p.id = u.partner_id
+             WHERE u.login IN %s
+          ORDER BY 2 DESC, 1
+        """, (tuple(emails), tuple(emails)))
+        wanted = set(emails)
+        users_by_email = {}
+        for user_id, active, email, login in self.env.cr.fetchall():
+            # Giữ người dùng đang hoạt động, rồi người dùng tạo sớm nhất khi nhiều tài khoản trùng email
+            for key in (email, login):
+                if key in wanted:
+                    users_by_email.setdefault(key, user_id)
+        prefetch_ids = list(users_by_email.values())
+        return {email: self.browse(user_id).with_prefetch(prefetch_ids) for email, user_id in users_by_email.items()}
@@ -5,4 +5,12 @@ from . import test_course_sync
 from . import test_teacher_sync
 from . import test_assignment_sync
 from . import test_progress_sync
+from . import test_grade_sync
+from . import test_moodle_client
+from . import test_bulk
+from . import test_sync_cursor
+from . import test_roster_cache
+from . import test_json_stream
+from . import test_metrics
+from . import test_user_sync_benchmark
 # from . import test_wizard # Sẽ thêm sau nếu có UI test cụ thể 
\ No newline at end of file
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import unittest
+from datetime import datetime, timezone
+from unittest.mock import patch, MagicMock
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.digi_moodle_sync.controllers.assignments_sync import MoodleAssignmentSync
+
+@tagged('-at_install', 'post_install')
+class TestAssignmentSync(TransactionCase):
+    def setUp(self):
+        super(TestAssignmentSync, self).setUp()
+        params = self.env['ir.config_parameter'].sudo()
+        params.set_param('digi_moodle_sync.moodle_url', 'https://fakemoodle.example.com')
+        params.set_param('digi_moodle_sync.token', 'faketoken123')
+        params.set_param('digi_moodle_sync.assignment_course_batch_size', '2')
+        # Chỉ đồng bộ các khóa học của test
+        self.env['moodle.course'].search([]).write({'active': False})
+        self.courses = self.env['moodle.course'].create([
+            {'name': f'Assign Course {i}', 'shortname': f'AC{i}', 'moodle_id': 9500 + i} for i in range(3)
+        ])
+        self.assignment_calls = []
+        self.submission_calls = []
+
+    def _fake_get(self, url, params=None, **kwargs):
+        response = MagicMock(status_code=200, content=b'{}')
+        if params['wsfunction'] == 'mod_assign_get_assignments':
+            course_ids = [v for k, v in params.items() if k.startswith('courseids[')]
+            self.assignment_calls.append(course_ids)
+            response.json.return_value = {
+                'courses': [{'id': course_id, 'assignments': [
+                    {'id': course_id * 10 + n, 'name': f'Assignment {course_id}-{n}', 'duedate': 0} for n in range(2)
+                ]} for course_id in course_ids],
+                'warnings': [],
+            }
+        return response
+
+    def _fake_post(self, url, data=None, **kwargs):
+        response = MagicMock(status_code=200, content=b'{}')
+        assignment_ids = [v for k, v in data.items() if k.startswith('assignmentids[')]
+        self.submission_calls.append((assignment_ids, data.get('since')))
+        response.json.return_value = {
+            'assignments': [{'assignmentid': assignment_id, 'submissions': [
+                {'userid': self.student.moodle_id, 'status': 'submitted', 'timemodified': 1700000000},
+            ]} for assignment_id in assignment_ids],
+            'warnings': [],
+        }
+        return response
+
+    def _patch_moodle(self):
+        self.student = self.env['res.users'].create({
+            'name': 'Submission Student', 'login': 'submission.student@example.com', 'moodle_id': 9599,
+        })
+        get = patch('requests.Session.get', side_effect=self._fake_get)
+        post = patch('requests.Session.post', side_effect=self._fake_post)
+        get.start()
+        post.start()
+        self.addCleanup(get.stop)
+        self.addCleanup(post.stop)
+
+    def test_assignments_fetched_per_course_batch(self):
+        self._patch_moodle()
+        payload, status = MoodleAssignmentSync()._sync_assignments(self.env)
+
+        self.assertEqual(status, 200, payload)
+        self.assertEqual(self.assignment_calls, [[9500, 9501], [9502]])
+        for course in self.courses:
+            assignments = self.env['moodle.assignment'].search([('course_id', '=', course.id)])
+            self.assertEqual(sorted(assignments.mapped('moodle_id')), [course.moodle_id * 10, course.moodle_id * 10 + 1])
+
+    def test_submissions_posted_in_chunks_since_watermark(self):
+        self._patch_moodle()
+        # Ước tính tối thiểu 30 bài nộp * 400 byte mỗi bài tập: hai bài tập mỗi lần gọi
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.submission_chunk_bytes', str(2 * 30 * 400))
+        MoodleAssignmentSync()._sync_assignments(self.env)
+
+        # Lần đầu: chưa có mốc, since=0, mỗi nhóm khóa học (4 và 2 bài tập) chia theo kích thước
+        self.assertEqual([len(ids) for ids, since in self.submission_calls], [2, 2, 2])
+        self.assertEqual({since for ids, since in self.submission_calls}, {0})
+        assignments = self.env['moodle.assignment'].search([('course_id', 'in', self.courses.ids)])
+        self.assertEqual(len(assignments.submission_ids), 6)
+        self.assertTrue(all(assignments.mapped('submissions_synced_until')))
+
+        # Lần sau: mỗi bài tập chỉ hỏi các bài nộp sửa sau mốc đã lưu
+        watermark = datetime(2026, 1, 1, 12, 0, 0)
+        assignments.write({'submissions_synced_until': watermark})
+        self.submission_calls = []
+        MoodleAssignmentSync()._sync_assignments(self.env)
+        self.assertEqual({since for ids, since in self.submission_calls}, {int(watermark.replace(tzinfo=timezone.utc).timestamp())})
+
+        # full=1 bỏ qua mốc
+        self.submission_calls = []
+        MoodleAssignmentSync()._sync_assignments(self.env, full='1')
+        self.assertEqual({since for ids, since in self.submission_calls}, {0})
+
+    def test_watermark_kept_for_submissions_of_unknown_users(self):
+        self._patch_moodle()
+        self.student.moodle_id = False
+        MoodleAssignmentSync()._sync_assignments(self.env)
+        assignments = self.env['moodle.assignment'].search([('course_id', 'in', self.courses.ids)])
+        self.assertFalse(assignments.submission_ids)
+        self.assertFalse(any(assignments.mapped('submissions_synced_until')))
+
+        # Sau khi đồng bộ người dùng, lần chạy sau tải lại từ đầu và lưu được bài nộp
+        self.student.moodle_id = 9599
+        self.submission_calls = []
+        MoodleAssignmentSync()._sync_assignments(self.env)
+        self.assertEqual({since for ids, since in self.submission_calls}, {0})
+        self.assertEqual(len(assignments.submission_ids), 6)
+        self.assertTrue(all(assignments.mapped('submissions_synced_until')))
+
+    def test_submission_users_resolved_from_one_map(self):
+        self._patch_moodle()
+        ResUsers = type(self.env['res.users'])
+        with patch.object(ResUsers, 'search', autospec=True, side_effect=ResUsers.search) as user_search:
+            MoodleAssignmentSync()._sync_assignments(self.env)
+
+        # Một truy vấn res.users cho cả lượt, không phải một truy vấn mỗi bài nộp
+        self.assertEqual(user_search.call_count, 1)
+        submissions = self.env['moodle.assignment.submission'].search([('user_id', '=', self.student.id)])
+        self.assertEqual(len(submissions), 6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import unittest
+from datetime import datetime
+from unittest.mock import patch
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.digi_moodle_sync.tools import bulk
+from odoo.addons.digi_moodle_sync.tools.bulk import bulk_upsert, bulk_write
+
+@tagged('-at_install', 'post_install')
+class TestBulkUpsert(TransactionCase):
+    def setUp(self):
+        super(TestBulkUpsert, self).setUp()
+        self.moodle_app_user = self.env['moodle.user'].create({
+            'name': 'Bulk Test User',
+            'login': 'bulk_test_user',
+            'email': 'bulk_test_user@example.com',
+            'moodle_id': 901,
+        })
+        self.user_course = self.env['moodle.user.course'].create({
+            'moodle_course_id': 1,
+            'moodle_user_id': self.moodle_app_user.id,
+            'course_name': 'Bulk Course',
+            'course_shortname': 'BULK',
+        })
+
+    def _grade_row(self, item_id, grade):
+        return {
+            'moodle_user_id': self.moodle_app_user.id,
+            'moodle_course_id': self.user_course.id,
+            'moodle_item_id': item_id,
+            'item_name': f'Item {item_id}',
+            'grade': grade,
+        }
+
+    def test_upsert_creates_then_updates(self):
+        key = ['moodle_user_id', 'moodle_course_id', 'moodle_item_id']
+        result = bulk_upsert(self.env, 'moodle.user.grade', [self._grade_row(1, 5.0), self._grade_row(2, 6.0)], key)
+        self.assertEqual((result['created'], result['updated']), (2, 0))
+
+        result = bulk_upsert(self.env, 'moodle.user.grade', [self._grade_row(1, 9.0), self._grade_row(3, 7.0)], key, batch_size=1)
+        self.assertEqual((result['created'], result['updated']), (1, 1))
+
+        grade = self.env['moodle.user.grade'].browse(result['ids'][(self.moodle_app_user.id, self.user_course.id, 1)])
+        self.assertEqual(grade.grade, 9.0)
+        self.assertFalse(grade.is_null_grade)
+        self.assertEqual(self.env['moodle.user.grade'].search_count([('moodle_course_id', '=', self.user_course.id)]), 3)
+
+    def test_upsert_keeps_last_duplicate(self):
+        key = ['moodle_user_id', 'moodle_course_id', 'moodle_item_id']
+        result = bulk_upsert(self.env, 'moodle.user.grade', [self._grade_row(1, 5.0), self._grade_row(1, 8.0)], key)
+        self.assertEqual(result['created'], 1)
+        grade = self.env['moodle.user.grade'].search([('moodle_item_id', '=', 1), ('moodle_course_id', '=', self.user_course.id)])
+        self.assertEqual(grade.grade, 8.0)
+
+    def test_upsert_skips_unchanged_rows(self):
+        key = ['moodle_user_id', 'moodle_course_id', 'moodle_item_id']
+        first_row = dict(self._grade_row(1, 5.0), last_sync_date=datetime(2024, 1, 1))
+        bulk_upsert(self.env, 'moodle.user.grade', [first_row], key)
+
+        second_row = dict(self._grade_row(1, 5.0), last_sync_date=datetime(2024, 2, 1))
+        result = bulk_upsert(self.env, 'moodle.user.grade', [second_row], key)
+
+        self.assertEqual((result['created'], result['updated'], result['unchanged']), (0, 0, 1))
+        grade = self.env['moodle.user.grade'].browse(result['ids'][(self.moodle_app_user.id, self.user_course.id, 1)])
+        self.assertEqual(grade.last_sync_date, datetime(2024, 2, 1))
+
+    def test_upsert_isolates_bad_rows(self):
+        key = ['moodle_user_id', 'moodle_course_id', 'moodle_item_id']
+        rows = [self._grade_row(item_id, 5.0) for item_id in range(1, 9)]
+        # Khóa ngoại tới moodle.user không tồn tại: chỉ dòng này bị loại
+        rows[5]['moodle_user_id'] = self.moodle_app_user.id + 100000
+        result = bulk_upsert(self.env, 'moodle.user.grade', rows, key)
+
+        self.assertEqual(result['created'], 7)
+        self.assertEqual(len(result['failed']), 1)
+        bad_key = next(iter(result['failed']))
+        self.assertEqual(bad_key[2], 6)
+        self.assertEqual(self.env['moodle.user.grade'].search_count([('moodle_course_id', '=', self.user_course.id)]), 7)
+
+    def test_write_groups_and_isolates_failures(self):
+        MoodleUser = self.env['moodle.user']
+        users = MoodleUser.create([{
+            'name': f'Write Test {i}',
+            'login': f'write_test_{i}',
+            'email': f'write_test_{i}@example.com',
+            'moodle_id': 910 + i,
+        } for i in range(4)])
+        synced_at = datetime(2024, 3, 1)
+        updates = {
+            # Cùng giá trị: một lệnh write
+            users[0].id: {'last_sync_date': synced_at},
+            users[1].id: {'last_sync_date': synced_at},
+            # Khác giá trị, cột thường: một UPDATE ... FROM (VALUES ...)
+            users[2].id: {'name': 'Renamed 2', 'email': 'renamed_2@example.com'},
+            # Trùng email của bản ghi khác: chỉ bản ghi này lỗi
+            users[3].id: {'name': 'Renamed 3', 'email': self.moodle_app_user.email},
+        }
+        result = bulk_write(self.env, 'moodle.user', updates)
+
+        self.assertEqual(result['updated'], 3)
+        self.assertEqual(list(result['failed']), [users[3].id])
+        self.assertEqual(users[:2].mapped('last_sync_date'), [synced_at, synced_at])
+        self.assertEqual((users[2].name, users[2].email), ('Renamed 2', 'renamed_2@example.com'))
+        self.assertEqual(users[3].name, 'Write Test 3')
+
+    def _submissions(self, count):
+        assignment = self.env['moodle.assignment'].create({
+            'moodle_id': 990, 'name': 'Bulk Assignment', 'course_id': self.env['moodle.course'].create({
+                'name': 'Bulk Assignment Course', 'shortname': 'BAC', 'moodle_id': 991}).id,
+        })
+        students = self.env['res.users'].create([{
+            'name': f'Bulk Student {i}', 'login': f'bulk_student_{i}@example.com',
+        } for i in range(count)])
+        return assignment, students
+
+    def test_upsert_rejects_unconvertible_values(self):
+        assignment, students = self._submissions(4)
+        rows = [{'assignment_id': assignment.id, 'user_id': student.id, 'status': 'submitted'} for student in students]
+        # Moodle còn trả về 'reopened', không có trong selection
+        rows[2]['status'] = 'reopened'
+        result = bulk_upsert(self.env, 'moodle.assignment.submission', rows, ['assignment_id', 'user_id'])
+
+        self.assertEqual(result['created'], 3)
+        self.assertEqual(list(result['failed']), [(assignment.id, students[2].id)])
+        self.assertEqual(assignment.submission_ids.user_id, students - students[2])
+
+    def test_write_isolates_unconvertible_values(self):
+        assignment, students = self._submissions(4)
+        submissions = self.env['moodle.assignment.submission'].create([
+            {'assignment_id': assignment.id, 'user_id': student.id, 'status': 'new'} for student in students
+        ])
+        # Giá trị khác nhau trên cột thường: đi đường UPDATE ... FROM (VALUES ...)
+        updates = {sub.id: {'status': 'submitted', 'grade': float(i)} for i, sub in enumerate(submissions)}
+        updates[submissions[1].id]['status'] = 'reopened'
+        result = bulk_write(self.env, 'moodle.assignment.submission', updates)
+
+        self.assertEqual(result['updated'], 3)
+        self.assertEqual(list(result['failed']), [submissions[1].id])
+        self.assertEqual(submissions.mapped('status'), ['submitted', 'new', 'submitted', 'submitted'])
+        self.assertEqual(submissions[3].grade, 3.0)
+
+    def test_write_inherited_fields_of_users(self):
+        users = self.env['res.users'].create([{
+            'name': f'Inherit Test {i}', 'login': f'inherit_{i}@example.com', 'email': f'inherit_{i}@example.com',
+        } for i in range(3)])
+        # Cùng dạng giá trị đồng bộ người dùng ghi: name/email nằm trên res.partner
+        updates = {user.id: {
+            'name': f'Renamed {i}', 'login': f'renamed_{i}@example.com', 'email': f'renamed_{i}@example.com', 'moodle_id': 950 + i,
+        } for i, user in enumerate(users)}
+        with patch.object(bulk, 'execute_values', wraps=bulk.execute_values) as sql:
+            result = bulk_write(self.env, 'res.users', updates)
+
+        self.assertEqual((result['updated'], result['failed']), (3, {}))
+        # Cột riêng của res.users đi một UPDATE ... FROM (VALUES ...), không ghi từng bản ghi
+        queries = [call.args[1] for call in sql.call_args_list]
+        self.assertEqual(len([q for q in queries if q.startswith('UPDATE "res_users"') and 'FROM (VALUES' in q]), 1)
+        users.invalidate_cache()
+        self.assertEqual(users.mapped('moodle_id'), [950, 951, 952])
+        self.assertEqual(users.mapped('login'), [f'renamed_{i}@example.com' for i in range(3)])
+        self.assertEqual(users.mapped('partner_id.name'), [f'Renamed {i}' for i in range(3)])
+        self.assertEqual(users.mapped('partner_id.email'), [f'renamed_{i}@example.com' for i in range(3)])
+
+if __name__ == '__main__':
+    unittest.main()
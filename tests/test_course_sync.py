@@ -87,7 +87,7 @@ class TestCourseGradeSync(HttpCase):
 
     def test_sync_one_course_grades_user_not_found(self):
         """Test /moodle/sync_courses_grades with non-existent odoo_userid."""
-        response = self.url_open('/moodle/sync_courses_grades?odoo_userid=99999')
+        response = self.url_open('/moodle/sync_courses_grades?odoo_userid=99999&wait=1')
         # Status code có thể là 200 OK nhưng có error message, hoặc 404 tùy cách controller xử lý
         # Hiện tại controller trả về JSON error với status 200 cho trường hợp này.
         # Nên chuẩn hóa thành 404 hoặc 400.
@@ -97,7 +97,7 @@ class TestCourseGradeSync(HttpCase):
         self.assertEqual(response.status_code, 200) # Theo code hiện tại của controller
         self.assertIn('không tồn tại', response.json().get('error', ''))
 
-    @patch('odoo.addons.digi_moodle_sync.controllers.courses_grades_sync.requests.get')
+    @patch('requests.Session.get')
     def test_sync_one_success_create(self, mock_requests_get):
         """Test successful sync of courses and grades for one user (creation)."""
         user_to_sync = self.odoo_user_synced
@@ -158,7 +158,7 @@ class TestCourseGradeSync(HttpCase):
         
         mock_requests_get.side_effect = side_effect_requests_get
 
-        response = self.url_open(f'/moodle/sync_courses_grades?odoo_userid={user_to_sync.id}')
+        response = self.url_open(f'/moodle/sync_courses_grades?odoo_userid={user_to_sync.id}&wait=1')
         self.assertEqual(response.status_code, 200, response.json().get('error'))
         json_result = response.json().get('result', {})
 
@@ -210,6 +210,65 @@ class TestCourseGradeSync(HttpCase):
         self.assertTrue(grade_final)
         self.assertEqual(grade_final.grade, 92.5)
 
+    @patch('requests.Session.get')
+    def test_sync_all_by_course_mode(self, mock_requests_get):
+        """mode=course gọi báo cáo điểm một lần cho mỗi khóa học."""
+        mock_grades_api_data_c1 = {
+            'usergrades': [{
+                'courseid': self.moodle_course_odoo1.moodle_id,
+                'userid': self.odoo_user_synced.moodle_id,
+                'gradeitems': [
+                    {'id': 701, 'itemname': 'Quiz 1', 'itemtype': 'mod', 'itemmodule': 'quiz', 'graderaw': 85.0, 'gradedategraded': 1670000100},
+                ]
+            }, {
+                'courseid': self.moodle_course_odoo1.moodle_id,
+                'userid': 99999, # Không có res.users tương ứng
+                'gradeitems': [{'id': 701, 'itemname': 'Quiz 1', 'graderaw': 50.0}]
+            }]
+        }
+
+        def side_effect_requests_get(*args, **kwargs):
+            params = kwargs.get('params', {})
+            mock_resp = MagicMock()
+            mock_resp.status_code = 200
+            self.assertEqual(params.get('wsfunction'), 'gradereport_user_get_grade_items')
+            self.assertNotIn('userid', params)
+            if params.get('courseid') == self.moodle_course_odoo1.moodle_id:
+                mock_resp.json.return_value = mock_grades_api_data_c1
+            else:
+                mock_resp.json.return_value = {'usergrades': []}
+            return mock_resp
+
+        mock_requests_get.side_effect = side_effect_requests_get
+
+        response = self.url_open('/moodle/sync_all_courses_grades?mode=course&wait=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('details_per_course', response.json())
+
+        grade = self.env['moodle.user.grade'].search([
+            ('moodle_user_id', '=', self.moodle_app_user.id),
+            ('moodle_item_id', '=', 701)
+        ])
+        self.assertEqual(len(grade), 1)
+        self.assertEqual(grade.grade, 85.0)
+
+    @patch('requests.Session.get')
+    def test_course_report_timeout_falls_back_without_retry(self, mock_requests_get):
+        """Báo cáo điểm toàn khóa quá thời gian: không thử lại, timeout không vượt quá thời gian còn lại."""
+        import time
+        import requests
+        from odoo.addons.digi_moodle_sync.controllers.courses_grades_sync import MoodleCourseGradeSyncController
+        from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
+        mock_requests_get.side_effect = requests.exceptions.Timeout('slow')
+
+        payload = MoodleCourseGradeSyncController()._fetch_course_grades(
+            MoodleClient.from_env(self.env), self.moodle_course_odoo1.moodle_id, deadline=time.monotonic() + 30)
+
+        self.assertEqual(payload, {'fallback': True})
+        self.assertEqual(mock_requests_get.call_count, 1)
+        connect_timeout, read_timeout = mock_requests_get.call_args[1]['timeout']
+        self.assertLessEqual(read_timeout, 30)
+
     # Thêm các test case:
     # - _sync_all_courses_grades (tương tự sync_one nhưng lặp qua nhiều user)
     # - Cập nhật user.course và user.grade đã tồn tại
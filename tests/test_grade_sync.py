@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import patch, MagicMock
+
+import requests
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.digi_moodle_sync.controllers.courses_grades_sync import MoodleCourseGradeSyncController
+
+@tagged('-at_install', 'post_install')
+class TestGradeSync(TransactionCase):
+    def setUp(self):
+        super(TestGradeSync, self).setUp()
+        params = self.env['ir.config_parameter'].sudo()
+        params.set_param('digi_moodle_sync.moodle_url', 'https://fakemoodle.example.com')
+        params.set_param('digi_moodle_sync.token', 'faketoken123')
+        params.set_param('digi_moodle_sync.http_max_retries', '0')
+        # Chỉ đồng bộ các khóa học và học viên của test
+        self.env['moodle.course'].search([]).write({'active': False})
+        self.env['res.users'].search([('moodle_id', '!=', False)]).write({'moodle_id': False})
+        self.course, self.broken_course = self.env['moodle.course'].create([
+            {'name': 'Grade Course', 'shortname': 'GC1', 'moodle_id': 9801},
+            {'name': 'Broken Grade Course', 'shortname': 'GC2', 'moodle_id': 9802},
+        ])
+        self.students = self.env['res.users'].create([{
+            'name': f'Grade Student {i}', 'login': f'grade_student_{i}@example.com', 'moodle_id': 9900 + i,
+        } for i in range(2)])
+        self.broken_calls = set()
+
+    def _usergrades(self, user_moodle_id):
+        return {'userid': user_moodle_id, 'gradeitems': [
+            {'id': 1, 'itemname': 'Quiz', 'graderaw': 8.0, 'gradedategraded': 1700000000},
+        ]}
+
+    def _fake_get(self, url, params=None, **kwargs):
+        response = MagicMock(status_code=200, content=b'{}')
+        wsfunction = params['wsfunction']
+        if wsfunction == 'core_enrol_get_users_courses':
+            response.json.return_value = [
+                {'id': course.moodle_id, 'fullname': course.name, 'shortname': course.shortname}
+                for course in (self.course, self.broken_course)
+            ]
+        elif wsfunction == 'core_enrol_get_enrolled_users':
+            response.json.return_value = [{'id': student.moodle_id} for student in self.students]
+        elif wsfunction == 'gradereport_user_get_grade_items':
+            user_moodle_id = params.get('userid')
+            if params['courseid'] == self.broken_course.moodle_id and user_moodle_id in self.broken_calls:
+                raise requests.exceptions.ConnectionError('connection reset')
+            user_moodle_ids = [user_moodle_id] if user_moodle_id else self.students.mapped('moodle_id')
+            response.json.return_value = {'usergrades': [self._usergrades(uid) for uid in user_moodle_ids]}
+        return response
+
+    def _sync(self, mode):
+        with patch('requests.Session.get', side_effect=self._fake_get):
+            return MoodleCourseGradeSyncController()._sync_all(self.env, mode=mode)
+
+    def _grades(self, course):
+        return self.env['moodle.user.grade'].search([('moodle_course_id.moodle_course_id', '=', course.id)])
+
+    def test_user_mode_keeps_watermark_of_failed_course(self):
+        # Lỗi tải điểm của một khóa học cho một học viên
+        self.broken_calls = {self.students[0].moodle_id}
+        payload, status = self._sync('user')
+
+        self.assertEqual(status, 200, payload)
+        self.assertEqual(len(self._grades(self.course)), 2)
+        self.assertEqual(len(self._grades(self.broken_course)), 1)
+        self.assertTrue(self.course.grades_synced_until)
+        self.assertFalse(self.broken_course.grades_synced_until)
+
+    def test_course_mode_reports_fallback_errors(self):
+        # Báo cáo toàn khóa lỗi -> tải theo từng học viên, một học viên lỗi
+        self.broken_calls = {None, self.students[1].moodle_id}
+        payload, status = self._sync('course')
+
+        self.assertEqual(status, 200, payload)
+        self.assertEqual(len(self._grades(self.broken_course)), 1)
+        self.assertIn(str(self.students[1].moodle_id), payload['details_per_course'][self.broken_course.id]['error'])
+        self.assertNotIn('error', payload['details_per_course'][self.course.id])
+        self.assertTrue(self.course.grades_synced_until)
+        self.assertFalse(self.broken_course.grades_synced_until)
+
+if __name__ == '__main__':
+    unittest.main()
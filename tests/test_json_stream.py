@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from unittest.mock import MagicMock
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.digi_moodle_sync.tools.json_stream import JsonArrayStream
+
+def _stream_response(payload, chunk_size):
+    body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+    response = MagicMock()
+    response.encoding = 'utf-8'
+    response.iter_content.return_value = [body[i:i + chunk_size] for i in range(0, len(body), chunk_size)]
+    return response
+
+@tagged('-at_install', 'post_install')
+class TestJsonArrayStream(TransactionCase):
+
+    def test_items_split_across_chunks(self):
+        users = [{'id': i, 'fullname': f'Người dùng {i}', 'email': f'u{i}@example.com'} for i in range(50)]
+        payload = {'users': users, 'warnings': [], 'total': 123456}
+        for chunk_size in (1, 7, 4096):
+            stream = JsonArrayStream(_stream_response(payload, chunk_size), 'users')
+            batches = list(stream.batches(20))
+            self.assertEqual([len(b) for b in batches], [20, 20, 10])
+            self.assertEqual([u for b in batches for u in b], users)
+            self.assertTrue(stream.found)
+            self.assertEqual(stream.other, {'warnings': [], 'total': 123456})
+
+    def test_moodle_exception_has_no_items(self):
+        payload = {'exception': 'moodle_exception', 'errorcode': 'invalidtoken', 'message': 'Invalid token'}
+        stream = JsonArrayStream(_stream_response(payload, 5), 'users')
+        self.assertEqual(list(stream), [])
+        self.assertFalse(stream.found)
+        self.assertEqual(stream.other['errorcode'], 'invalidtoken')
+
+    def test_truncated_body_raises(self):
+        response = _stream_response({'users': [{'id': 1}, {'id': 2}]}, 4)
+        response.iter_content.return_value = response.iter_content.return_value[:-2]
+        with self.assertRaises(ValueError):
+            list(JsonArrayStream(response, 'users'))
+
+if __name__ == '__main__':
+    unittest.main()
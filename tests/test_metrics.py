@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import patch, MagicMock
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.digi_moodle_sync.tools.metrics import CallStats, collect, prometheus_text
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
+
+@tagged('-at_install', 'post_install')
+class TestCallMetrics(TransactionCase):
+    def setUp(self):
+        super(TestCallMetrics, self).setUp()
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.moodle_url', 'https://fakemoodle.example.com')
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.token', 'faketoken123')
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.http_backoff_factor', 0)
+
+    def test_percentiles_and_merge(self):
+        stats = CallStats()
+        for i in range(100):
+            stats.record('gradereport_user_get_grade_items', 0.2 if i < 90 else 3.0, 200)
+        summary = stats.summary()['gradereport_user_get_grade_items']
+        self.assertEqual(summary['calls'], 100)
+        self.assertLess(summary['p50'], 0.25)
+        self.assertGreater(summary['p95'], 2.5)
+
+        # Gộp qua JSON (nhiều lượt cron) giữ nguyên histogram
+        merged = CallStats.from_json(stats.to_json()).merge(stats)
+        self.assertEqual(merged.total_calls, 200)
+        self.assertEqual(merged.summary()['gradereport_user_get_grade_items']['p50'], summary['p50'])
+
+    @patch('requests.Session.get')
+    def test_client_records_calls(self, mock_get):
+        busy_response = MagicMock(status_code=503, headers={})
+        ok_response = MagicMock(status_code=200, content=b'{"sitename": "Fake"}')
+        ok_response.json.return_value = {'sitename': 'Fake'}
+        mock_get.side_effect = [busy_response, ok_response]
+
+        stats = CallStats()
+        with collect(stats):
+            MoodleClient.from_env(self.env).call('core_webservice_get_site_info')
+
+        data = stats.to_dict()['functions']['core_webservice_get_site_info']
+        self.assertEqual((data['calls'], data['retries'], data['status']), (1, 1, {'200': 1}))
+        self.assertEqual(data['bytes'], len(b'{"sitename": "Fake"}'))
+
+    @patch('requests.Session.get')
+    def test_job_stores_stats_and_prometheus_text(self, mock_get):
+        ok_response = MagicMock(status_code=200, content=b'[]')
+        ok_response.json.return_value = []
+        mock_get.return_value = ok_response
+
+        def handler(env, params, progress, cursor):
+            MoodleClient.from_env(env).call('core_course_get_courses')
+            return {'message': 'ok'}, 200
+
+        job = self.env['moodle.sync.job'].create({'name': 'Metrics', 'job_type': 'courses'})
+        with patch.object(type(job), '_get_job_handlers', return_value={'courses': handler}):
+            job._run()
+
+        self.assertEqual(job.state, 'done')
+        self.assertEqual(job.api_call_count, 1)
+        self.assertIn('core_course_get_courses', job.get_status()['api_calls'])
+
+        text = prometheus_text({'courses': CallStats.from_json(job.api_stats)}, {'courses': job.run_seconds})
+        self.assertIn('moodle_ws_calls_total{job_type="courses",wsfunction="core_course_get_courses",status="200"} 1', text)
+        self.assertIn('moodle_ws_call_duration_seconds_count{job_type="courses",wsfunction="core_course_get_courses"} 1', text)
+
+if __name__ == '__main__':
+    unittest.main()
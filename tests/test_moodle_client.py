@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import patch, MagicMock
+
+import requests
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient, get_session
+from odoo.addons.digi_moodle_sync.tools.throttle import MoodleGovernor
+
+@tagged('-at_install', 'post_install')
+class TestMoodleClient(TransactionCase):
+    def setUp(self):
+        super(TestMoodleClient, self).setUp()
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.moodle_url', 'https://fakemoodle.example.com/')
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.token', 'faketoken123')
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.http_backoff_factor', 0)
+
+    def test_from_env_builds_api_url(self):
+        client = MoodleClient.from_env(self.env)
+        self.assertTrue(client.is_configured)
+        self.assertEqual(client.api_url, 'https://fakemoodle.example.com/webservice/rest/server.php')
+
+    def test_session_is_shared(self):
+        """Hai client cùng pool size dùng chung một session keep-alive."""
+        client_1 = MoodleClient.from_env(self.env)
+        client_2 = MoodleClient.from_env(self.env)
+        self.assertIs(client_1.session, client_2.session)
+        self.assertIs(client_1.session, get_session(client_1.pool_size))
+
+    @patch('requests.Session.get')
+    def test_request_builds_payload(self, mock_get):
+        mock_response = MagicMock()
+        mock_response.status_code = 200
+        mock_response.json.return_value = {'sitename': 'Fake'}
+        mock_get.return_value = mock_response
+
+        data = MoodleClient.from_env(self.env).call('core_webservice_get_site_info', {'foo': 1})
+
+        self.assertEqual(data, {'sitename': 'Fake'})
+        params = mock_get.call_args.kwargs['params']
+        self.assertEqual(params['wstoken'], 'faketoken123')
+        self.assertEqual(params['wsfunction'], 'core_webservice_get_site_info')
+        self.assertEqual(params['moodlewsrestformat'], 'json')
+        self.assertEqual(params['foo'], 1)
+
+    @patch('requests.Session.get')
+    def test_request_retries_transient_errors(self, mock_get):
+        busy_response = MagicMock()
+        busy_response.status_code = 503
+        busy_response.headers = {}
+        ok_response = MagicMock()
+        ok_response.status_code = 200
+        mock_get.side_effect = [requests.exceptions.ConnectionError('reset'), busy_response, ok_response]
+
+        response = MoodleClient.from_env(self.env).request('core_webservice_get_site_info')
+
+        self.assertIs(response, ok_response)
+        self.assertEqual(mock_get.call_count, 3)
+
+    @patch('requests.Session.get')
+    def test_request_gives_up_after_max_retries(self, mock_get):
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.http_max_retries', 1)
+        mock_get.side_effect = requests.exceptions.Timeout('slow')
+
+        with self.assertRaises(requests.exceptions.Timeout):
+            MoodleClient.from_env(self.env).request('core_webservice_get_site_info')
+        self.assertEqual(mock_get.call_count, 2)
+
+    def test_governor_backs_off_and_ramps_up(self):
+        governor = MoodleGovernor(rate_limit=0, max_concurrency=8, target_latency=0)
+        with governor.slot() as outcome:
+            outcome.overloaded()
+        self.assertEqual(governor.concurrency.limit, 4)
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            with governor.slot():
+                raise requests.exceptions.ConnectionError('reset')
+        self.assertEqual(governor.concurrency.limit, 2)
+        # Mỗi cửa sổ request khoẻ mở thêm một slot, không vượt quá giới hạn cấu hình
+        for _i in range(100):
+            with governor.slot():
+                pass
+        self.assertEqual(governor.concurrency.limit, 8)
+        self.assertEqual(governor.concurrency.in_flight, 0)
+
+    @patch('requests.Session.get')
+    def test_request_reports_overload_to_governor(self, mock_get):
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.moodle_url', 'https://governed.example.com/')
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.max_concurrency', 6)
+        exception_response = MagicMock()
+        exception_response.status_code = 200
+        exception_response.content = b'{"exception":"dml_read_exception","errorcode":"dmlreadexception"}'
+        mock_get.return_value = exception_response
+
+        client = MoodleClient.from_env(self.env)
+        client.governor.concurrency.limit = 6
+        client.request('core_webservice_get_site_info')
+
+        self.assertEqual(client.governor.concurrency.limit, 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import patch
+
+import requests
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.digi_moodle_sync.controllers.progress_sync import MoodleProgressSync
+
+@tagged('-at_install', 'post_install')
+class TestProgressSync(TransactionCase):
+    def setUp(self):
+        super(TestProgressSync, self).setUp()
+        params = self.env['ir.config_parameter'].sudo()
+        params.set_param('digi_moodle_sync.moodle_url', 'https://fakemoodle.example.com')
+        params.set_param('digi_moodle_sync.token', 'faketoken123')
+        # Nhiều luồng tải: đi đúng đường fetch_concurrently song song
+        params.set_param('digi_moodle_sync.fetch_concurrency', '4')
+        # Chỉ đồng bộ các khóa học của test
+        self.env['moodle.course'].search([]).write({'active': False})
+        self.course = self.env['moodle.course'].create({'name': 'Progress Course', 'shortname': 'PC1', 'moodle_id': 9601})
+        self.course_no_completion = self.env['moodle.course'].create({'name': 'No Completion', 'shortname': 'PC2', 'moodle_id': 9602})
+        self.students = self.env['res.users'].create([{
+            'name': f'Progress Student {i}', 'login': f'progress_student_{i}@example.com', 'moodle_id': 9700 + i,
+        } for i in range(3)])
+        self.statuses = {
+            9700: [{'cmid': 1, 'activityname': 'Quiz', 'state': 1, 'timemodified': 1700000000},
+                   {'cmid': 2, 'activityname': 'Forum', 'state': 0}],
+            9702: [{'cmid': 1, 'activityname': 'Quiz', 'state': 2}],
+        }
+        self.completion_calls = []
+
+    def _fake_roster(self, env, client, course):
+        return list(self.students.mapped('moodle_id'))
+
+    def _fake_completion(self, client, course_moodle_id, user_moodle_id):
+        self.completion_calls.append((course_moodle_id, user_moodle_id))
+        if course_moodle_id == 9602:
+            return {'exception': 'moodle_exception', 'errorcode': 'completionnotenabled', 'message': 'Completion is not enabled'}
+        if user_moodle_id == 9701:
+            raise requests.exceptions.Timeout('slow')
+        return {'statuses': self.statuses[user_moodle_id], 'warnings': []}
+
+    def _sync(self):
+        with patch.object(MoodleProgressSync, '_fetch_enrolled_user_ids', autospec=True,
+                          side_effect=lambda controller, *args: self._fake_roster(*args)), \
+                patch.object(MoodleProgressSync, '_fetch_completion_statuses', autospec=True,
+                             side_effect=lambda controller, *args: self._fake_completion(*args)):
+            return MoodleProgressSync()._sync_progress(self.env)
+
+    def _progress(self, course):
+        return self.env['moodle.activity.progress'].search([('courseid', '=', course.id)])
+
+    def test_progress_fetched_in_parallel_and_upserted(self):
+        payload, status = self._sync()
+
+        self.assertEqual(status, 200, payload)
+        self.assertIn('3 records synced, 0 unchanged', payload['message'])
+        # Lỗi của một học viên không chặn các học viên khác
+        progress = self._progress(self.course)
+        self.assertEqual(sorted((p.userid.moodle_id, p.cmid, p.completionstate) for p in progress),
+                         [(9700, 1, '1'), (9700, 2, '0'), (9702, 1, '2')])
+        self.assertEqual(sorted(user for course, user in self.completion_calls if course == 9601), [9700, 9701, 9702])
+        # Khóa học không bật theo dõi hoàn thành: bỏ qua cả khóa
+        self.assertFalse(self._progress(self.course_no_completion))
+
+        # Lần sau, dữ liệu không đổi thì không ghi lại; trạng thái đổi được cập nhật
+        self.statuses[9702] = [{'cmid': 1, 'activityname': 'Quiz', 'state': 3}]
+        payload, status = self._sync()
+        self.assertIn('1 records synced, 2 unchanged', payload['message'])
+        self.assertEqual(self._progress(self.course).filtered(lambda p: p.userid.moodle_id == 9702).completionstate, '3')
+
+    def test_completion_not_enabled_stops_the_course(self):
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.fetch_concurrency', '1')
+        self._sync()
+        # Một luồng tải: dừng ngay sau học viên đầu tiên của khóa học không bật hoàn thành
+        self.assertEqual([user for course, user in self.completion_calls if course == 9602], [9700])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import unittest
+from unittest.mock import MagicMock
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.digi_moodle_sync.tools.roster_cache import get_course_roster, clear_roster_cache
+
+ROSTER = [
+    {'id': 11, 'fullname': 'Teacher One', 'roles': [{'roleid': 3}]},
+    {'id': 12, 'fullname': 'Student One', 'roles': [{'roleid': 5}]},
+]
+
+@tagged('-at_install', 'post_install')
+class TestRosterCache(TransactionCase):
+    def setUp(self):
+        super(TestRosterCache, self).setUp()
+        clear_roster_cache()
+        self.addCleanup(clear_roster_cache)
+        self.course = self.env['moodle.course'].create({'name': 'Roster Course', 'shortname': 'ROSTER', 'moodle_id': 9201})
+        self.client = MagicMock()
+        self.client.base_url = 'https://fakemoodle.example.com'
+        self.client.call.return_value = list(ROSTER)
+        self.params = self.env['ir.config_parameter'].sudo()
+        self.params.set_param('digi_moodle_sync.roster_cache_ttl', '600')
+
+    def test_roster_fetched_once_within_ttl(self):
+        first = get_course_roster(self.env, self.client, self.course)
+        second = get_course_roster(self.env, self.client, self.course)
+        self.assertEqual(self.client.call.call_count, 1)
+        self.assertEqual(first.users, second.users)
+
+    def test_ttl_zero_disables_cache(self):
+        self.params.set_param('digi_moodle_sync.roster_cache_ttl', '0')
+        get_course_roster(self.env, self.client, self.course)
+        get_course_roster(self.env, self.client, self.course)
+        self.assertEqual(self.client.call.call_count, 2)
+
+    def test_persisted_roster_hash_validation(self):
+        self.params.set_param('digi_moodle_sync.roster_cache_persist', 'True')
+        first = get_course_roster(self.env, self.client, self.course)
+        self.assertTrue(first.changed)
+        self.assertEqual(self.course.roster_hash, first.digest)
+
+        # Lần tải lại (hết TTL) cùng nội dung, khác thứ tự: mã băm không đổi
+        clear_roster_cache()
+        self.course.roster_fetched_at = False
+        self.client.call.return_value = list(reversed(ROSTER))
+        second = get_course_roster(self.env, self.client, self.course)
+        self.assertFalse(second.changed)
+        self.assertEqual(second.digest, first.digest)
+
+    def test_moodle_exception_is_not_cached(self):
+        self.client.call.return_value = {'exception': 'moodle_exception', 'errorcode': 'nopermissions', 'message': 'No access'}
+        with self.assertRaises(ValueError):
+            get_course_roster(self.env, self.client, self.course)
+        self.client.call.return_value = list(ROSTER)
+        self.assertEqual(len(get_course_roster(self.env, self.client, self.course).users), 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+import time
+import unittest
+from unittest.mock import patch
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.digi_moodle_sync.models.moodle_sync_job import MAX_INTERRUPTED_ATTEMPTS
+from odoo.addons.digi_moodle_sync.tools.sync_cursor import SyncCursor
+
+@tagged('-at_install', 'post_install')
+class TestSyncCursor(TransactionCase):
+    def setUp(self):
+        super(TestSyncCursor, self).setUp()
+        self.courses = self.env['moodle.course'].create([
+            {'name': f'Cursor Course {i}', 'shortname': f'CUR{i}', 'moodle_id': 9100 + i}
+            for i in range(5)
+        ])
+
+    def test_iterate_without_deadline_walks_everything(self):
+        cursor = SyncCursor(chunk_size=2)
+        seen = [course.id for course in cursor.iterate(self.courses)]
+        self.assertEqual(seen, sorted(self.courses.ids))
+        self.assertFalse(cursor.interrupted)
+        self.assertEqual(cursor.resume_after, max(self.courses.ids))
+
+    def test_expired_deadline_stops_between_chunks_and_resumes(self):
+        cursor = SyncCursor(chunk_size=2)
+        chunks = cursor.chunks(self.courses)
+        first = next(chunks)
+        self.assertEqual(len(first), 2)
+        # Hết thời gian sau nhóm đầu: nhóm thứ hai không được bắt đầu
+        cursor.deadline = time.monotonic() - 1
+        self.assertEqual(list(chunks), [])
+        self.assertTrue(cursor.interrupted)
+        self.assertEqual(cursor.resume_after, first[-1].id)
+        self.assertEqual(cursor.summary(), {'interrupted': True, 'resume_after': first[-1].id})
+
+        resumed = SyncCursor.from_state(cursor.to_state())
+        self.assertEqual(resumed.pending(self.courses).ids, sorted(self.courses.ids)[2:])
+
+    def test_item_chunks_resume_by_key(self):
+        items = [{'id': moodle_id} for moodle_id in (30, 10, 20, 40)]
+        cursor = SyncCursor(chunk_size=2)
+        chunks = cursor.item_chunks(items, key=lambda item: item['id'])
+        self.assertEqual(next(chunks), [{'id': 10}, {'id': 20}])
+        cursor.deadline = time.monotonic() - 1
+        self.assertEqual(list(chunks), [])
+        self.assertTrue(cursor.interrupted)
+
+        resumed = SyncCursor.from_state(cursor.to_state(), on_checkpoint=lambda c: checkpoints.append(c.resume_after))
+        checkpoints = []
+        self.assertEqual([item['id'] for chunk in resumed.item_chunks(items, key=lambda item: item['id']) for item in chunk], [30, 40])
+        self.assertEqual(checkpoints, [40])
+
+    def test_checkpoint_after_each_completed_chunk(self):
+        checkpoints = []
+        cursor = SyncCursor(chunk_size=2, on_checkpoint=lambda c: checkpoints.append(c.resume_after))
+        list(cursor.iterate(self.courses))
+        ids = sorted(self.courses.ids)
+        self.assertEqual(checkpoints, [ids[1], ids[3], ids[4]])
+
+    def test_failed_job_with_checkpoint_is_resumed_by_enqueue(self):
+        Job = self.env['moodle.sync.job']
+        failed = Job.create({
+            'name': 'Progress',
+            'job_type': 'progress',
+            'params': '{}',
+            'state': 'failed',
+            'cursor_state': SyncCursor(resume_after=self.courses[2].id).to_state(),
+        })
+        self.assertEqual(Job.enqueue('progress'), failed)
+        self.assertEqual(failed.state, 'queued')
+        self.assertNotEqual(Job.enqueue('progress', {'full': '1'}), failed)
+
+    def test_job_interrupted_too_often_is_failed(self):
+        Job = self.env['moodle.sync.job']
+        Job.search([('state', '=', 'running')]).write({'state': 'failed'})
+        state = SyncCursor(resume_after=self.courses[2].id).to_state()
+        job = Job.create({'name': 'Progress', 'job_type': 'progress', 'state': 'running', 'cursor_state': state})
+        with patch.object(self.env.cr, 'commit'):
+            for attempt in range(1, MAX_INTERRUPTED_ATTEMPTS):
+                Job._requeue_interrupted_jobs()
+                self.assertEqual((job.state, job.interrupted_count), ('queued', attempt))
+                job.state = 'running'
+            Job._requeue_interrupted_jobs()
+        self.assertEqual(job.state, 'failed')
+        # Giữ điểm tiếp tục để thử lại bằng tay
+        self.assertEqual(job.cursor_state, state)
+        job.action_retry()
+        self.assertEqual((job.state, job.interrupted_count), ('queued', 0))
+
+    def test_failed_run_keeps_its_checkpoint(self):
+        Job = self.env['moodle.sync.job']
+        state = SyncCursor(resume_after=self.courses[2].id).to_state()
+        job = Job.create({'name': 'Progress', 'job_type': 'progress', 'state': 'running', 'cursor_state': state})
+        handlers = {'progress': lambda env, params, progress, cursor: ({'error': 'Moodle down'}, 200)}
+        with patch.object(type(Job), '_get_job_handlers', return_value=handlers):
+            job._run()
+        self.assertEqual(job.state, 'failed')
+        self.assertEqual(job.cursor_state, state)
+
+        handlers['progress'] = lambda env, params, progress, cursor: ({'message': 'ok'}, 200)
+        with patch.object(type(Job), '_get_job_handlers', return_value=handlers):
+            job._run()
+        self.assertEqual(job.state, 'done')
+        self.assertFalse(job.cursor_state)
+
+if __name__ == '__main__':
+    unittest.main()
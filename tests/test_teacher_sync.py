@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+import json
+import unittest
+from unittest.mock import patch, MagicMock
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.digi_moodle_sync.controllers.teacher_sync import MoodleTeacherSync
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
+from odoo.addons.digi_moodle_sync.tools.roster_cache import clear_roster_cache, get_course_roster
+
+@tagged('-at_install', 'post_install')
+class TestTeacherSync(TransactionCase):
+    def setUp(self):
+        super(TestTeacherSync, self).setUp()
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.moodle_url', 'https://fakemoodle.example.com')
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.token', 'faketoken123')
+        self.course_1 = self.env['moodle.course'].create({'name': 'Teacher Course 1', 'shortname': 'TC1', 'moodle_id': 9301})
+        self.course_2 = self.env['moodle.course'].create({'name': 'Teacher Course 2', 'shortname': 'TC2', 'moodle_id': 9302})
+        # Người dùng Odoo có sẵn, chưa có moodle_id: được nhận ra qua email
+        self.existing_user = self.env['res.users'].create({
+            'name': 'Existing Teacher',
+            'login': 'existing_teacher',
+            'email': 'Existing.Teacher@example.com',
+        })
+        self.rosters = {
+            9301: [
+                {'id': 9401, 'username': 'existing', 'fullname': 'Existing Teacher', 'email': 'existing.teacher@example.com', 'roles': [{'roleid': 3, 'shortname': 'editingteacher'}]},
+                {'id': 9402, 'username': 'newteacher', 'fullname': 'New Teacher', 'email': 'new.teacher@example.com', 'roles': [{'roleid': 4, 'shortname': 'teacher'}]},
+                {'id': 9403, 'username': 'student', 'fullname': 'Student', 'email': 'student@example.com', 'roles': [{'roleid': 5, 'shortname': 'student'}]},
+            ],
+            9302: [
+                {'id': 9401, 'username': 'existing', 'fullname': 'Existing Teacher', 'email': 'existing.teacher@example.com', 'roles': [{'roleid': 3, 'shortname': 'editingteacher'}]},
+            ],
+        }
+
+    def _sync(self):
+        def fake_fetch(env, client, course, teacher_roles):
+            return self.rosters.get(course.moodle_id, [])
+        with patch.object(MoodleTeacherSync, '_fetch_course_teachers', side_effect=fake_fetch):
+            return MoodleTeacherSync()._sync_teachers(self.env)
+
+    def _links(self, course):
+        return self.env['moodle.course.teacher'].search([('course_id', '=', course.id)])
+
+    def test_sync_creates_links_in_bulk(self):
+        payload, status = self._sync()
+        self.assertEqual(status, 200, payload)
+
+        self.assertEqual(self.existing_user.moodle_id, 9401)
+        self.assertEqual(set(self._links(self.course_1).mapped('user_id.moodle_id')), {9401, 9402})
+        self.assertEqual(self._links(self.course_2).user_id, self.existing_user)
+        moodle_users = self.env['moodle.user'].search([('moodle_id', 'in', [9401, 9402, 9403])])
+        self.assertEqual(set(moodle_users.mapped('moodle_id')), {9401, 9402})
+
+    def test_stale_links_removed(self):
+        self._sync()
+        # Giảng viên 9402 rời khóa học 1
+        self.rosters[9301] = self.rosters[9301][:1]
+        self._sync()
+        self.assertEqual(self._links(self.course_1).user_id, self.existing_user)
+        self.assertEqual(len(self._links(self.course_2)), 1)
+
+    def test_links_kept_when_teacher_unresolved_or_roster_empty(self):
+        self._sync()
+        # Lỗi tạm thời: không tìm được người dùng cho giảng viên 9402, khóa học 2 trả về danh sách rỗng
+        self.rosters[9302] = []
+        resolve = MoodleTeacherSync._resolve_teacher_users
+
+        def resolve_without_9402(controller, env, teachers_by_moodle_id):
+            user_ids = resolve(controller, env, teachers_by_moodle_id)
+            user_ids.pop(9402, None)
+            return user_ids
+        with patch.object(MoodleTeacherSync, '_resolve_teacher_users', autospec=True, side_effect=resolve_without_9402):
+            self._sync()
+        self.assertEqual(set(self._links(self.course_1).mapped('user_id.moodle_id')), {9401, 9402})
+        self.assertEqual(self._links(self.course_2).user_id, self.existing_user)
+
+    def test_custom_roles_and_role_ids_learned(self):
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.teacher_role_shortnames', 'editingteacher,tutor')
+        self.rosters[9302].append({'id': 9404, 'username': 'tutor', 'fullname': 'Tutor', 'email': 'tutor@example.com',
+                                   'roles': [{'roleid': 9, 'shortname': 'tutor'}]})
+        self._sync()
+        # Vai trò 'teacher' không còn trong cấu hình, vai trò riêng 'tutor' được tính
+        self.assertEqual(set(self._links(self.course_1).mapped('user_id.moodle_id')), {9401})
+        self.assertEqual(set(self._links(self.course_2).mapped('user_id.moodle_id')), {9401, 9404})
+        role_ids = self.env['ir.config_parameter'].sudo().get_param('digi_moodle_sync.teacher_role_ids')
+        self.assertEqual(json.loads(role_ids), {'editingteacher': 3, 'tutor': 9})
+
+    def test_is_teacher_does_not_learn_role_ids(self):
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.teacher_role_ids', '{}')
+        controller = MoodleTeacherSync()
+        teacher_roles = controller._get_teacher_roles(self.env)
+        manager = {'id': 9405, 'roles': [{'roleid': 1, 'shortname': 'manager'}]}
+        teacher = {'id': 9406, 'roles': [{'roleid': 3, 'shortname': 'editingteacher'}]}
+        # Quản lý có cùng quyền lọc nhưng không phải giảng viên
+        self.assertFalse(controller._is_teacher(manager, teacher_roles))
+        self.assertTrue(controller._is_teacher(teacher, teacher_roles))
+        self.assertFalse(teacher_roles['learned'])
+
+        controller._learn_teacher_role_ids(teacher_roles, [manager, teacher])
+        self.assertEqual(teacher_roles['ids'], {'editingteacher': 3})
+        self.assertTrue(controller._is_teacher({'id': 9407, 'roles': [{'roleid': 3}]}, teacher_roles))
+
+    @patch('requests.Session.get')
+    def test_fetch_asks_only_for_teachers(self, mock_get):
+        clear_roster_cache()
+        mock_response = MagicMock(status_code=200, content=b'[]')
+        mock_response.json.return_value = []
+        mock_get.return_value = mock_response
+        controller = MoodleTeacherSync()
+        controller._fetch_course_teachers(self.env, MoodleClient.from_env(self.env), self.course_1,
+                                          controller._get_teacher_roles(self.env))
+        params = mock_get.call_args[1]['params']
+        self.assertEqual(params['wsfunction'], 'core_enrol_get_enrolled_users')
+        options = {params[f'options[{i}][name]']: params[f'options[{i}][value]'] for i in range(3)}
+        self.assertEqual(options['withcapability'], 'moodle/grade:viewall')
+        self.assertEqual(options['onlyactive'], 1)
+        self.assertNotIn('description', options['userfields'])
+
+    @patch('requests.Session.get')
+    def test_fetch_ignores_cached_roster(self, mock_get):
+        clear_roster_cache()
+        self.addCleanup(clear_roster_cache)
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.roster_cache_ttl', '600')
+        mock_response = MagicMock(status_code=200, content=b'[]')
+        mock_response.json.return_value = []
+        mock_get.return_value = mock_response
+        client = MoodleClient.from_env(self.env)
+        # Danh sách ghi danh đầy đủ đã có trong cache (do đồng bộ tiến độ tải)
+        get_course_roster(self.env, client, self.course_1)
+        controller = MoodleTeacherSync()
+        controller._fetch_course_teachers(self.env, client, self.course_1, controller._get_teacher_roles(self.env))
+        # Vẫn hỏi Moodle theo quyền giảng viên: kết quả không phụ thuộc cache
+        self.assertEqual(mock_get.call_count, 2)
+        params = mock_get.call_args[1]['params']
+        self.assertEqual(params['options[2][name]'], 'withcapability')
+
+if __name__ == '__main__':
+    unittest.main()
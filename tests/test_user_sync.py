@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import json
 import unittest
 from unittest.mock import patch, MagicMock
 
@@ -34,6 +35,9 @@ class TestUserSync(HttpCase):
         # Cấu hình System Parameters giả lập
         self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.moodle_url', 'https://fakemoodle.example.com')
         self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.token', 'faketoken123')
+        # Các test dưới đây giả lập một phản hồi core_user_get_users (chế độ stream);
+        # chế độ theo trang được kiểm tra riêng trong test_sync_users_paged
+        self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.user_sync_page_size', '0')
 
     def test_sync_users_access_denied(self):
         """Test sync_users endpoint access denied for user without rights."""
@@ -100,16 +104,18 @@ class TestUserSync(HttpCase):
             ]
         }
 
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             mock_response = MagicMock()
             mock_response.status_code = 200
             mock_response.json.return_value = mock_api_response
+            mock_response.encoding = 'utf-8'
+            mock_response.iter_content.return_value = [json.dumps(mock_api_response).encode()] # core_user_get_users được đọc dạng stream
             mock_get.return_value = mock_response
             
             # Đảm bảo user đang chạy là user có quyền
             # Mặc định HttpCase chạy với admin
 
-            response = self.url_open('/moodle/sync_users')
+            response = self.url_open('/moodle/sync_users?wait=1')
             self.assertEqual(response.status_code, 200)
             json_response = response.json()
             self.assertIn('message', json_response)
@@ -136,6 +142,126 @@ class TestUserSync(HttpCase):
             self.assertEqual(moodle_user1.odoo_user_id, user1_odoo)
             self.assertIsNotNone(moodle_user1.last_sync_date)
 
+    def test_sync_users_enqueues_job(self):
+        """Without wait=1 the endpoint answers 202 and the job runs later."""
+        response = self.url_open('/moodle/sync_users')
+        self.assertEqual(response.status_code, 202)
+        json_response = response.json()
+        self.assertIn('job_id', json_response)
+        self.assertEqual(json_response['state'], 'queued')
+
+        job = self.env['moodle.sync.job'].browse(json_response['job_id'])
+        self.assertEqual(job.job_type, 'users')
+
+        status_response = self.url_open(json_response['status_url'])
+        self.assertEqual(status_response.status_code, 200)
+        self.assertEqual(status_response.json()['state'], 'queued')
+
+        with patch('requests.Session.get') as mock_get:
+            mock_response = MagicMock()
+            mock_response.status_code = 200
+            mock_response.json.return_value = {'users': []}
+            mock_response.encoding = 'utf-8'
+            mock_response.iter_content.return_value = [json.dumps({'users': []}).encode()] # core_user_get_users được đọc dạng stream
+            mock_get.return_value = mock_response
+            job._run()
+        self.assertEqual(job.state, 'done')
+        self.assertIn('created_odoo_users', job.get_status()['result'])
+
+    def test_sync_users_paged(self):
+        """Paged mode walks id ranges with core_user_get_users_by_field until enough empty pages."""
+        directory = {
+            3: {'id': 3, 'username': 'paged3', 'fullname': 'Paged User Three', 'email': 'paged3@example.com'},
+            7: {'id': 7, 'username': 'paged7', 'fullname': 'Paged User Seven', 'email': 'paged7@example.com'},
+        }
+        requested_pages = []
+
+        def fake_get(url, params=None, **kwargs):
+            self.assertEqual(params['wsfunction'], 'core_user_get_users_by_field')
+            ids = [v for k, v in params.items() if k.startswith('values[')]
+            requested_pages.append((min(ids), max(ids)))
+            response = MagicMock()
+            response.status_code = 200
+            response.json.return_value = [directory[i] for i in ids if i in directory]
+            return response
+
+        with patch('requests.Session.get', side_effect=fake_get):
+            response = self.url_open('/moodle/sync_users?wait=1&page_size=5&max_empty_pages=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created_odoo_users'], 2)
+        # Trang 1-5, 6-10 có người dùng; 11-15 và 16-20 rỗng thì dừng
+        self.assertEqual(requested_pages, [(1, 5), (6, 10), (11, 15), (16, 20)])
+        self.assertTrue(self.env['res.users'].search([('moodle_id', '=', 7)]))
+
+    def test_sync_users_paged_walks_past_gaps_up_to_known_ids(self):
+        """Empty pages below the highest Moodle id known in Odoo do not end the walk."""
+        self.env['res.users'].create({'name': 'Known Far User', 'login': 'paged40@example.com', 'moodle_id': 40})
+        directory = {
+            3: {'id': 3, 'username': 'paged3', 'fullname': 'Paged User Three', 'email': 'paged3@example.com'},
+            40: {'id': 40, 'username': 'paged40', 'fullname': 'Known Far User', 'email': 'paged40@example.com'},
+        }
+        requested_pages = []
+
+        def fake_get(url, params=None, **kwargs):
+            ids = [v for k, v in params.items() if k.startswith('values[')]
+            requested_pages.append((min(ids), max(ids)))
+            response = MagicMock()
+            response.status_code = 200
+            response.json.return_value = [directory[i] for i in ids if i in directory]
+            return response
+
+        with patch('requests.Session.get', side_effect=fake_get):
+            response = self.url_open('/moodle/sync_users?wait=1&page_size=5&max_empty_pages=2')
+        self.assertEqual(response.status_code, 200)
+        # Khoảng trống 6-35 rộng hơn giới hạn trang rỗng nhưng nằm dưới ID 40 đã biết
+        self.assertEqual(requested_pages[-3:], [(36, 40), (41, 45), (46, 50)])
+        self.assertEqual(response.json()['stopped_on_empty_pages'], 50)
+        self.assertTrue(self.env['res.users'].search([('moodle_id', '=', 3)]))
+
+    def test_apply_batch_isolates_failing_user(self):
+        """A user that cannot be created is skipped; the rest of the batch is still written."""
+        from odoo.addons.digi_moodle_sync.controllers.users_sync import MoodleUserSyncController
+        batch = [{'id': 300 + i, 'username': f'iso{i}', 'fullname': f'Isolated {i}', 'email': f'iso{i}@example.com'} for i in range(5)]
+        ResUsers = type(self.env['res.users'])
+        original_create = ResUsers.create
+
+        def create(records, vals_list):
+            if any(vals.get('login') == 'iso3@example.com' for vals in vals_list):
+                raise ValueError('login trùng')
+            return original_create(records, vals_list)
+
+        with patch.object(ResUsers, 'create', autospec=True, side_effect=create):
+            counters = MoodleUserSyncController()._apply_users_batch(self.env, batch, set())
+
+        self.assertEqual(counters['created_odoo_users'], 4)
+        self.assertEqual(counters['created_moodle_users'], 5)
+        self.assertEqual(sorted(self.env['res.users'].search([('moodle_id', 'in', [300 + i for i in range(5)])]).mapped('moodle_id')), [300, 301, 302, 304])
+        self.assertFalse(self.env['res.partner'].search([('email', '=', 'iso3@example.com')]))
+        failed = self.env['moodle.user'].search([('moodle_id', '=', 303)])
+        self.assertTrue(failed)
+        self.assertFalse(failed.odoo_user_id)
+
+    def test_get_users_by_email(self):
+        """Email lookup only returns the requested users and ignores case and spaces."""
+        found = self.env['res.users'].sudo()._get_users_by_email([' Test_User_With_Rights@Example.com', 'nobody@example.com', None])
+        self.assertEqual(list(found), ['test_user_with_rights@example.com'])
+        self.assertEqual(found['test_user_with_rights@example.com'], self.user_with_rights)
+        self.env.cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'res_partner_lower_email_index'")
+        self.assertTrue(self.env.cr.fetchone())
+
+    def test_get_users_by_email_includes_archived_and_login(self):
+        """Archived users and users whose login is the email are found too."""
+        archived = self.env['res.users'].create({
+            'name': 'Archived', 'login': 'archived@example.com', 'email': 'archived@example.com',
+        })
+        archived.active = False
+        by_login = self.env['res.users'].create({
+            'name': 'Login Only', 'login': 'login.only@example.com', 'email': 'other.address@example.com',
+        })
+        found = self.env['res.users'].sudo()._get_users_by_email(['Archived@example.com', 'login.only@example.com'])
+        self.assertEqual(found['archived@example.com'], archived)
+        self.assertEqual(found['login.only@example.com'], by_login)
+
     def test_sync_users_update_existing(self):
         """Test updating existing Odoo users and moodle.user records."""
         # Tạo user Odoo và moodle.user giả lập đã tồn tại
@@ -161,13 +287,15 @@ class TestUserSync(HttpCase):
             ]
         }
 
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             mock_response = MagicMock()
             mock_response.status_code = 200
             mock_response.json.return_value = mock_api_response
+            mock_response.encoding = 'utf-8'
+            mock_response.iter_content.return_value = [json.dumps(mock_api_response).encode()] # core_user_get_users được đọc dạng stream
             mock_get.return_value = mock_response
 
-            response = self.url_open('/moodle/sync_users')
+            response = self.url_open('/moodle/sync_users?wait=1')
             self.assertEqual(response.status_code, 200)
             json_response = response.json()
             self.assertEqual(json_response['created_odoo_users'], 0)
@@ -186,13 +314,13 @@ class TestUserSync(HttpCase):
 
     def test_sync_users_api_error(self):
         """Test handling of Moodle API error."""
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             mock_response = MagicMock()
             mock_response.status_code = 500 # Lỗi server từ Moodle
             mock_response.raise_for_status.side_effect = requests.exceptions.HTTPError("Fake HTTP Error")
             mock_get.return_value = mock_response
 
-            response = self.url_open('/moodle/sync_users')
+            response = self.url_open('/moodle/sync_users?wait=1')
             self.assertEqual(response.status_code, 502) # Hoặc mã lỗi tương ứng bạn đặt
             json_response = response.json()
             self.assertIn('error', json_response)
@@ -201,7 +329,7 @@ class TestUserSync(HttpCase):
     def test_sync_users_missing_config(self):
         """Test handling of missing Moodle configuration."""
         self.env['ir.config_parameter'].sudo().set_param('digi_moodle_sync.token', False)
-        response = self.url_open('/moodle/sync_users')
+        response = self.url_open('/moodle/sync_users?wait=1')
         self.assertEqual(response.status_code, 503) # Hoặc mã lỗi bạn đặt cho config thiếu
         json_response = response.json()
         self.assertIn('error', json_response)
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+import unittest
+
+from odoo.tests.common import TransactionCase, tagged
+
+from odoo.addons.digi_moodle_sync.controllers.users_sync import MoodleUserSyncController, USER_BATCH_SIZE
+
+_logger = logging.getLogger(__name__)
+
+BENCHMARK_USERS = 5000
+# Đường tạo từng người dùng chậm hơn nhiều, chỉ đo trên một mẫu nhỏ
+BASELINE_USERS = 200
+BENCHMARK_MOODLE_ID_START = 800000
+
+# Không chạy cùng bộ test thường: odoo-bin --test-tags moodle_benchmark
+@tagged('-standard', 'moodle_benchmark')
+class TestUserSyncBenchmark(TransactionCase):
+
+    def _moodle_users(self, count, offset=0):
+        return [{
+            'id': BENCHMARK_MOODLE_ID_START + offset + i,
+            'username': f'bench{offset + i}',
+            'fullname': f'Bench User {offset + i}',
+            'email': f'bench{offset + i}@example.com',
+        } for i in range(count)]
+
+    def test_provisioning_throughput(self):
+        """Per-user cost of the batched provisioning path vs one create per user."""
+        controller = MoodleUserSyncController()
+        moodle_users = self._moodle_users(BENCHMARK_USERS)
+        processed = set()
+        created = 0
+        queries_before = self.env.cr.sql_log_count
+        started = time.perf_counter()
+        for start in range(0, len(moodle_users), USER_BATCH_SIZE):
+            counts = controller._apply_users_batch(self.env, moodle_users[start:start + USER_BATCH_SIZE], processed)
+            created += counts['created_odoo_users']
+        self.env['base'].flush()
+        batched_seconds = time.perf_counter() - started
+        batched_queries = self.env.cr.sql_log_count - queries_before
+        self.assertEqual(created, BENCHMARK_USERS)
+
+        ResPartner = self.env['res.partner'].sudo()
+        ResUsers = self.env['res.users'].sudo()
+        started = time.perf_counter()
+        for u in self._moodle_users(BASELINE_USERS, offset=BENCHMARK_USERS):
+            partner = ResPartner.create({'name': u['fullname'], 'email': u['email']})
+            ResUsers.with_context(no_reset_password=True).create({
+                'name': u['fullname'],
+                'login': u['email'],
+                'email': u['email'],
+                'moodle_id': u['id'],
+                'partner_id': partner.id,
+            })
+        self.env['base'].flush()
+        baseline_seconds = time.perf_counter() - started
+
+        _logger.info(
+            "Provisioning benchmark: batched %s users in %.2fs (%.2f ms/user, %.1f queries/user); "
+            "one-by-one %s users in %.2fs (%.2f ms/user)",
+            BENCHMARK_USERS, batched_seconds, batched_seconds * 1000 / BENCHMARK_USERS, batched_queries / BENCHMARK_USERS,
+            BASELINE_USERS, baseline_seconds, baseline_seconds * 1000 / BASELINE_USERS)
+
+if __name__ == '__main__':
+    unittest.main()
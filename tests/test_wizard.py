@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import json
 import unittest
 from unittest.mock import patch, MagicMock
 
@@ -40,9 +41,9 @@ class TestMoodleSyncWizard(TransactionCase):
     @patch('odoo.addons.digi_moodle_sync.wizard.moodle_sync_wizard.MoodleSyncWizard._sync_activities')
     @patch('odoo.addons.digi_moodle_sync.wizard.moodle_sync_wizard.MoodleSyncWizard._sync_assignments')
     @patch('odoo.addons.digi_moodle_sync.wizard.moodle_sync_wizard.MoodleSyncWizard._sync_submissions')
-    @patch('odoo.addons.digi_moodle_sync.controllers.teacher_sync.MoodleTeacherSync.sync_teachers') # Patch method của controller
+    @patch('odoo.addons.digi_moodle_sync.controllers.teacher_sync.MoodleTeacherSync._sync_teachers') # Patch method của controller
     def test_wizard_sync_all_success(self, mock_sync_teachers, mock_sync_submissions, mock_sync_assignments, mock_sync_activities, mock_sync_users):
-        """Test wizard action_sync with type 'all' success (mocking sync methods)."""
+        """Test wizard _run_sync with type 'all' success (mocking sync methods)."""
         if not self.moodle_sync_manager_group:
             self.skipTest("Moodle Sync Manager group not found, test might not reflect true permission pass.")
 
@@ -51,17 +52,15 @@ class TestMoodleSyncWizard(TransactionCase):
         mock_sync_activities.return_value = None
         mock_sync_assignments.return_value = None
         mock_sync_submissions.return_value = None
-        mock_sync_teachers.return_value = "Teachers synced successfully via wizard mock."
+        mock_sync_teachers.return_value = ({'message': 'Teachers synced successfully via wizard mock.'}, 200)
 
         wizard = self.env['moodle.sync.wizard'].with_user(self.user_with_rights).create({
             'sync_type': 'all'
         })
-        result_action = wizard.action_sync()
+        payload, status = wizard._run_sync()
 
-        self.assertIsNotNone(result_action)
-        self.assertEqual(result_action.get('type'), 'ir.actions.client')
-        self.assertEqual(result_action.get('tag'), 'display_notification')
-        self.assertEqual(result_action.get('params', {}).get('type'), 'success')
+        self.assertEqual(status, 200)
+        self.assertNotIn('error', payload)
 
         mock_sync_users.assert_called_once()
         mock_sync_activities.assert_called_once()
@@ -71,7 +70,7 @@ class TestMoodleSyncWizard(TransactionCase):
         
     @patch('odoo.addons.digi_moodle_sync.wizard.moodle_sync_wizard.MoodleSyncWizard._sync_activities')
     def test_wizard_sync_activity_only(self, mock_sync_activities):
-        """Test wizard action_sync with type 'activity'."""
+        """Test wizard _run_sync with type 'activity'."""
         if not self.moodle_sync_manager_group:
             self.skipTest("Moodle Sync Manager group not found.")
 
@@ -80,10 +79,22 @@ class TestMoodleSyncWizard(TransactionCase):
         wizard = self.env['moodle.sync.wizard'].with_user(self.user_with_rights).create({
             'sync_type': 'activity'
         })
-        wizard.action_sync()
+        wizard._run_sync()
         mock_sync_activities.assert_called_once()
         # Cũng cần mock _sync_users vì nó luôn được gọi trước
 
+    def test_wizard_action_sync_enqueues_job(self):
+        """action_sync only queues a moodle.sync.job for the cron runner."""
+        wizard = self.env['moodle.sync.wizard'].with_user(self.user_with_rights).create({
+            'sync_type': 'teacher'
+        })
+        result_action = wizard.action_sync()
+        self.assertEqual(result_action.get('tag'), 'display_notification')
+        self.assertEqual(result_action.get('params', {}).get('type'), 'success')
+        job = self.env['moodle.sync.job'].search([('job_type', '=', 'wizard')], limit=1)
+        self.assertEqual(job.state, 'queued')
+        self.assertEqual(json.loads(job.params), {'sync_type': 'teacher'})
+
     # Thêm test cho các trường hợp lỗi cấu hình (thiếu token/url)
     def test_wizard_missing_config(self):
         """Test wizard when Moodle config is missing."""
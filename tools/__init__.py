@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+from . import moodle_client
+from . import fetch_pool
+from . import bulk
+from . import sync_cursor
+from . import roster_cache
+from . import json_stream
+from . import throttle
+from . import metrics
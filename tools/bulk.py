@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+import logging
+
+from psycopg2.extras import execute_values
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_UPSERT_BATCH_SIZE = 1000
+
+LOG_ACCESS_COLUMNS = ('create_uid', 'create_date', 'write_uid', 'write_date')
+
+
+def _apply_isolated(env, items, apply, failed, on_success=None):
+    """Run ``apply(items)`` in a savepoint; when it fails, split in halves to isolate the bad items.
+
+    A single failing item costs about 2*log2(len(items)) extra savepoints
+    instead of one statement per item. Failing items land in ``failed`` as
+    ``{item: error message}``. ``on_success`` receives the return value of
+    each ``apply`` that went through. Returns the number of items applied.
+    """
+    try:
+        with env.cr.savepoint():
+            outcome = apply(items)
+    except Exception as e:
+        if len(items) == 1:
+            failed[items[0]] = str(e)
+            return 0
+        middle = len(items) // 2
+        return (_apply_isolated(env, items[:middle], apply, failed, on_success)
+                + _apply_isolated(env, items[middle:], apply, failed, on_success))
+    if on_success:
+        on_success(outcome)
+    return len(items)
+
+
+def bulk_upsert(env, model_name, rows, conflict_fields, update_fields=None, batch_size=DEFAULT_UPSERT_BATCH_SIZE,
+                seen_field='last_sync_date'):
+    """Insert or update ``rows`` of ``model_name`` with ``INSERT ... ON CONFLICT``.
+
+    ``conflict_fields`` must match a UNIQUE constraint of the model. Rows are
+    plain ORM vals dicts sharing the same keys; values go through the field
+    ``convert_to_column`` so many2one, selection and datetime values are
+    written exactly as the ORM would. Fields missing from the rows get their
+    default on insert and are left untouched on update.
+
+    Existing rows are only rewritten when one of the update fields really
+    differs (``IS DISTINCT FROM``). For unchanged rows only ``seen_field``
+    is refreshed, in one batched ``UPDATE ... FROM (VALUES ...)`` per batch,
+    so a re-sync of identical data does not rewrite every tuple.
+
+    Each batch runs in its own savepoint and is sent with ``execute_values``.
+    When a batch fails (constraint, bad value) it is split in halves until
+    the bad rows are isolated: they are reported in ``failed`` and every
+    other row is still written. Rows with a value the field cannot convert
+    are reported in ``failed`` before any statement runs. The ORM cache of the touched records is
+    invalidated afterwards.
+
+    Returns ``{'ids': {conflict key tuple: id}, 'created': n, 'updated': n,
+    'unchanged': n, 'failed': {conflict key tuple: error message}}``.
+    """
+    result = {'ids': {}, 'created': 0, 'updated': 0, 'unchanged': 0, 'failed': {}}
+    if not rows:
+        return result
+
+    Model = env[model_name].sudo()
+    conflict_fields = list(conflict_fields)
+    row_fields = list(rows[0])
+    if update_fields is None:
+        update_fields = [f for f in row_fields if f not in conflict_fields]
+    if seen_field not in row_fields:
+        seen_field = None
+    compare_fields = [f for f in update_fields if f != seen_field]
+
+    # ON CONFLICT DO UPDATE refuses to touch the same row twice in one
+    # statement: keep the last vals for each key. A value the field refuses
+    # (e.g. an unknown selection key) only rejects its own row.
+    rows_by_key = {}
+    for vals in rows:
+        try:
+            converted = {
+                fname: Model._fields[fname].convert_to_column(vals.get(fname), Model)
+                for fname in row_fields
+            }
+        except Exception as e:
+            result['failed'][tuple(vals.get(f) for f in conflict_fields)] = str(e)
+            continue
+        rows_by_key[tuple(converted[f] for f in conflict_fields)] = converted
+
+    default_fields = [
+        fname for fname, field in Model._fields.items()
+        if field.store and field.column_type and fname not in row_fields
+        and fname != 'id' and fname not in LOG_ACCESS_COLUMNS
+    ]
+    defaults = {
+        fname: Model._fields[fname].convert_to_column(value, Model)
+        for fname, value in Model.default_get(default_fields).items()
+        if fname in default_fields
+    }
+
+    now = env.cr.now()
+    uid = env.uid
+    insert_fields = row_fields + list(defaults)
+    if Model._log_access:
+        insert_fields += list(LOG_ACCESS_COLUMNS)
+        update_fields = list(update_fields) + ['write_uid', 'write_date']
+
+    table = Model._table
+    columns = ', '.join(f'"{f}"' for f in insert_fields)
+    conflict_clause = ', '.join(f'"{f}"' for f in conflict_fields)
+    if compare_fields:
+        set_clause = ', '.join(f'"{f}" = EXCLUDED."{f}"' for f in update_fields)
+        current = ', '.join(f'"{table}"."{f}"' for f in compare_fields)
+        incoming = ', '.join(f'EXCLUDED."{f}"' for f in compare_fields)
+        on_conflict = f'DO UPDATE SET {set_clause} WHERE ({current}) IS DISTINCT FROM ({incoming})'
+    else:
+        on_conflict = 'DO NOTHING'
+    query = (
+        f'INSERT INTO "{table}" ({columns}) VALUES %s '
+        f'ON CONFLICT ({conflict_clause}) {on_conflict} '
+        f'RETURNING id, (xmax = 0), {conflict_clause}'
+    )
+    key_aliases = [f'k{i}' for i in range(len(conflict_fields))]
+    key_join = ' AND '.join(f't."{f}" = v.{k}' for f, k in zip(conflict_fields, key_aliases))
+    key_columns = ', '.join(f't."{f}"' for f in conflict_fields)
+    touch_query = (
+        f'UPDATE "{table}" AS t SET "{seen_field}" = v.seen::timestamp '
+        f'FROM (VALUES %s) AS v({", ".join(key_aliases)}, seen) '
+        f'WHERE {key_join} RETURNING t.id, {key_columns}'
+    )
+
+    Model.flush(row_fields)
+
+    values = {}
+    for key, converted in rows_by_key.items():
+        row = [converted[f] for f in row_fields] + [defaults[f] for f in defaults]
+        if Model._log_access:
+            row += [uid, now, uid, now]
+        values[key] = tuple(row)
+    keys = list(rows_by_key)
+
+    def upsert_batch(batch_keys):
+        batch_ids = {}
+        created = updated = 0
+        returned = execute_values(env.cr._obj, query, [values[key] for key in batch_keys], page_size=len(batch_keys), fetch=True)
+        for rec_id, inserted, *key in returned:
+            batch_ids[tuple(key)] = rec_id
+            if inserted:
+                created += 1
+            else:
+                updated += 1
+
+        unchanged = [key for key in batch_keys if key not in batch_ids]
+        if unchanged and seen_field:
+            seen_rows = [key + (rows_by_key[key][seen_field],) for key in unchanged]
+            seen = execute_values(env.cr._obj, touch_query, seen_rows, page_size=len(seen_rows), fetch=True)
+            for rec_id, *key in seen:
+                batch_ids[tuple(key)] = rec_id
+        return batch_ids, created, updated, len(unchanged)
+
+    def merge(outcome):
+        batch_ids, created, updated, unchanged = outcome
+        result['ids'].update(batch_ids)
+        result['created'] += created
+        result['updated'] += updated
+        result['unchanged'] += unchanged
+
+    for start in range(0, len(keys), batch_size):
+        _apply_isolated(env, keys[start:start + batch_size], upsert_batch, result['failed'], merge)
+
+    Model.invalidate_cache(ids=list(result['ids'].values()))
+    if result['failed']:
+        _logger.warning(f"bulk_upsert {model_name}: {len(result['failed'])} rows rejected, first: {next(iter(result['failed'].values()))}")
+    _logger.debug(f"bulk_upsert {model_name}: {result['created']} created, {result['updated']} updated, {result['unchanged']} unchanged")
+    return result
+
+
+def _vals_key(vals):
+    """Hashable form of a vals dict, to group records receiving the same values."""
+    return repr(sorted(vals.items()))
+
+
+def _is_plain_column(Model, fname):
+    """Whether ``fname`` can be written with SQL without skipping ORM side effects."""
+    field = Model._fields.get(fname)
+    if not field or not field.store or not field.column_type or fname == 'id' or fname in LOG_ACCESS_COLUMNS:
+        return False
+    if field.compute or field.related or field.inverse or field.translate or field.type in ('binary', 'one2many', 'many2many'):
+        return False
+    # Trường kéo theo trường tính toán lưu trữ hoặc ràng buộc Python phải đi qua write()
+    if Model.pool.field_triggers.get(field):
+        return False
+    return not any(fname in getattr(method, '_constrains', ()) for method in Model._constraint_methods)
+
+
+def _split_inherited(Model, updates):
+    """Move the vals of ``_inherits`` fields of ``updates`` to the parent records.
+
+    Returns ``(own updates, {parent model: ({parent id: vals}, {parent id: [record ids]})})``.
+    """
+    parent_models = {
+        fname: Model._fields[fname].inherited_field.model_name
+        for vals in updates.values() for fname in vals
+        if fname in Model._fields and Model._fields[fname].inherited
+    }
+    if not parent_models:
+        return updates, {}
+    link_fields = {parent_model: Model._inherits[parent_model] for parent_model in set(parent_models.values())}
+    records = Model.browse(list(updates))
+    own_updates = {}
+    parents = {parent_model: ({}, {}) for parent_model in link_fields}
+    for record in records:
+        vals = updates[record.id]
+        own_updates[record.id] = {fname: value for fname, value in vals.items() if fname not in parent_models}
+        for parent_model, link_field in link_fields.items():
+            parent_vals = {fname: value for fname, value in vals.items() if parent_models.get(fname) == parent_model}
+            parent_id = record[link_field].id
+            if parent_vals and parent_id:
+                parent_updates, children = parents[parent_model]
+                parent_updates.setdefault(parent_id, {}).update(parent_vals)
+                children.setdefault(parent_id, []).append(record.id)
+    return own_updates, parents
+
+
+def bulk_write(env, model_name, updates, batch_size=DEFAULT_UPSERT_BATCH_SIZE):
+    """Apply ``updates`` (``{record id: vals}``) of ``model_name`` in a few statements.
+
+    Fields inherited through ``_inherits`` (e.g. ``name`` and ``email`` of
+    res.users) are written on the parent records by a nested bulk_write.
+    Records receiving identical vals are written together with one ORM
+    ``write``. The remaining records are grouped by the set of fields they
+    update; when all those fields are plain stored columns (no compute,
+    related, inverse, translation, dependent stored field or Python
+    constraint) each group is sent as one ``UPDATE ... FROM (VALUES ...)``
+    per batch, otherwise the group is written record by record inside one
+    savepoint, so dependent stored fields are recomputed once per batch.
+
+    Each statement runs in a savepoint; a failing one is bisected so only
+    the bad records are reported, the rest of its group is still written.
+    A record whose parent write failed is reported as failed too.
+
+    Returns ``{'updated': n, 'failed': {record id: error message}}``.
+    """
+    result = {'updated': 0, 'failed': {}}
+    updates = {rec_id: vals for rec_id, vals in updates.items() if vals}
+    if not updates:
+        return result
+
+    Model = env[model_name].sudo()
+    own_updates, parents = _split_inherited(Model, updates)
+    for parent_model, (parent_updates, children) in parents.items():
+        parent_result = bulk_write(env, parent_model, parent_updates, batch_size=batch_size)
+        for parent_id, error in parent_result['failed'].items():
+            for rec_id in children[parent_id]:
+                result['failed'][rec_id] = error
+    own_updates = {rec_id: vals for rec_id, vals in own_updates.items() if vals}
+
+    ids_by_vals = {}
+    for rec_id, vals in own_updates.items():
+        ids_by_vals.setdefault(_vals_key(vals), []).append(rec_id)
+
+    def orm_write(ids):
+        Model.browse(ids).write(own_updates[ids[0]])
+
+    def orm_write_each(ids):
+        for rec_id in ids:
+            Model.browse(rec_id).write(own_updates[rec_id])
+
+    failed = {}
+    sql_groups = {}
+    orm_groups = {}
+    for ids in ids_by_vals.values():
+        vals = own_updates[ids[0]]
+        if len(ids) > 1:
+            _apply_isolated(env, ids, orm_write, failed)
+        elif all(_is_plain_column(Model, fname) for fname in vals):
+            sql_groups.setdefault(tuple(sorted(vals)), []).append(ids[0])
+        else:
+            orm_groups.setdefault(tuple(sorted(vals)), []).append(ids[0])
+
+    for ids in orm_groups.values():
+        for start in range(0, len(ids), batch_size):
+            _apply_isolated(env, ids[start:start + batch_size], orm_write_each, failed)
+
+    table = Model._table
+    written_ids = []
+    for fnames, ids in sql_groups.items():
+        fields_ = [Model._fields[fname] for fname in fnames]
+        aliases = [f'v{i}' for i in range(len(fnames))]
+        set_clause = ', '.join(f'"{fname}" = v.{alias}' for fname, alias in zip(fnames, aliases))
+        if Model._log_access:
+            set_clause += f', "write_uid" = {int(env.uid)}, "write_date" = (now() at time zone \'UTC\')'
+        query = (
+            f'UPDATE "{table}" AS t SET {set_clause} '
+            f'FROM (VALUES %s) AS v(id, {", ".join(aliases)}) '
+            f'WHERE t.id = v.id RETURNING t.id'
+        )
+        # Kiểu của từng cột, để VALUES không bị suy ra thành text
+        template = '(%s, ' + ', '.join(f'%s::{field.column_type[1]}' for field in fields_) + ')'
+        Model.flush(list(fnames))
+
+        def sql_write(batch_ids, query=query, template=template, fnames=fnames):
+            rows = [
+                (rec_id,) + tuple(Model._fields[fname].convert_to_column(own_updates[rec_id][fname], Model) for fname in fnames)
+                for rec_id in batch_ids
+            ]
+            returned = execute_values(env.cr._obj, query, rows, template=template, page_size=len(rows), fetch=True)
+            written_ids.extend(rec_id for rec_id, in returned)
+
+        for start in range(0, len(ids), batch_size):
+            _apply_isolated(env, ids[start:start + batch_size], sql_write, failed)
+
+    Model.invalidate_cache(ids=written_ids)
+    result['failed'].update(failed)
+    result['updated'] = len(updates) - len(result['failed'])
+    _logger.debug(f"bulk_write {model_name}: {result['updated']} updated, {len(result['failed'])} failed, "
+                  f"{len(ids_by_vals)} value groups, {len(sql_groups)} SQL / {len(orm_groups)} ORM field groups")
+    return result
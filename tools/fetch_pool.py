@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from .metrics import bind_stats
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_FETCH_CONCURRENCY = 4
+
+_SENTINEL = object()
+
+
+def get_fetch_concurrency(env):
+    """Read digi_moodle_sync.fetch_concurrency, never below 1."""
+    value = env['ir.config_parameter'].sudo().get_param('digi_moodle_sync.fetch_concurrency')
+    try:
+        return max(int(value or DEFAULT_FETCH_CONCURRENCY), 1)
+    except (TypeError, ValueError):
+        _logger.warning(f"Invalid digi_moodle_sync.fetch_concurrency '{value}', using {DEFAULT_FETCH_CONCURRENCY}")
+        return DEFAULT_FETCH_CONCURRENCY
+
+
+def fetch_concurrently(fetch_func, items, max_workers=DEFAULT_FETCH_CONCURRENCY):
+    """Run ``fetch_func(item)`` in a bounded thread pool.
+
+    Yields ``(item, result, error)`` tuples in completion order so the caller
+    can write each payload with its own cursor while the next ones are still
+    in flight. At most ``2 * max_workers`` calls are pending at any time,
+    which keeps memory flat for very large item lists.
+
+    ``fetch_func`` runs outside the request thread: it must only do network
+    work and must not touch ``request.env`` or any ORM record.
+    """
+    max_workers = max(int(max_workers or 1), 1)
+    items_iter = iter(items)
+    # Các lần gọi trong luồng tải vẫn được tính vào thống kê của lượt đồng bộ đang chạy
+    fetch_func = bind_stats(fetch_func)
+
+    if max_workers == 1:
+        for item in items_iter:
+            try:
+                yield item, fetch_func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    window = max_workers * 2
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='moodle_fetch') as executor:
+        pending = {}
+        for item in items_iter:
+            pending[executor.submit(fetch_func, item)] = item
+            if len(pending) >= window:
+                break
+        while pending:
+            done, _not_done = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                error = future.exception()
+                yield item, (None if error else future.result()), error
+                next_item = next(items_iter, _SENTINEL)
+                if next_item is not _SENTINEL:
+                    pending[executor.submit(fetch_func, next_item)] = next_item
+
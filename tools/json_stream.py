@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import codecs
+import json
+import logging
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_STREAM_CHUNK_SIZE = 64 * 1024
+
+_WHITESPACE = ' \t\n\r'
+
+
+class JsonArrayStream(object):
+    """Iterate the items of one array of a JSON object as it is downloaded.
+
+    ``JsonArrayStream(response, 'users')`` reads a ``stream=True``
+    ``requests.Response`` holding ``{"users": [...], ...}`` chunk by chunk
+    and yields each element of ``users`` as soon as it is complete, so only
+    the current chunk and item are held in memory instead of the whole body
+    and its object tree. The other top-level keys, which Moodle keeps small
+    (``warnings``, or ``exception``/``errorcode``/``message`` on errors),
+    are decoded into :attr:`other`. :attr:`found` tells whether the array
+    key was present at all.
+    """
+
+    def __init__(self, response, key, chunk_size=DEFAULT_STREAM_CHUNK_SIZE):
+        self.key = key
+        self.other = {}
+        self.found = False
+        self._chunks = iter(response.iter_content(chunk_size=chunk_size))
+        self._decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+        self._json = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._eof = False
+
+    def __iter__(self):
+        self._expect('{')
+        while True:
+            if self._peek() == '}':
+                return
+            name = self._value()
+            self._expect(':')
+            if name == self.key and self._peek() == '[':
+                self.found = True
+                self._expect('[')
+                if self._peek() == ']':
+                    self._pos += 1
+                else:
+                    while True:
+                        yield self._value()
+                        if self._next_separator(']'):
+                            break
+            else:
+                self.other[name] = self._value()
+            if self._next_separator('}'):
+                return
+
+    def batches(self, size):
+        """Yield lists of at most ``size`` items."""
+        batch = []
+        for item in self:
+            batch.append(item)
+            if len(batch) >= size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _fill(self):
+        """Read one more chunk; return False at end of body."""
+        if self._eof:
+            return False
+        # Drop what was consumed so the buffer never grows with the body
+        self._buffer = self._buffer[self._pos:]
+        self._pos = 0
+        for chunk in self._chunks:
+            if chunk:
+                self._buffer += self._decoder.decode(chunk)
+                return True
+        self._buffer += self._decoder.decode(b'', final=True)
+        self._eof = True
+        return True
+
+    def _peek(self):
+        while True:
+            while self._pos < len(self._buffer) and self._buffer[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buffer):
+                return self._buffer[self._pos]
+            if not self._fill():
+                raise ValueError("Unexpected end of JSON response")
+
+    def _expect(self, char):
+        found = self._peek()
+        if found != char:
+            raise ValueError(f"Invalid JSON response: expected '{char}' but found '{found}' at offset {self._pos}")
+        self._pos += 1
+
+    def _next_separator(self, closing):
+        """Consume ',' (returns False) or ``closing`` (returns True)."""
+        char = self._peek()
+        self._pos += 1
+        if char == ',':
+            return False
+        if char == closing:
+            return True
+        raise ValueError(f"Invalid JSON response: unexpected '{char}' at offset {self._pos - 1}")
+
+    def _value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self._json.raw_decode(self._buffer, self._pos)
+            except json.JSONDecodeError:
+                # Most likely the value is cut by the chunk boundary
+                if not self._fill():
+                    raise
+                continue
+            # A number ending exactly at the buffer end may continue in the next chunk
+            if end == len(self._buffer) and not self._eof:
+                self._fill()
+                continue
+            self._pos = end
+            return value
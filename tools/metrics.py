@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import threading
+from contextlib import contextmanager
+
+_logger = logging.getLogger(__name__)
+
+# Biên trên (giây) của các nhóm histogram thời gian gọi, giống bucket của Prometheus
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+PERCENTILES = (50, 95, 99)
+
+_current = threading.local()
+
+
+def _empty_function_stats():
+    return {
+        'calls': 0,
+        'retries': 0,
+        'bytes': 0,
+        'seconds': 0.0,
+        'status': {},
+        'buckets': [0] * (len(LATENCY_BUCKETS) + 1),
+    }
+
+
+def bucket_percentile(buckets, percentile):
+    """Estimate a percentile (0-100) from histogram ``buckets``, interpolating inside a bucket."""
+    total = sum(buckets)
+    if not total:
+        return None
+    rank = total * percentile / 100.0
+    seen = 0
+    for index, count in enumerate(buckets):
+        if count and seen + count >= rank:
+            if index >= len(LATENCY_BUCKETS):
+                # Nhóm cuối (+Inf) không có biên trên
+                return float(LATENCY_BUCKETS[-1])
+            lower = LATENCY_BUCKETS[index - 1] if index else 0.0
+            return lower + (LATENCY_BUCKETS[index] - lower) * (rank - seen) / count
+        seen += count
+    return float(LATENCY_BUCKETS[-1])
+
+
+class CallStats(object):
+    """Thread-safe per-wsfunction statistics of Moodle webservice calls.
+
+    Latencies are kept as histogram bucket counts rather than samples, so
+    statistics of several cron ticks or jobs merge exactly and percentiles
+    are estimated from the buckets. :meth:`to_dict` / the ``data`` argument
+    round-trip through JSON.
+    """
+
+    def __init__(self, data=None):
+        self._lock = threading.Lock()
+        self.functions = {}
+        if data:
+            self.merge(data)
+
+    @classmethod
+    def from_json(cls, value):
+        return cls(json.loads(value) if value else None)
+
+    def record(self, wsfunction, seconds, status, size=0, retries=0):
+        bucket = next((i for i, bound in enumerate(LATENCY_BUCKETS) if seconds <= bound), len(LATENCY_BUCKETS))
+        with self._lock:
+            stats = self.functions.setdefault(wsfunction, _empty_function_stats())
+            stats['calls'] += 1
+            stats['retries'] += retries
+            stats['bytes'] += size or 0
+            stats['seconds'] += seconds
+            stats['status'][str(status)] = stats['status'].get(str(status), 0) + 1
+            stats['buckets'][bucket] += 1
+
+    def merge(self, other):
+        """Add the statistics of another CallStats or of its ``to_dict()``."""
+        data = other.to_dict() if isinstance(other, CallStats) else other
+        with self._lock:
+            for wsfunction, theirs in (data.get('functions') or {}).items():
+                stats = self.functions.setdefault(wsfunction, _empty_function_stats())
+                for key in ('calls', 'retries', 'bytes', 'seconds'):
+                    stats[key] += theirs.get(key, 0)
+                for status, count in (theirs.get('status') or {}).items():
+                    stats['status'][status] = stats['status'].get(status, 0) + count
+                for index, count in enumerate((theirs.get('buckets') or [])[:len(stats['buckets'])]):
+                    stats['buckets'][index] += count
+        return self
+
+    def to_dict(self):
+        with self._lock:
+            return {'functions': json.loads(json.dumps(self.functions))}
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), sort_keys=True)
+
+    @property
+    def total_calls(self):
+        return sum(stats['calls'] for stats in self.functions.values())
+
+    @property
+    def total_seconds(self):
+        return sum(stats['seconds'] for stats in self.functions.values())
+
+    def summary(self):
+        """``{wsfunction: {calls, errors, retries, bytes, seconds, p50, p95, p99}}``, slowest first."""
+        result = {}
+        for wsfunction, stats in sorted(self.functions.items(), key=lambda item: -item[1]['seconds']):
+            result[wsfunction] = {
+                'calls': stats['calls'],
+                'errors': sum(count for status, count in stats['status'].items() if status != '200'),
+                'retries': stats['retries'],
+                'bytes': stats['bytes'],
+                'seconds': round(stats['seconds'], 3),
+                **{f'p{p}': round(bucket_percentile(stats['buckets'], p) or 0.0, 3) for p in PERCENTILES},
+            }
+        return result
+
+
+def current_stats():
+    """The CallStats collecting the calls of the current thread, if any."""
+    return getattr(_current, 'stats', None)
+
+
+@contextmanager
+def collect(stats):
+    """Record the Moodle calls made by this thread into ``stats`` while the block runs."""
+    previous = current_stats()
+    _current.stats = stats
+    try:
+        yield stats
+    finally:
+        _current.stats = previous
+
+
+def bind_stats(func, stats=None):
+    """Wrap ``func`` so it records into ``stats`` (default: the caller's) from any thread."""
+    stats = stats or current_stats()
+    if stats is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        with collect(stats):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def record_call(wsfunction, seconds, status, size=0, retries=0):
+    stats = current_stats()
+    if stats is not None:
+        stats.record(wsfunction, seconds, status, size=size, retries=retries)
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(stats_by_job_type, run_seconds_by_job_type=None):
+    """Render ``{job_type: CallStats}`` in the Prometheus text exposition format."""
+    lines = [
+        '# HELP moodle_ws_calls_total Moodle webservice calls by function and final status.',
+        '# TYPE moodle_ws_calls_total counter',
+    ]
+    for job_type, stats in sorted(stats_by_job_type.items()):
+        for wsfunction, data in sorted(stats.functions.items()):
+            for status, count in sorted(data['status'].items()):
+                lines.append(f'moodle_ws_calls_total{{job_type="{_escape_label(job_type)}",wsfunction="{_escape_label(wsfunction)}",status="{_escape_label(status)}"}} {count}')
+
+    lines += [
+        '# HELP moodle_ws_call_duration_seconds Duration of Moodle webservice calls, retries included.',
+        '# TYPE moodle_ws_call_duration_seconds histogram',
+    ]
+    for job_type, stats in sorted(stats_by_job_type.items()):
+        for wsfunction, data in sorted(stats.functions.items()):
+            labels = f'job_type="{_escape_label(job_type)}",wsfunction="{_escape_label(wsfunction)}"'
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), data['buckets']):
+                cumulative += count
+                lines.append(f'moodle_ws_call_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'moodle_ws_call_duration_seconds_sum{{{labels}}} {data["seconds"]:.6f}')
+            lines.append(f'moodle_ws_call_duration_seconds_count{{{labels}}} {data["calls"]}')
+
+    for metric, key, help_text in (
+        ('moodle_ws_retries_total', 'retries', 'Retried attempts of Moodle webservice calls.'),
+        ('moodle_ws_response_bytes_total', 'bytes', 'Bytes received from Moodle webservice calls.'),
+    ):
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} counter']
+        for job_type, stats in sorted(stats_by_job_type.items()):
+            for wsfunction, data in sorted(stats.functions.items()):
+                lines.append(f'{metric}{{job_type="{_escape_label(job_type)}",wsfunction="{_escape_label(wsfunction)}"}} {data[key]}')
+
+    if run_seconds_by_job_type:
+        lines += [
+            '# HELP moodle_sync_job_run_seconds_total Wall time spent running sync jobs (Moodle calls, ORM and the rest).',
+            '# TYPE moodle_sync_job_run_seconds_total counter',
+        ]
+        for job_type, seconds in sorted(run_seconds_by_job_type.items()):
+            lines.append(f'moodle_sync_job_run_seconds_total{{job_type="{_escape_label(job_type)}"}} {seconds:.6f}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .metrics import record_call
+from .throttle import (get_governor, OVERLOAD_STATUS_CODES, DEFAULT_RATE_LIMIT, DEFAULT_MAX_CONCURRENCY,
+                       DEFAULT_TARGET_LATENCY)
+
+_logger = logging.getLogger(__name__)
+
+MOODLE_REST_PATH = '/webservice/rest/server.php'
+
+DEFAULT_TIMEOUT = 30
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF_FACTOR = 0.5
+MAX_BACKOFF_SECONDS = 30
+
+# Mã HTTP tạm thời, có thể gửi lại request sau một khoảng chờ
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(pool_size=DEFAULT_POOL_SIZE):
+    """Return the pooled keep-alive session of the current worker process.
+
+    Sessions are keyed by PID so a prefork worker never reuses sockets
+    inherited from its parent.
+    """
+    key = (os.getpid(), pool_size)
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            # Retries are handled by MoodleClient so every attempt is logged
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Connection': 'keep-alive'})
+            _sessions[key] = session
+        return session
+
+
+def _get_int_param(params, key, default):
+    try:
+        value = int(params.get_param(key) or default)
+    except (TypeError, ValueError):
+        _logger.warning(f"Invalid value for {key}, falling back to {default}")
+        return default
+    return value if value >= 0 else default
+
+
+def _get_float_param(params, key, default):
+    try:
+        value = float(params.get_param(key) or default)
+    except (TypeError, ValueError):
+        _logger.warning(f"Invalid value for {key}, falling back to {default}")
+        return default
+    return value if value >= 0 else default
+
+
+def _is_exception_payload(response):
+    """Whether a (non streamed) answer is a Moodle ``{"exception": ...}`` error."""
+    content = response.content if response.status_code == 200 else None
+    return isinstance(content, bytes) and content[:64].lstrip().startswith(b'{"exception"')
+
+
+def _call_status(response, stream):
+    """Status label of a finished call for the metrics: HTTP code, 'exception' or 'error'."""
+    if response is None:
+        return 'error'
+    if not stream and _is_exception_payload(response):
+        return 'exception'
+    return str(response.status_code)
+
+
+def _response_size(response, stream):
+    if response is None:
+        return 0
+    if not stream:
+        content = response.content
+        return len(content) if isinstance(content, bytes) else 0
+    try:
+        return int(response.headers.get('Content-Length') or 0)
+    except (TypeError, ValueError, AttributeError):
+        return 0
+
+
+class MoodleClient(object):
+    """Thin Moodle webservice client sharing one pooled session per worker.
+
+    Every call goes through the site's :class:`MoodleGovernor`: a token
+    bucket caps calls per second and an adaptive limit caps calls in flight,
+    shrinking on HTTP 429/503, Moodle exceptions or slow answers and
+    growing back while Moodle answers fast.
+    """
+
+    def __init__(self, base_url, token, timeout=DEFAULT_TIMEOUT, pool_size=DEFAULT_POOL_SIZE,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff_factor=DEFAULT_BACKOFF_FACTOR,
+                 rate_limit=DEFAULT_RATE_LIMIT, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 target_latency=DEFAULT_TARGET_LATENCY):
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.token = token
+        self.timeout = timeout
+        self.pool_size = max(pool_size, 1)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.session = get_session(self.pool_size)
+        self.governor = get_governor(self.base_url, rate_limit, max_concurrency, target_latency)
+
+    @classmethod
+    def from_env(cls, env, min_pool_size=0):
+        """Build a client from the digi_moodle_sync.* system parameters.
+
+        ``min_pool_size`` lets concurrent callers make sure the pool holds at
+        least one connection per fetch thread.
+        """
+        params = env['ir.config_parameter'].sudo()
+        pool_size = _get_int_param(params, 'digi_moodle_sync.http_pool_size', DEFAULT_POOL_SIZE)
+        return cls(
+            params.get_param('digi_moodle_sync.moodle_url'),
+            params.get_param('digi_moodle_sync.token'),
+            timeout=_get_int_param(params, 'digi_moodle_sync.http_timeout', DEFAULT_TIMEOUT),
+            pool_size=max(pool_size, min_pool_size),
+            max_retries=_get_int_param(params, 'digi_moodle_sync.http_max_retries', DEFAULT_MAX_RETRIES),
+            backoff_factor=_get_float_param(params, 'digi_moodle_sync.http_backoff_factor', DEFAULT_BACKOFF_FACTOR),
+            rate_limit=_get_float_param(params, 'digi_moodle_sync.rate_limit', DEFAULT_RATE_LIMIT),
+            max_concurrency=_get_int_param(params, 'digi_moodle_sync.max_concurrency', DEFAULT_MAX_CONCURRENCY),
+            target_latency=_get_float_param(params, 'digi_moodle_sync.target_latency', DEFAULT_TARGET_LATENCY),
+        )
+
+    @property
+    def api_url(self):
+        if not self.base_url:
+            return None
+        # Chấp nhận cả cấu hình cũ lưu sẵn đường dẫn REST đầy đủ
+        if self.base_url.endswith(MOODLE_REST_PATH):
+            return self.base_url
+        return self.base_url + MOODLE_REST_PATH
+
+    @property
+    def is_configured(self):
+        return bool(self.base_url and self.token)
+
+    def _build_payload(self, wsfunction, params):
+        payload = {
+            'wstoken': self.token,
+            'wsfunction': wsfunction,
+            'moodlewsrestformat': 'json',
+        }
+        if params:
+            payload.update(params)
+        return payload
+
+    def _get_backoff(self, attempt, response=None):
+        retry_after = response is not None and response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(float(retry_after), MAX_BACKOFF_SECONDS)
+            except (TypeError, ValueError):
+                pass
+        return min(self.backoff_factor * (2 ** attempt), MAX_BACKOFF_SECONDS)
+
+    def request(self, wsfunction, params=None, timeout=None, method='GET', stream=False, max_retries=None):
+        """Send one webservice call and return the raw ``requests.Response``.
+
+        Connection errors, timeouts and transient HTTP statuses are retried
+        with exponential backoff; the last response or error is surfaced to
+        the caller unchanged so existing error handling keeps working. Each
+        attempt waits for the governor first and reports its outcome to it.
+        ``max_retries`` overrides the client setting for this call, e.g. 0
+        when the caller has a cheaper fallback than waiting for retries.
+        """
+        if max_retries is None:
+            max_retries = self.max_retries
+        payload = self._build_payload(wsfunction, params)
+        read_timeout = timeout or self.timeout
+        call_timeout = (min(DEFAULT_CONNECT_TIMEOUT, read_timeout), read_timeout)
+        started_at = time.monotonic()
+        attempt = 0
+        response = None
+        try:
+            while True:
+                response = None
+                try:
+                    with self.governor.slot() as outcome:
+                        if method == 'POST':
+                            response = self.session.post(self.api_url, data=payload, timeout=call_timeout, stream=stream)
+                        else:
+                            response = self.session.get(self.api_url, params=payload, timeout=call_timeout, stream=stream)
+                        if response.status_code in OVERLOAD_STATUS_CODES or (not stream and _is_exception_payload(response)):
+                            outcome.overloaded()
+                except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                    if attempt >= max_retries:
+                        raise
+                    _logger.warning(f"Moodle call {wsfunction} failed ({e}), retry {attempt + 1}/{max_retries}")
+                else:
+                    if response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries:
+                        return response
+                    _logger.warning(f"Moodle call {wsfunction} returned HTTP {response.status_code}, retry {attempt + 1}/{max_retries}")
+                    response.close()
+                time.sleep(self._get_backoff(attempt, response))
+                attempt += 1
+        finally:
+            record_call(wsfunction, time.monotonic() - started_at, _call_status(response, stream),
+                        size=_response_size(response, stream), retries=attempt)
+
+    def call(self, wsfunction, params=None, timeout=None, method='GET', max_retries=None):
+        """Send one webservice call and return the decoded JSON payload."""
+        response = self.request(wsfunction, params=params, timeout=timeout, method=method, max_retries=max_retries)
+        response.raise_for_status()
+        return response.json()
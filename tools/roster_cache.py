@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import logging
+import threading
+import time
+from collections import namedtuple
+from datetime import timedelta
+
+from odoo import fields
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_ROSTER_TTL = 600
+
+# Đồng bộ tiến độ và wizard chỉ cần id của học viên
+ROSTER_USER_FIELDS = 'id'
+
+Roster = namedtuple('Roster', ['users', 'digest', 'changed'])
+
+_rosters = {}
+_rosters_lock = threading.Lock()
+
+
+def _get_ttl(env):
+    value = env['ir.config_parameter'].sudo().get_param('digi_moodle_sync.roster_cache_ttl')
+    try:
+        return max(int(value if value not in (None, False, '') else DEFAULT_ROSTER_TTL), 0)
+    except (TypeError, ValueError):
+        _logger.warning(f"Invalid digi_moodle_sync.roster_cache_ttl '{value}', using {DEFAULT_ROSTER_TTL}")
+        return DEFAULT_ROSTER_TTL
+
+
+def roster_digest(users):
+    """Stable hash of a roster, independent of the order Moodle returns users in."""
+    canonical = json.dumps(sorted(users, key=lambda u: u.get('id') or 0), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def get_course_roster(env, client, course):
+    """Enrolled users of ``course`` (a moodle.course), fetched at most once per TTL.
+
+    The progress sync and the wizard both need the roster of every course;
+    within ``digi_moodle_sync.roster_cache_ttl`` seconds (0 disables) the
+    second caller in the same worker gets the cached list. Teacher sync
+    asks Moodle for active teachers only and does not use this cache. With
+    ``digi_moodle_sync.roster_cache_persist`` the roster and its hash are
+    also stored on the course, so another worker or a later run within the
+    TTL reuses it, and a refetch with the same hash does not rewrite it.
+
+    Returns a ``Roster(users, digest, changed)``; ``changed`` is False when
+    the hash equals the last persisted one. Transport errors and Moodle
+    exceptions raise ``requests.RequestException`` / ``ValueError`` and are
+    never cached.
+    """
+    ttl = _get_ttl(env)
+    persist = bool(env['ir.config_parameter'].sudo().get_param('digi_moodle_sync.roster_cache_persist'))
+
+    roster = peek_course_roster(env, client, course)
+    if roster is not None:
+        return roster
+
+    course = course.sudo()
+    users = client.call('core_enrol_get_enrolled_users', {
+        'courseid': course.moodle_id,
+        'options[0][name]': 'userfields',
+        'options[0][value]': ROSTER_USER_FIELDS,
+    }, timeout=60)
+    if isinstance(users, dict) and 'exception' in users:
+        raise ValueError(f"{users.get('message', 'Unknown error')} - Code: {users.get('errorcode', 'Unknown')}")
+    if not isinstance(users, list):
+        raise ValueError(f"Unexpected core_enrol_get_enrolled_users response: {users}")
+    digest = roster_digest(users)
+    roster = Roster(users, digest, digest != course.roster_hash)
+    if persist:
+        vals = {'roster_fetched_at': fields.Datetime.now()}
+        if roster.changed:
+            vals.update(roster_hash=digest, roster_data=json.dumps(users))
+        course.write(vals)
+    _remember(env, client, course, roster, ttl)
+    return roster
+
+
+def peek_course_roster(env, client, course):
+    """The cached roster of ``course`` if still fresh, else None; never calls Moodle."""
+    ttl = _get_ttl(env)
+    if not ttl:
+        return None
+    now = time.monotonic()
+    with _rosters_lock:
+        cached = _rosters.get(_cache_key(env, client, course))
+    if cached and cached[0] > now:
+        return cached[1]
+
+    persist = bool(env['ir.config_parameter'].sudo().get_param('digi_moodle_sync.roster_cache_persist'))
+    course = course.sudo()
+    if persist and course.roster_hash and course.roster_fetched_at \
+            and course.roster_fetched_at > fields.Datetime.now() - timedelta(seconds=ttl):
+        roster = Roster(json.loads(course.roster_data or '[]'), course.roster_hash, False)
+        _remember(env, client, course, roster, ttl)
+        return roster
+    return None
+
+
+def _cache_key(env, client, course):
+    return (env.cr.dbname, client.base_url, course.moodle_id)
+
+
+def _remember(env, client, course, roster, ttl):
+    if not ttl:
+        return
+    now = time.monotonic()
+    with _rosters_lock:
+        for stale_key in [k for k, (expires_at, _r) in _rosters.items() if expires_at <= now]:
+            del _rosters[stale_key]
+        _rosters[_cache_key(env, client, course)] = (now + ttl, roster)
+
+
+def clear_roster_cache():
+    with _rosters_lock:
+        _rosters.clear()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import time
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 10
+
+
+class SyncCursor(object):
+    """Deadline and resume point shared by the record loops of one sync run.
+
+    Loops walk their records in id order through :meth:`chunks` or
+    :meth:`iterate`. The deadline (a ``time.monotonic()`` value) is only
+    checked between chunks, so a chunk is never cut in half. When it is
+    reached the loop stops, ``interrupted`` is set and ``resume_after``
+    holds the id of the last completed record; a later run built from
+    :meth:`to_state` skips everything up to it.
+
+    ``data`` keeps small JSON values a sync needs across resumes, such as
+    the start of the run for watermarks.
+
+    ``on_checkpoint(cursor)`` is called after every completed chunk; the job
+    runner uses it to store the cursor and commit, so a worker killed
+    mid-run only loses the chunk it was on.
+    """
+
+    def __init__(self, resume_after=None, deadline=None, data=None, chunk_size=DEFAULT_CHUNK_SIZE, on_checkpoint=None):
+        self.resume_after = resume_after
+        self.deadline = deadline
+        self.data = data or {}
+        self.chunk_size = chunk_size
+        self.on_checkpoint = on_checkpoint
+        self.interrupted = False
+
+    @classmethod
+    def from_state(cls, state, deadline=None, on_checkpoint=None):
+        state = json.loads(state) if isinstance(state, str) and state else (state or {})
+        return cls(resume_after=state.get('resume_after'), deadline=deadline, data=state.get('data'),
+                   on_checkpoint=on_checkpoint)
+
+    def to_state(self):
+        return json.dumps({'resume_after': self.resume_after, 'data': self.data})
+
+    @property
+    def resumed(self):
+        return self.resume_after is not None
+
+    def expired(self):
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def pending(self, records):
+        """Records not handled by a previous run, in id order."""
+        records = records.sorted('id')
+        if self.resume_after is not None:
+            records = records.filtered(lambda r: r.id > self.resume_after)
+        return records
+
+    def chunks(self, records, chunk_size=None):
+        """Yield the pending records chunk by chunk until the deadline."""
+        records = self.pending(records)
+        chunk_size = chunk_size or self.chunk_size
+        for start in range(0, len(records), chunk_size):
+            if self.expired():
+                self.interrupted = True
+                _logger.info(f"Sync time budget reached, {len(records) - start} {records._name} records left for the next run")
+                return
+            chunk = records[start:start + chunk_size]
+            yield chunk
+            self.resume_after = chunk[-1].id
+            if self.on_checkpoint:
+                self.on_checkpoint(self)
+
+    def item_chunks(self, items, key, chunk_size=None):
+        """Like :meth:`chunks` for plain items from outside Odoo, in ``key(item)`` order.
+
+        For lists Moodle returns at once (e.g. the course list): ``key`` gives
+        a stable integer id and ``resume_after`` holds the key of the last
+        completed item.
+        """
+        items = sorted(items, key=key)
+        if self.resume_after is not None:
+            items = [item for item in items if key(item) > self.resume_after]
+        chunk_size = chunk_size or self.chunk_size
+        for start in range(0, len(items), chunk_size):
+            if self.expired():
+                self.interrupted = True
+                _logger.info(f"Sync time budget reached, {len(items) - start} items left for the next run")
+                return
+            chunk = items[start:start + chunk_size]
+            yield chunk
+            self.resume_after = key(chunk[-1])
+            if self.on_checkpoint:
+                self.on_checkpoint(self)
+
+    def iterate(self, records, chunk_size=None):
+        """Like :meth:`chunks` but yields records one by one."""
+        for chunk in self.chunks(records, chunk_size):
+            for record in chunk:
+                yield record
+
+    def id_ranges(self, size, start=1):
+        """Yield ``(first, last)`` id ranges of ``size`` ids from the resume point.
+
+        For sources paged by id outside Odoo (e.g. the Moodle user table).
+        The sequence is endless: the caller breaks when it reaches the end.
+        """
+        first = self.resume_after + 1 if self.resume_after is not None else start
+        while True:
+            if self.expired():
+                self.interrupted = True
+                _logger.info(f"Sync time budget reached, resuming after id {self.resume_after} in the next run")
+                return
+            last = first + size - 1
+            yield first, last
+            self.resume_after = last
+            if self.on_checkpoint:
+                self.on_checkpoint(self)
+            first = last + 1
+
+    def summary(self):
+        """Keys to merge into a sync payload when the run stopped early."""
+        return {'interrupted': True, 'resume_after': self.resume_after} if self.interrupted else {}
+
+    def restart(self):
+        """Forget the resume point, e.g. before the next pipeline stage."""
+        self.resume_after = None
+        self.data = {}
+        self.interrupted = False
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_RATE_LIMIT = 20.0
+DEFAULT_MAX_CONCURRENCY = 8
+DEFAULT_TARGET_LATENCY = 5.0
+
+# Mã HTTP cho biết Moodle đang quá tải
+OVERLOAD_STATUS_CODES = (429, 503)
+
+# Giảm một nửa khi quá tải, tăng dần một slot sau mỗi "cửa sổ" request khoẻ
+DECREASE_FACTOR = 0.5
+
+_governors = {}
+_governors_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket: at most ``rate`` calls per second, bursts up to ``burst``.
+
+    ``rate`` 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst=None):
+        self._lock = threading.Lock()
+        self.configure(rate, burst)
+        self._tokens = self.burst
+        self._updated_at = time.monotonic()
+
+    def configure(self, rate, burst=None):
+        with self._lock:
+            self.rate = max(float(rate or 0), 0.0)
+            self.burst = max(float(burst or self.rate), 1.0)
+
+    def acquire(self):
+        """Take one token, sleeping until one is available; returns the time waited."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                if not self.rate:
+                    return waited
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdaptiveConcurrency(object):
+    """Concurrency limit adjusted from the calls' outcome (AIMD).
+
+    A call that is overloaded (HTTP 429/503, Moodle exception payload) or
+    slower than ``target_latency`` halves the limit; a healthy call raises
+    it by ``1 / limit``, i.e. one slot per window of healthy calls, up to
+    ``max_limit``. Only calls started after the last decrease can decrease
+    it again, so one burst of slow calls halves the limit once.
+    """
+
+    def __init__(self, max_limit, target_latency, min_limit=1):
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        self.min_limit = max(int(min_limit), 1)
+        self.max_limit = max(int(max_limit or 1), self.min_limit)
+        self.target_latency = max(float(target_latency or 0), 0.0)
+        self.limit = float(self.max_limit)
+        self._decreased_at = 0.0
+
+    def configure(self, max_limit, target_latency):
+        with self._condition:
+            self.max_limit = max(int(max_limit or 1), self.min_limit)
+            self.target_latency = max(float(target_latency or 0), 0.0)
+            self.limit = min(self.limit, self.max_limit)
+            self._condition.notify_all()
+
+    def acquire(self):
+        """Wait for a free slot; returns the call start time to hand back to :meth:`release`."""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started_at, overloaded=False):
+        latency = time.monotonic() - started_at
+        slow = bool(self.target_latency) and latency > self.target_latency
+        with self._condition:
+            self.in_flight -= 1
+            if overloaded or slow:
+                if started_at >= self._decreased_at and self.limit > self.min_limit:
+                    self.limit = max(self.limit * DECREASE_FACTOR, self.min_limit)
+                    self._decreased_at = time.monotonic()
+                    _logger.info(f"Moodle {'overloaded' if overloaded else f'slow ({latency:.1f}s)'}, concurrency limit down to {int(self.limit)}")
+            elif self.limit < self.max_limit:
+                self.limit = min(self.limit + 1 / self.limit, self.max_limit)
+            self._condition.notify_all()
+
+
+class MoodleGovernor(object):
+    """Rate limit and adaptive concurrency shared by every call to one Moodle site.
+
+    One governor exists per worker process and site (see :func:`get_governor`),
+    so parallel fetch threads and concurrent syncs of a worker share the
+    same budget.
+    """
+
+    def __init__(self, rate_limit=DEFAULT_RATE_LIMIT, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 target_latency=DEFAULT_TARGET_LATENCY):
+        self.bucket = TokenBucket(rate_limit)
+        self.concurrency = AdaptiveConcurrency(max_concurrency, target_latency)
+
+    def configure(self, rate_limit, max_concurrency, target_latency):
+        self.bucket.configure(rate_limit)
+        self.concurrency.configure(max_concurrency, target_latency)
+
+    @contextmanager
+    def slot(self):
+        """Hold a rate token and a concurrency slot for one call.
+
+        The body calls ``outcome.overloaded()`` to report an overload that
+        is not an exception (HTTP 429/503, Moodle exception payload).
+        Transport errors count as overload.
+        """
+        self.bucket.acquire()
+        outcome = _CallOutcome()
+        started_at = self.concurrency.acquire()
+        try:
+            yield outcome
+        except Exception:
+            outcome.overloaded()
+            raise
+        finally:
+            self.concurrency.release(started_at, overloaded=outcome.is_overloaded)
+
+
+class _CallOutcome(object):
+    __slots__ = ('is_overloaded',)
+
+    def __init__(self):
+        self.is_overloaded = False
+
+    def overloaded(self):
+        self.is_overloaded = True
+
+
+def get_governor(base_url, rate_limit=DEFAULT_RATE_LIMIT, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 target_latency=DEFAULT_TARGET_LATENCY):
+    """Return the governor of ``base_url`` in this worker process, updated with the given limits."""
+    key = (os.getpid(), base_url)
+    with _governors_lock:
+        governor = _governors.get(key)
+        if governor is None:
+            governor = _governors[key] = MoodleGovernor(rate_limit, max_concurrency, target_latency)
+            return governor
+    governor.configure(rate_limit, max_concurrency, target_latency)
+    return governor
@@ -1,11 +1,15 @@
 # -*- coding: utf-8 -*-
 import logging
-import requests
 from odoo import api, fields, models, _
 from odoo.exceptions import UserError, AccessError
 from datetime import datetime
 # Import the controller
 from odoo.addons.digi_moodle_sync.controllers.teacher_sync import MoodleTeacherSync # Adjusted import path
+from odoo.addons.digi_moodle_sync.controllers.assignments_sync import MoodleAssignmentSync, get_assignment_course_batch_size
+from odoo.addons.digi_moodle_sync.tools.moodle_client import MoodleClient
+from odoo.addons.digi_moodle_sync.tools.roster_cache import get_course_roster
+from odoo.addons.digi_moodle_sync.tools.json_stream import JsonArrayStream
+from odoo.addons.digi_moodle_sync.tools.sync_cursor import SyncCursor
 
 _logger = logging.getLogger(__name__)
 
@@ -27,7 +31,8 @@ class MoodleSyncWizard(models.TransientModel):
         params = self.env['ir.config_parameter'].sudo()
         return {
             'token': params.get_param('digi_moodle_sync.token'),
-            'url': params.get_param('digi_moodle_sync.moodle_url')
+            'url': params.get_param('digi_moodle_sync.moodle_url'),
+            'client': MoodleClient.from_env(self.env),
         }
 
     def _check_access_rights_for_wizard(self):
@@ -71,87 +76,85 @@ class MoodleSyncWizard(models.TransientModel):
                 }
             }
 
-        # Sync users first
-        self._sync_users(config)
-
-        if self.sync_type in ['activity', 'all']:
-            self._sync_activities(config)
-        if self.sync_type in ['assignment', 'all']:
-            self._sync_assignments(config)
-        if self.sync_type in ['submission', 'all']:
-            self._sync_submissions(config)
-        if self.sync_type in ['teacher', 'all']:
-            _logger.info("Wizard: Starting teacher synchronization...")
-            try:
-                # Instantiate the controller
-                # Ensure MoodleTeacherSync is imported at the top of the file:
-                # from odoo.addons.digi_moodle_sync.controllers.teacher_sync import MoodleTeacherSync
-                teacher_sync_controller = MoodleTeacherSync()
-                
-                # Calling controller methods directly like this is generally not recommended
-                # as they are designed for HTTP requests and might depend on `odoo.http.request`.
-                # A better long-term solution is to move the core sync logic to a model method
-                # that both the controller and wizard can call.
-                # For this refactoring, we proceed with the direct call, assuming `request.env`
-                # is available or the controller method is simple enough.
-                
-                # Simulate a basic request object if the controller heavily relies on it.
-                # For now, we pass 'self.env' which is available in wizard methods.
-                # The controller's sync_teachers might need to be adapted to accept `env`
-                # or to work without a full HTTP request context if it uses `request.env`
-                
-                # Attempt to call with current environment if controller logic can handle it
-                # This is a simplification. Proper context passing or a shared model method is ideal.
-                with self.env.cr.savepoint(): # Use a savepoint for safety
-                    # The controller's sync_teachers doesn't take specific arguments other than **kwargs
-                    # which are http params. It internally gets config and courses.
-                    result_message = teacher_sync_controller.sync_teachers() 
-                
-                _logger.info(f"Wizard: Teacher synchronization via controller result: {result_message}")
-
-            except Exception as e:
-                _logger.error(f"Wizard: Error during teacher synchronization via controller: {str(e)}", exc_info=True)
-                # Show an error to the user
-                return {
-                    'type': 'ir.actions.client',
-                    'tag': 'display_notification',
-                    'params': {
-                        'title': _('Teacher Sync Error'),
-                        'message': _('Failed to sync teachers: %s') % str(e),
-                        'type': 'danger',
-                        'sticky': True,
-                    }
-                }
-            _logger.info("Wizard: Teacher synchronization finished.")
-
+        # Chạy nền qua moodle.sync.job để không bị giới hạn thời gian của request
+        job = self.env['moodle.sync.job'].sudo().enqueue('wizard', {'sync_type': self.sync_type})
         return {
             'type': 'ir.actions.client',
             'tag': 'display_notification',
             'params': {
                 'title': 'Success',
-                'message': 'Data synchronized successfully',
+                'message': _('Sync job #%s queued. Progress is available under Moodle Sync > Sync Jobs.') % job.id,
                 'type': 'success',
                 'sticky': False,
             }
         }
 
+    def _run_sync(self, progress=None, cursor=None):
+        """Run the selected sync steps; called by the moodle.sync.job runner.
+
+        ``cursor`` (a SyncCursor) time-boxes the run between steps: a step
+        is never cut, and a resumed run starts after the last finished one.
+        """
+        cursor = cursor or SyncCursor()
+        config = self._get_moodle_config()
+        if not config['token'] or not config['url']:
+            return {'error': 'Moodle configuration is missing. Please configure token and URL.'}, 200
+
+        steps = ['users']
+        if self.sync_type in ['activity', 'all']:
+            steps.append('activity')
+        if self.sync_type in ['assignment', 'all']:
+            steps.append('assignment')
+        if self.sync_type in ['submission', 'all']:
+            steps.append('submission')
+        if self.sync_type in ['teacher', 'all']:
+            steps.append('teacher')
+
+        # Mỗi bước là một nhóm của cursor, khóa là số thứ tự bước (bắt đầu từ 1)
+        for [number] in cursor.item_chunks(range(1, len(steps) + 1), key=int, chunk_size=1):
+            index, step = number - 1, steps[number - 1]
+            if progress:
+                progress(index, len(steps))
+            if step == 'users':
+                self._sync_users(config)
+            elif step == 'activity':
+                self._sync_activities(config)
+            elif step == 'assignment':
+                self._sync_assignments(config)
+            elif step == 'submission':
+                self._sync_submissions(config)
+            elif step == 'teacher':
+                _logger.info("Wizard: Starting teacher synchronization...")
+                try:
+                    with self.env.cr.savepoint():
+                        result, status = MoodleTeacherSync()._sync_teachers(self.env)
+                    _logger.info(f"Wizard: Teacher synchronization result: {result}")
+                except Exception as e:
+                    _logger.error(f"Wizard: Error during teacher synchronization: {str(e)}", exc_info=True)
+                    return {'error': _('Failed to sync teachers: %s') % str(e)}, 500
+                _logger.info("Wizard: Teacher synchronization finished.")
+        if cursor.interrupted:
+            return {'message': 'Data partially synchronized, the remaining steps run in the next tick',
+                    'sync_type': self.sync_type, **cursor.summary()}, 200
+        if progress:
+            progress(len(steps), len(steps))
+
+        return {'message': 'Data synchronized successfully', 'sync_type': self.sync_type}, 200
+
     def _sync_users(self, config):
         """Đồng bộ người dùng từ Moodle sang Odoo"""
         params = {
-            'wstoken': config['token'],
-            'wsfunction': 'core_user_get_users',
             'criteria[0][key]': 'email',
             'criteria[0][value]': '%',  # Lấy tất cả người dùng
-            'moodlewsrestformat': 'json'
         }
 
         try:
-            response = requests.get(f"{config['url']}/webservice/rest/server.php", params=params)
+            # Đọc danh bạ người dùng dạng stream thay vì nạp cả phản hồi vào bộ nhớ
+            response = config['client'].request('core_user_get_users', params, timeout=60, stream=True)
             response.raise_for_status()
-            data = response.json()
 
-            if isinstance(data, dict) and 'users' in data:
-                for user_data in data['users']:
+            with response:
+                for user_data in JsonArrayStream(response, 'users'):
                     email = user_data.get('email')
                     if not email:
                         continue
@@ -199,17 +202,20 @@ class MoodleSyncWizard(models.TransientModel):
         users = self.env['res.users'].search([('moodle_id', '!=', False)])
 
         for course in courses:
-            for user in users:
+            # Chỉ gọi cho người dùng có ghi danh; danh sách dùng chung cache với đồng bộ tiến độ
+            try:
+                enrolled_moodle_ids = {u.get('id') for u in get_course_roster(self.env, config['client'], course).users}
+            except Exception as e:
+                _logger.error(f"Error fetching enrolled users of course {course.name}: {str(e)}")
+                continue
+            for user in users.filtered(lambda u: u.moodle_id in enrolled_moodle_ids):
                 params = {
-                    'wstoken': config['token'],
-                    'wsfunction': 'core_completion_get_activities_completion_status',
                     'courseid': course.moodle_id,
                     'userid': user.moodle_id,
-                    'moodlewsrestformat': 'json'
                 }
 
                 try:
-                    response = requests.get(config['url'] + '/webservice/rest/server.php', params=params)
+                    response = config['client'].request('core_completion_get_activities_completion_status', params)
                     response.raise_for_status()
                     data = response.json()
 
@@ -242,94 +248,55 @@ class MoodleSyncWizard(models.TransientModel):
                     _logger.error(f"Error syncing progress for user {user.name} in course {course.name}: {str(e)}")
 
     def _sync_assignments(self, config):
-        courses = self.env['moodle.course'].search([])
-        
-        for course in courses:
-            params = {
-                'wstoken': config['token'],
-                'wsfunction': 'mod_assign_get_assignments',
-                'courseids[]': course.moodle_id,
-                'moodlewsrestformat': 'json'
-            }
-
+        courses = self.env['moodle.course'].search([('moodle_id', '!=', False)])
+        batch_size = get_assignment_course_batch_size(self.env)
+        assignment_sync = MoodleAssignmentSync()
+
+        # Một lần gọi mod_assign_get_assignments cho mỗi nhóm khóa học
+        for start in range(0, len(courses), batch_size):
+            course_batch = courses[start:start + batch_size]
+            courses_by_moodle_id = {course.moodle_id: course for course in course_batch}
             try:
-                response = requests.get(config['url'] + '/webservice/rest/server.php', params=params)
-                response.raise_for_status()
-                data = response.json()
-
-                if 'courses' in data:
-                    for course_data in data['courses']:
-                        for assignment in course_data.get('assignments', []):
-                            vals = {
-                                'moodle_id': assignment['id'],
-                                'name': assignment['name'],
-                                'duedate': assignment.get('duedate'),
-                                'course_id': course.id,
-                                'last_sync_date': datetime.now(),
-                            }
-
-                            assign = self.env['moodle.assignment'].search([
-                                ('moodle_id', '=', assignment['id'])
-                            ])
-
-                            if assign:
-                                assign.write(vals)
-                                _logger.debug(f"Updated assignment {assignment['name']} for course {course.name}")
-                            else:
-                                self.env['moodle.assignment'].create(vals)
-                                _logger.debug(f"Created assignment {assignment['name']} for course {course.name}")
-
+                assignments_by_course = assignment_sync._fetch_assignments_by_course(config['client'], list(courses_by_moodle_id))
             except Exception as e:
-                _logger.error(f"Error syncing assignments for course {course.name}: {str(e)}")
-
-    def _sync_submissions(self, config):
-        assignments = self.env['moodle.assignment'].search([])
-        
-        for assignment in assignments:
-            params = {
-                'wstoken': config['token'],
-                'wsfunction': 'mod_assign_get_submissions',
-                'assignmentids[]': assignment.moodle_id,
-                'moodlewsrestformat': 'json'
-            }
+                _logger.error(f"Error syncing assignments for courses {course_batch.mapped('name')}: {str(e)}")
+                continue
 
-            try:
-                response = requests.get(config['url'] + '/webservice/rest/server.php', params=params)
-                response.raise_for_status()
-                data = response.json()
-
-                if 'assignments' in data:
-                    for assign_data in data['assignments']:
-                        for submission in assign_data.get('submissions', []):
-                            user = self.env['res.users'].search([
-                                ('moodle_id', '=', submission['userid'])
-                            ])
-                            if not user:
-                                continue
-
-                            vals = {
-                                'assignment_id': assignment.id,
-                                'user_id': user.id,
-                                'status': submission['status'],
-                                'timemodified': submission.get('timemodified'),
-                                'grade': submission.get('grade'),
-                                'last_sync_date': datetime.now(),
-                            }
-
-                            sub = self.env['moodle.assignment.submission'].search([
-                                ('assignment_id', '=', assignment.id),
-                                ('user_id', '=', user.id)
-                            ])
+            for moodle_course_id, assignments in assignments_by_course.items():
+                course = courses_by_moodle_id.get(moodle_course_id)
+                if not course:
+                    continue
+                try:
+                    for assignment in assignments:
+                        vals = {
+                            'moodle_id': assignment['id'],
+                            'name': assignment['name'],
+                            'duedate': datetime.fromtimestamp(assignment['duedate']) if assignment.get('duedate') else False,
+                            'course_id': course.id,
+                            'last_sync_date': datetime.now(),
+                        }
+
+                        assign = self.env['moodle.assignment'].search([
+                            ('moodle_id', '=', assignment['id'])
+                        ])
+
+                        if assign:
+                            assign.write(vals)
+                            _logger.debug(f"Updated assignment {assignment['name']} for course {course.name}")
+                        else:
+                            self.env['moodle.assignment'].create(vals)
+                            _logger.debug(f"Created assignment {assignment['name']} for course {course.name}")
 
-                            if sub:
-                                sub.write(vals)
-                                _logger.debug(f"Updated submission for user {user.name} in assignment {assignment.name}")
-                            else:
-                                self.env['moodle.assignment.submission'].create(vals)
-                                _logger.debug(f"Created submission for user {user.name} in assignment {assignment.name}")
+                except Exception as e:
+                    _logger.error(f"Error syncing assignments for course {course.name}: {str(e)}")
 
-            except Exception as e:
-                _logger.error(f"Error syncing submissions for assignment {assignment.name}: {str(e)}")
+    def _sync_submissions(self, config):
+        assignments = self.env['moodle.assignment'].search([('moodle_id', '!=', False)])
+        assignment_sync = MoodleAssignmentSync()
+        # Một bản đồ moodle_id -> người dùng cho cả lượt; wizard luôn tải lại toàn bộ bài nộp
+        user_map = assignment_sync._get_user_moodle_map(self.env)
+        count = assignment_sync._sync_submissions(self.env, config, assignments, full=True, user_map=user_map)
+        _logger.info(f"Synced {count} submissions for {len(assignments)} assignments")
 
     # The old _sync_teachers method in the wizard should be REMOVED by this edit.
     # If it's not, it means the `// ... existing code ...` marker was not placed correctly